@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+"""!
+@package psmap_benchmark
+
+@brief benchmarks of instruction parsing, serialization and coordinate transforms
+
+Synthetic instruction files with increasing number of text and vector
+blocks are generated, GRASS modules and map queries are replaced by
+GrassStandIn, so only the code of ps.map GUI is measured. Each case runs
+in a separate process, best time of several runs, peak memory (RSS) of
+the process and its increase during the case are reported and compared
+with baseline saved earlier on the same computer.
+
+Usage (in GRASS session, GISBASE is needed for GUI modules):
+
+    python psmap_benchmark.py --save-baseline
+    python psmap_benchmark.py
+
+Classes:
+ - GrassStandIn
+ - Benchmark
+
+(C) 2011 by Anna Kratochvilova, and the GRASS Development Team
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author Anna Kratochvilova <anna.kratochvilova fsv.cvut.cz> (bachelor's project)
+@author Martin Landa <landa.martin gmail.com> (mentor)
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import tempfile
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+# modules of this working copy are preferred to installed ones
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarkDir, os.pardir, 'gui_modules'))
+if os.getenv('GISBASE'):
+    sys.path.append(os.path.join(os.getenv('GISBASE'), 'etc', 'python'))
+    sys.path.append(os.path.join(os.getenv('GISBASE'), 'etc', 'wxpython', 'gui_modules'))
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import wx
+import grass.script as grass
+
+import psmap_dialogs as pd
+
+defaultBaseline = os.path.join(benchmarkDir, 'psmap_benchmark_baseline.json')
+defaultSizes = (10, 100, 1000, 10000)
+
+class GrassStandIn:
+    """!Answers GRASS module calls and map queries of psmap_dialogs without GRASS
+
+    Location has UTM projection, current region 10 x 10 km, all maps are
+    found in mapset PERMANENT.
+    """
+    region = dict(n = 5010000., s = 5000000., e = 610000., w = 600000.,
+                  nsres = 10., ewres = 10., rows = 1000, cols = 1000, cells = 1000000.)
+    gisenv = dict(GISDBASE = tempfile.gettempdir(), LOCATION_NAME = 'psmap_benchmark', MAPSET = 'PERMANENT')
+    projInfo = dict(name = 'UTM', proj = 'utm', zone = '33', units = 'meters', meters = '1.0')
+
+    class VectorDBInfo:
+        layers = {1 : dict(table = 'roads', key = 'cat', database = '', driver = 'dbf')}
+
+    def Install(self):
+        """!Replace functions calling GRASS"""
+        pd.RunCommand = self.RunCommand
+        pd.Region = lambda: dict(self.region)
+        pd.FindFile = self.FindFile
+        pd.GetVectorDBInfo = lambda name: self.VectorDBInfo()
+        pd.GMessage = pd.GWarning = pd.GError = lambda *args, **kwargs: None
+        grass.read_command = self.ReadCommand
+        pd.RasterInfo = lambda map: dict(datatype = 'FCELL', min = 0., max = 1500.,
+                                         nsres = 10., ewres = 10.)
+        pd.MapBounds = lambda input: self.ReadCommand('ps.map', flags = 'b', input = input)
+        pd.PaperSizes = lambda: self.ReadCommand('ps.map', flags = 'p')
+        pd.ProjInfo = lambda: dict(self.projInfo)
+        grass.gisenv = lambda: dict(self.gisenv)
+        grass.del_temp_region = grass.use_temp_region = lambda: None
+        pd.GetGisEnv = lambda: dict(self.gisenv)
+        pd.projInfoCache.clear()
+        pd.projInfoCache.update(self.projInfo)
+
+    def FindFile(self, name, element = 'cell', mapset = ''):
+        name = name.split('@')[0]
+        return dict(name = name, mapset = 'PERMANENT', fullname = '%s@PERMANENT' % name,
+                    file = os.path.join(self.gisenv['GISDBASE'], self.gisenv['LOCATION_NAME'],
+                                        'PERMANENT', element, name))
+
+    def RunCommand(self, prog, read = False, **kwargs):
+        if prog == 'g.proj':
+            return '\n'.join(['%s: %s' % item for item in self.projInfo.items()])
+        if prog == 'g.mlist':
+            return ''
+        if read:
+            return ''
+        return 0
+
+    def ReadCommand(self, prog, flags = '', **kwargs):
+        if prog == 'ps.map' and flags == 'p':
+            # paper formats: width, height, left, right, top, bottom (inch)
+            return 'a4 8.268 11.693 0.5 0.5 1 1\nletter 8.5 11 0.5 0.5 1 1\n'
+        if prog == 'ps.map':
+            # map frame bounding box (inch)
+            return 'bbox=0.5,10.5,8.0,1.0\n'
+        if prog == 'g.region':
+            return '\n'.join(['%s=%s' % (key, self.region[key]) for key in ('n', 's', 'e', 'w', 'nsres', 'ewres')])
+        if prog == 'r.category':
+            return '\n'.join(['%d:class %d' % (i, i) for i in range(1, 21)])
+        return ''
+
+def NewObject(cls, values, *args):
+    """!Returns new instruction object with default values updated by values"""
+    object = cls(wx.NewId(), *args)
+    for key, value in values.iteritems():
+        object[key] = value
+    return object
+
+def MakeFixture(blocks, seed = 0):
+    """!Returns instruction file text with given number of text and vector blocks
+
+    Half of blocks are texts, half are vector maps (points, lines and areas).
+    """
+    rand = random.Random(seed)
+    region = GrassStandIn.region
+    instruction = pd.Instruction(parent = None, objectsToDraw = [])
+
+    instruction.AddInstruction(NewObject(pd.MapFrame, dict(scaleType = 0, mapType = 'raster',
+                                                           map = 'elevation@PERMANENT',
+                                                           rect = wx.Rect2D(0.5, 1.0, 7.5, 9.5),
+                                                           scale = 7.5 * 0.0254 / 10000.)))
+    instruction.AddInstruction(NewObject(pd.PageSetup, dict()))
+    instruction.AddInstruction(NewObject(pd.Raster, dict(isRaster = True, raster = 'elevation@PERMANENT')))
+
+    vectorList = []
+    for i in range(blocks):
+        if i % 2 == 0:
+            instruction.AddInstruction(NewObject(pd.Text, dict(text = 'Label %d' % i,
+                                                               fontsize = rand.choice((8, 10, 12)),
+                                                               east = rand.uniform(region['w'], region['e']),
+                                                               north = rand.uniform(region['s'], region['n']))))
+        else:
+            subType = ('points', 'lines', 'areas')[(i // 2) % 3]
+            name = 'map%d@PERMANENT' % i
+            label = 'map%d (PERMANENT)' % i
+            vProperties = NewObject(pd.VProperties, dict(name = name, label = label, lpos = len(vectorList) + 1),
+                                    subType)
+            instruction.AddInstruction(vProperties)
+            vectorList.append([name, subType, vProperties.id, len(vectorList) + 1, label])
+    if vectorList:
+        instruction.AddInstruction(NewObject(pd.Vector, dict(list = vectorList)))
+        instruction.AddInstruction(NewObject(pd.VectorLegend, dict(vLegend = True, where = (1, 9))))
+    instruction.AddInstruction(NewObject(pd.RasterLegend, dict(rLegend = True, raster = 'elevation@PERMANENT',
+                                                               rasterDefault = False, discrete = 'n',
+                                                               where = (6, 9))))
+    instruction.AddInstruction(NewObject(pd.Mapinfo, dict(where = (0.5, 10.6))))
+    instruction.AddInstruction(NewObject(pd.Scalebar, dict(where = (4, 10.6), length = 1000)))
+    return str(instruction)
+
+def PeakMemory():
+    """!Returns peak resident memory of the process in MB (None if unknown)"""
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes
+        return peak / 1024. / 1024.
+    return peak / 1024.
+
+class Benchmark:
+    """!Runs benchmark cases for all sizes"""
+    def __init__(self, sizes = defaultSizes, repeat = 5):
+        self.sizes = sizes
+        self.repeat = repeat
+        # names of cases to run, all if None
+        self.caseFilter = None
+        # (case, size) -> dict(time, ops, memory, increase)
+        self.results = dict()
+        # (case, size) of cases which failed
+        self.failed = []
+        self.cases = [('read', self.Read),
+                      ('str_cold', self.StrCold),
+                      ('str_warm', self.StrWarm),
+                      ('paper_to_map', self.PaperToMap),
+                      ('map_to_paper', self.MapToPaper),
+                      ('auto_adjust', self.AutoAdjust),
+                      ('estimate_legends', self.EstimateLegends)]
+
+    def Measure(self, func):
+        """!Returns the best time of func() from several runs"""
+        best = None
+        for i in range(self.repeat):
+            gc.collect()
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def Run(self, output = sys.stdout):
+        """!Run all cases, each in separate process (failed ones are marked F)
+
+        @return number of failed cases
+        """
+        for size in self.sizes:
+            for name, case in self.cases:
+                if self.caseFilter and name not in self.caseFilter:
+                    continue
+                result = self.RunProcess(name, size)
+                if result is None:
+                    self.failed.append((name, size))
+                    output.write('F')
+                else:
+                    self.results[(name, size)] = result
+                    output.write('.')
+                output.flush()
+        output.write('\n')
+        return len(self.failed)
+
+    def GetProcessCommand(self, name, size):
+        """!Returns command running one case in new process"""
+        return [sys.executable, os.path.abspath(__file__), '--case-process', '--cases', name,
+                '--sizes', str(size), '--repeat', str(self.repeat)]
+        
+    def RunProcess(self, name, size):
+        """!Run case in new process, peak memory is not affected by other cases
+
+        @return result (see RunCase), None on failure
+        """
+        process = subprocess.Popen(self.GetProcessCommand(name, size), stdout = subprocess.PIPE)
+        stdout = process.communicate()[0]
+        if process.returncode != 0 or not stdout.strip():
+            return None
+        try:
+            return json.loads(stdout.strip().splitlines()[-1])
+        except ValueError:
+            return None
+        
+    def RunCase(self, name, size):
+        """!Run case in current process
+
+        @return dict(time, ops, memory, increase), peak memory after the case
+        and its increase against peak memory measured before the case
+        """
+        self.tmpDir = tempfile.mkdtemp(prefix = 'psmap_benchmark_')
+        try:
+            self.Prepare(size)
+            before = PeakMemory()
+            func, ops = dict(self.cases)[name](size)
+            elapsed = self.Measure(func)
+            peak = PeakMemory()
+        finally:
+            for file in os.listdir(self.tmpDir):
+                os.remove(os.path.join(self.tmpDir, file))
+            os.rmdir(self.tmpDir)
+        increase = None
+        if peak is not None:
+            increase = peak - before
+        return dict(time = elapsed, ops = ops, memory = peak, increase = increase)
+
+    def Prepare(self, size):
+        """!Create instruction file and read instructions for given size"""
+        self.filename = os.path.join(self.tmpDir, 'blocks_%d.psmap' % size)
+        fd = open(self.filename, 'w')
+        try:
+            fd.write(MakeFixture(size))
+        finally:
+            fd.close()
+        self.instruction = pd.Instruction(parent = None, objectsToDraw = [])
+        self.instruction.Read(self.filename)
+        self.map = self.instruction.FindInstructionByType('map')
+        rand = random.Random(size)
+        region = GrassStandIn.region
+        self.paperPoints = [(rand.uniform(0.5, 8.0), rand.uniform(1.0, 10.5)) for i in range(size)]
+        self.mapPoints = [(rand.uniform(region['w'], region['e']), rand.uniform(region['s'], region['n']))
+                          for i in range(size)]
+
+    def Read(self, size):
+        def func():
+            pd.Instruction(parent = None, objectsToDraw = []).Read(self.filename)
+        return func, size
+
+    def StrCold(self, size):
+        def func():
+            for each in self.instruction.instruction:
+                each.SetDirty()
+            str(self.instruction)
+        return func, size
+
+    def StrWarm(self, size):
+        str(self.instruction)
+        def func():
+            str(self.instruction)
+        return func, size
+
+    def PaperToMap(self, size):
+        region = GrassStandIn.region
+        map = self.map.GetInstruction()
+        def func():
+            for x, y in self.paperPoints:
+                pd.PaperMapCoordinates(map, x, y, paperToMap = True, region = region)
+        return func, size
+
+    def MapToPaper(self, size):
+        region = GrassStandIn.region
+        map = self.map.GetInstruction()
+        def func():
+            for e, n in self.mapPoints:
+                pd.PaperMapCoordinates(map, e, n, paperToMap = False, region = region)
+        return func, size
+
+    def AutoAdjust(self, size):
+        class Caller:
+            unitConv = pd.UnitConversion()
+        caller = Caller()
+        rect = wx.Rect2D(0.5, 1.0, 7.5, 9.5)
+        def func():
+            for i in range(size):
+                pd.AutoAdjust(caller, scaleType = 0, rect = rect, map = 'elevation@PERMANENT',
+                              mapType = 'raster')
+        return func, size
+
+    def EstimateLegends(self, size):
+        instruction = self.instruction
+        rasterLegend = instruction.FindInstructionByType('rasterLegend')
+        vectorLegend = instruction.FindInstructionByType('vectorLegend')
+        scalebar = instruction.FindInstructionByType('scalebar')
+        mapinfo = instruction.FindInstructionByType('mapinfo')
+        vector = instruction.FindInstructionByType('vector')
+        page = instruction.FindInstructionByType('page')
+        def func():
+            for i in range(size):
+                for discrete in ('n', 'y'):
+                    rasterLegend.EstimateHeight(raster = rasterLegend['raster'], discrete = discrete,
+                                                fontsize = rasterLegend['fontsize'], cols = rasterLegend['cols'])
+                    rasterLegend.EstimateWidth(raster = rasterLegend['raster'], discrete = discrete,
+                                               fontsize = rasterLegend['fontsize'], cols = rasterLegend['cols'],
+                                               paperInstr = page)
+                if vectorLegend:
+                    vectorLegend.EstimateSize(vectorInstr = vector, fontsize = vectorLegend['fontsize'],
+                                              width = vectorLegend['width'], cols = vectorLegend['cols'])
+                scalebar.EstimateSize(scalebarDict = scalebar.GetInstruction(), scale = self.map['scale'])
+                mapinfo.EstimateRect(mapinfoDict = mapinfo.GetInstruction())
+        return func, size
+
+    def Report(self, baseline = None, tolerance = 0.2, output = sys.stdout):
+        """!Print results and compare them with baseline
+
+        @param baseline results loaded by LoadBaseline()
+        @param tolerance allowed slowdown (0.2 = 20 %)
+
+        @return list of (case, size) slower than baseline, failed or missing
+        (in baseline, but not run)
+        """
+        regressions = []
+        output.write("%-18s %6s %12s %14s %10s %10s %10s\n" % ('case', 'size', 'time [ms]', 'ops/s',
+                                                                'RSS [MB]', 'case [MB]', 'baseline'))
+        for name, case in self.cases:
+            for size in self.sizes:
+                if (name, size) in self.failed:
+                    output.write("%-18s %6d %12s\n" % (name, size, 'FAILED'))
+                    regressions.append((name, size))
+                    continue
+                if (name, size) not in self.results:
+                    continue
+                result = self.results[(name, size)]
+                if result['time'] > 0:
+                    throughput = '%14.0f' % (result['ops'] / result['time'])
+                else:
+                    throughput = '%14s' % '-'
+                if result['memory'] is None:
+                    memory = '%10s %10s' % ('-', '-')
+                else:
+                    memory = '%10.1f %10.1f' % (result['memory'], result['increase'])
+                comparison = ''
+                key = '%s/%d' % (name, size)
+                if baseline and key in baseline and baseline[key]['time'] > 0:
+                    ratio = result['time'] / baseline[key]['time']
+                    comparison = '%+9.0f%%' % ((ratio - 1) * 100)
+                    if ratio > 1 + tolerance:
+                        comparison += ' SLOWER'
+                        regressions.append((name, size))
+                output.write("%-18s %6d %12.2f %s %s %s\n" % (name, size, result['time'] * 1000,
+                                                              throughput, memory, comparison))
+        # cases removed or renamed since baseline was saved
+        for key in sorted(baseline or []):
+            name, size = key.rsplit('/', 1)
+            if int(size) not in self.sizes or (self.caseFilter and name not in self.caseFilter):
+                continue
+            if (name, int(size)) not in self.results and (name, int(size)) not in self.failed:
+                output.write("%-18s %6s %12s\n" % (name, size, 'MISSING'))
+                regressions.append((name, int(size)))
+        return regressions
+
+    def SaveBaseline(self, filename):
+        """!Save results as baseline"""
+        data = dict()
+        for (name, size), result in self.results.iteritems():
+            data['%s/%d' % (name, size)] = result
+        fd = open(filename, 'w')
+        try:
+            json.dump(data, fd, indent = 1, sort_keys = True)
+        finally:
+            fd.close()
+
+def LoadBaseline(filename):
+    """!Returns baseline results, None if there is no baseline"""
+    try:
+        fd = open(filename, 'r')
+    except IOError:
+        return None
+    try:
+        return json.load(fd)
+    finally:
+        fd.close()
+
+def main():
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option('--sizes', default = ','.join(map(str, defaultSizes)),
+                      help = "comma separated numbers of blocks in instruction files [%default]")
+    parser.add_option('--cases', default = '',
+                      help = "comma separated names of cases to run (all by default)")
+    parser.add_option('--repeat', type = 'int', default = 5,
+                      help = "number of runs, the best time is used [%default]")
+    parser.add_option('--baseline', default = defaultBaseline,
+                      help = "baseline file [%default]")
+    parser.add_option('--save-baseline', action = 'store_true', dest = 'save', default = False,
+                      help = "save results as new baseline")
+    parser.add_option('--tolerance', type = 'float', default = 0.2,
+                      help = "allowed slowdown against baseline [%default]")
+    # run one case and print its result (used by Benchmark.RunProcess)
+    parser.add_option('--case-process', action = 'store_true', dest = 'caseProcess', default = False,
+                      help = SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    app = wx.PySimpleApp()
+    GrassStandIn().Install()
+
+    benchmark = Benchmark(sizes = [int(size) for size in options.sizes.split(',')],
+                          repeat = options.repeat)
+    if options.caseProcess:
+        print json.dumps(benchmark.RunCase(options.cases, benchmark.sizes[0]))
+        return 0
+    if options.cases:
+        benchmark.caseFilter = options.cases.split(',')
+    failed = benchmark.Run()
+
+    if options.save:
+        benchmark.Report()
+        if failed:
+            print "%d cases failed, baseline not saved" % failed
+            return 1
+        benchmark.SaveBaseline(options.baseline)
+        print "Baseline saved to %s" % options.baseline
+        return 0
+
+    baseline = LoadBaseline(options.baseline)
+    if baseline is None:
+        print "No baseline found (%s), run with --save-baseline to create it." % options.baseline
+    regressions = benchmark.Report(baseline = baseline, tolerance = options.tolerance)
+    if regressions:
+        print "%d cases failed, are missing or are slower than baseline by more than %.0f %%" % \
+            (len(regressions), options.tolerance * 100)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
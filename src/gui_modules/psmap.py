@@ -8,6 +8,7 @@ Classes:
  - PsMapToolbar (to be moved - toolbars.py)
  - PsMapFrame
  - PsMapBufferedWindow
+ - ThumbnailThread
 
 (C) 2011 by Anna Kratochvilova, and the GRASS Development Team
 This program is free software under the GNU General Public License
@@ -21,12 +22,13 @@ import os
 import sys
 import textwrap
 import Queue
+import threading
 try:
     import Image
     haveImage = True
 except ImportError:
     haveImage = False
-from math import sin, cos, pi
+from math import sin, cos, pi, ceil, floor
 
 import grass.script as grass
 if int(grass.version()['version'].split('.')[0]) > 6:
@@ -41,8 +43,10 @@ from   goutput    import CmdThread, EVT_CMD_DONE
 from   menudata   import MenuData, etcwxdir
 from   toolbars   import AbstractToolbar
 from   icon       import Icons, MetaIcon, iconSet
-from   gcmd       import RunCommand, GError, GMessage
+from   gcmd       import RunCommand, GError, GMessage, GWarning
 from psmap_dialogs import *
+from psmap_worker import Region, RasterInfo, workerPool
+from psmap_atlas import Atlas, AtlasThread, RenderCache, MapStage, VectorSheets, GridSheets
 
 import wx
 
@@ -266,6 +270,8 @@ class PsMapFrame(wx.Frame):
         self.instruction = Instruction(parent = self, objectsToDraw = self.objectId)
         # open dialogs
         self.openDialogs = dict()
+        # atlas being generated
+        self.atlas = None
         
         self.pageId = wx.NewId()
         #current page of flatnotebook
@@ -291,12 +297,16 @@ class PsMapFrame(wx.Frame):
         
         # set WIND_OVERRIDE
         grass.use_temp_region()
+        # paper sizes are needed by page setup dialog
+        RequestPaperSizes()
         
         # create queues
         self.requestQ = Queue.Queue()
         self.resultQ = Queue.Queue()
         # thread
         self.cmdThread = CmdThread(self, self.requestQ, self.resultQ)
+        # maps are prepared for ps.map (resampled...) in background, one request at once
+        self.renderService = MetadataService(workers = 1)
         
         self._layout()
         self.SetMinSize(wx.Size(750, 600))
@@ -340,10 +350,15 @@ class PsMapFrame(wx.Frame):
         mainSizer.Fit(self)
 
             
-    def InstructionFile(self):
-        """!Creates mapping instructions"""
-        
-        return str(self.instruction)
+    def WriteInstructionFile(self, filename, instruction = None):
+        """!Writes mapping instructions (current by default) into file"""
+        if instruction is None:
+            instruction = self.instruction
+        instrFileFd = open(filename, mode = 'w')
+        try:
+            instruction.Write(instrFileFd)
+        finally:
+            instrFileFd.close()
 
     def OnPSFile(self, event):
         """!Generate PostScript"""
@@ -367,20 +382,73 @@ class PsMapFrame(wx.Frame):
         if filename:  
             self.PSFile(filename, pdf = True)   
                
+    def OnAtlas(self, event):
+        """!Generate map series from current layout"""
+        if not self.instruction.FindInstructionByType('map'):
+            GMessage(parent = self, message = _("Please, create map frame first."))
+            return
+        if 'atlas' not in self.openDialogs:
+            dlg = AtlasDialog(self, id = None, settings = self.instruction)
+            self.openDialogs['atlas'] = dlg
+        self.openDialogs['atlas'].Show()
+        
+    def GenerateAtlas(self, atlasDict):
+        """!Create instructions for each sheet and run ps.map in background"""
+        if self.atlas:
+            GMessage(parent = self, message = _("Atlas is being generated, please wait."))
+            return
+        map = self.instruction.FindInstructionByType('map')
+        if not map['scale'] or not map['rect']:
+            GMessage(parent = self, message = _("Scale of map frame is unknown."))
+            return
+        if atlasDict['source'] == 'vector':
+            sheets = VectorSheets(atlasDict['vector'], atlasDict['column'])
+        else:
+            sheets = GridSheets(map.GetInstruction(), Region())
+        if not sheets:
+            GMessage(parent = self, message = _("No sheets found."))
+            return
+        
+        # region differs for each sheet, raster is not resampled, vectors are generalized,
+        # clipped and copied in atlas thread
+        stage = None
+        if atlasDict['stage']:
+            stage = MapStage()
+        self.atlas = Atlas(self.instruction, sheets, cache = RenderCache(), stage = stage)
+        outputs = self.atlas.Prepare(atlasDict['filename'])
+        self.SetStatusText(_("Generating atlas: 0 of %d sheets") % len(outputs), 0)
+        AtlasThread(self.atlas, outputs, callback = self.OnAtlasProgress).start()
+        
+    def OnAtlasProgress(self, done, total, failed):
+        """!Sheet of atlas is finished"""
+        if not self:
+            return
+        if done < total:
+            self.SetStatusText(_("Generating atlas: %(done)d of %(total)d sheets") % \
+                                   {'done' : done, 'total' : total}, 0)
+            return
+        self.atlas.Cleanup()
+        sheets, cached = len(self.atlas.sheets), self.atlas.cached
+        if self.atlas.stageFailed:
+            GWarning(parent = self, message = _("Maps cannot be copied to local directory, "
+                                                "original maps were used."))
+        self.atlas = None
+        self.SetStatusText('', 0)
+        if failed:
+            GError(parent = self, message = _("Failed to generate sheets:\n%s") % '\n'.join(failed))
+        else:
+            GMessage(parent = self, message = _("Atlas with %(sheets)d sheets was generated "
+                                                "(%(cached)d sheets unchanged).") % \
+                         {'sheets' : sheets, 'cached' : cached})
+        
     def OnPreview(self, event):
         """!Run ps.map and show result"""
         self.PSFile()
         
     def PSFile(self, filename = None, pdf = False):
         """!Create temporary instructions file and run ps.map with output = filename"""
-        instrFile = grass.tempfile()
-        instrFileFd = open(instrFile, mode = 'w')
-        instrFileFd.write(self.InstructionFile())
-        instrFileFd.flush()
-        instrFileFd.close()
-        
         temp = False
-        regOld = grass.region()
+        regOld = Region()
         
         if pdf:
             pdfname = filename
@@ -396,6 +464,37 @@ class PsMapFrame(wx.Frame):
                     SetResolution(dpi = 100, width = self.instruction[mapId]['rect'][2],
                                     height = self.instruction[mapId]['rect'][3])
         
+        if temp and not pdf:
+            dpi = 100
+        else:
+            dpi = None
+        # copy is used in other thread
+        instruction = self.instruction.Clone(shared = False)
+        raster = instruction.FindInstructionByType('raster')
+        if (raster and raster['isRaster'] and raster['resample']) or \
+                [vector for vector in instruction.FindInstructionByType('vProperties', list = True)
+                 if vector['generalize'] or vector['clip']]:
+            self.SetStatusText(_('Preparing maps for rendering...'), 0)
+        userData = {'filename' : filename, 'pdfname' : pdfname, 'temp' : temp, 'regionOld' : regOld}
+        self.renderService.Request(PrepareRenderInstruction, instruction, dpi = dpi).AddCallback(
+            lambda future: self.OnRenderInstruction(future, userData))
+        
+    def OnRenderInstruction(self, future, userData):
+        """!Maps are prepared for rendering, run ps.map"""
+        if not self:
+            return
+        filename, pdfname, temp = userData['filename'], userData['pdfname'], userData['temp']
+        try:
+            instruction = future.GetResult()
+        except (IOError, OSError, grass.ScriptError), e:
+            GError(parent = self, message = _("Unable to prepare maps for rendering. %s") % e)
+            self.SetStatusText('', 0)
+            if temp and not pdfname:
+                RunCommand('g.region', cols = userData['regionOld']['cols'], rows = userData['regionOld']['rows'])
+            return
+        instrFile = grass.tempfile()
+        self.WriteInstructionFile(instrFile, instruction)
+        
         cmd = ['ps.map', '--overwrite']
         if os.path.splitext(filename)[1] == '.eps':
             cmd.append('-e')
@@ -403,15 +502,15 @@ class PsMapFrame(wx.Frame):
             cmd.append('-r')
         cmd.append('input=%s' % instrFile)
         cmd.append('output=%s' % filename)
-        if pdf:
+        if pdfname:
             self.SetStatusText(_('Generating PDF...'), 0)
         elif not temp:
             self.SetStatusText(_('Generating PostScript...'), 0)
         else:
             self.SetStatusText(_('Generating preview...'), 0)
-         
-        self.cmdThread.RunCmd(cmd, userData = {'instrFile' : instrFile, 'filename' : filename,
-                                            'pdfname' : pdfname, 'temp' : temp, 'regionOld' : regOld})
+        
+        userData['instrFile'] = instrFile
+        self.cmdThread.RunCmd(cmd, userData = userData)
         
     def OnCmdDone(self, event):
         """!ps.map process finished"""
@@ -508,9 +607,7 @@ class PsMapFrame(wx.Frame):
     def OnInstructionFile(self, event):
         filename = self.getFile(wildcard = "*.psmap|*.psmap|Text file(*.txt)|*.txt|All files(*.*)|*.*")        
         if filename:    
-            instrFile = open(filename, "w")
-            instrFile.write(self.InstructionFile())
-            instrFile.close()   
+            self.WriteInstructionFile(filename)
                      
     def OnLoadFile(self, event):
         """!Load file and read instructions"""
@@ -528,7 +625,12 @@ class PsMapFrame(wx.Frame):
         #filename = '/home/anna/Desktop/reading.txt'
         readObjectId = []
         readInstruction = Instruction(parent = self, objectsToDraw = readObjectId)
-        ok = readInstruction.Read(filename)
+        ok = readInstruction.ReadSnapshot(filename)
+        if not ok:
+            ok = readInstruction.Read(filename)
+            if ok:
+                # snapshot needs resolved maps, save it after layout is displayed
+                wx.CallAfter(readInstruction.SaveSnapshot)
         if not ok:
             GMessage(_("Failed to read file %s.") % filename)
         else:
@@ -536,6 +638,7 @@ class PsMapFrame(wx.Frame):
             self.objectId = self.canvas.objectId = readObjectId
             self.pageId = self.canvas.pageId = self.instruction.FindInstructionByType('page').id
             self.canvas.UpdateMapLabel()
+            self.canvas.UpdateThumbnail()
             self.canvas.dragId = -1
             self.canvas.Clear()
             #self.canvas.ZoomAll()
@@ -820,15 +923,12 @@ class PsMapFrame(wx.Frame):
     def getInitMap(self):
         """!Create default map frame when no map is selected, needed for coordinates in map units"""
         instrFile = grass.tempfile()
-        instrFileFd = open(instrFile, mode = 'w')
-        instrFileFd.write(self.InstructionFile())
-        instrFileFd.flush()
-        instrFileFd.close()
+        self.WriteInstructionFile(instrFile)
         
         mapInitRect = GetMapBounds(instrFile)
         grass.try_remove(instrFile)
         
-        region = grass.region()
+        region = Region()
         units = UnitConversion(self)
         realWidth = units.convert(value = abs(region['w'] - region['e']), fromUnit = 'meter', toUnit = 'inch')
         scale = mapInitRect.Get()[2]/realWidth  
@@ -852,6 +952,7 @@ class PsMapFrame(wx.Frame):
                 self.deleteObject(self.canvas.dragId)
                 self.getInitMap()
                 self.canvas.RecalculateEN()
+                self.canvas.UpdateThumbnail()
             else:
                 self.deleteObject(self.canvas.dragId)
             
@@ -925,8 +1026,7 @@ class PsMapFrame(wx.Frame):
             if itype in ('map', 'vector', 'raster'):
                     
                 if itype == 'raster':#set resolution
-                    resol = RunCommand('r.info', read = True, flags = 's', map = self.instruction[id]['raster'])
-                    resol = grass.parse_key_val(resol, val_type = float)
+                    resol = RasterInfo(self.instruction[id]['raster'])
                     RunCommand('g.region', nsres = resol['nsres'], ewres = resol['ewres'])
                     # change current raster in raster legend
                     
@@ -943,6 +1043,7 @@ class PsMapFrame(wx.Frame):
                                                                     canvasToPaper = False)
                 self.canvas.RecalculateEN()
                 self.canvas.UpdateMapLabel()
+                self.canvas.UpdateThumbnail()
                 
                 self.canvas.Draw( pen = self.pen['map'], brush = self.brush['map'],
                                 pdc = self.canvas.pdcObj, drawid = id, pdctype = 'rectText', bb = rectCanvas)
@@ -1013,6 +1114,9 @@ class PsMapFrame(wx.Frame):
             os.remove(self.imgName)
         except OSError:
             pass
+        self.canvas.CleanupThumbnails()
+        RemoveStaleCopies()
+        workerPool.Terminate()
         grass.set_raise_on_error(False)
         self.Destroy()
 
@@ -1068,6 +1172,7 @@ class PsMapBufferedWindow(wx.Window):
         self.pdcImage = wx.PseudoDC()
         dc = wx.PaintDC(self)
         self.font = dc.GetFont()
+        self.unitConv = UnitConversion(self)
         
         self.SetClientSize((700,510))#?
         self._buffer = wx.EmptyBitmap(*self.GetClientSize())
@@ -1076,6 +1181,29 @@ class PsMapBufferedWindow(wx.Window):
         self.idZoomBoxTmp = wx.NewId()
         self.idResizeBoxTmp = wx.NewId()
         
+        # pre-rendered texts, key is (text, font, size bucket, rotation, colors)
+        self.textBitmaps = dict()
+        # number of size buckets per point
+        self.textBucketsPerPoint = 2
+        self.textBitmapsMax = 1000
+        # map frame thumbnail, rendered in separate thread
+        self.thumbnailThread = None
+        self.thumbnailFiles = dict()
+        self.thumbnailFilesMax = 20
+        self.thumbnailKey = None
+        self.thumbnail = None
+        self.thumbnailBitmap = None
+        # maximal thumbnail width or height in pixels
+        self.thumbnailSize = 300
+        # motion events while dragging are coalesced and handled by timer
+        self.dragTimer = wx.Timer(self)
+        self.dragInterval = 16
+        self.dragPos = None
+        # level of detail: texts smaller than this (scaled points)
+        # are drawn as boxes, labels are not drawn below minimal size
+        self.lodTextSize = 4
+        self.labelMinSize = 6
+        self.labelExtents = dict()
         
 
         self.dragId = -1
@@ -1097,6 +1225,7 @@ class PsMapBufferedWindow(wx.Window):
         self.Bind(wx.EVT_SIZE,  self.OnSize)
         self.Bind(wx.EVT_IDLE,  self.OnIdle)
         self.Bind(wx.EVT_MOUSE_EVENTS, self.OnMouse)
+        self.Bind(wx.EVT_TIMER, self.OnDragTimer, self.dragTimer)
 
 
     def Clear(self):
@@ -1120,7 +1249,7 @@ class PsMapBufferedWindow(wx.Window):
     def CanvasPaperCoordinates(self, rect, canvasToPaper = True):
         """!Converts canvas (pixel) -> paper (inch) coordinates and size and vice versa"""
         
-        units = UnitConversion(self)
+        units = self.unitConv
         
         fromU = 'pixel'
         toU = 'inch'
@@ -1174,17 +1303,26 @@ class PsMapBufferedWindow(wx.Window):
         r.SetHeight(abs(r.GetHeight()))
         return r 
           
-    def RecalculateEN(self):
-        """!Recalculate east and north for texts (eps, points) after their or map's movement"""
+    def RecalculateEN(self, ids = None):
+        """!Recalculate east and north for texts (eps, points) after their or map's movement
+        
+        @param ids list of texts to recalculate, all texts if None
+        """
         try:
             mapId = self.instruction.FindInstructionByType('map').id
         except AttributeError:
             mapId = self.instruction.FindInstructionByType('initMap').id
             
         texts = self.instruction.FindInstructionByType('text', list = True)
+        if ids is not None:
+            texts = [text for text in texts if text.id in ids]
+        if not texts:
+            return
+        region = Region()
         for text in texts:
             e, n = PaperMapCoordinates(map = self.instruction[mapId], x = self.instruction[text.id]['where'][0],
-                                                y = self.instruction[text.id]['where'][1], paperToMap = True)
+                                                y = self.instruction[text.id]['where'][1], paperToMap = True,
+                                                region = region)
             self.instruction[text.id]['east'], self.instruction[text.id]['north'] = e, n
             
     def OnPaint(self, event):
@@ -1284,57 +1422,18 @@ class PsMapBufferedWindow(wx.Window):
                 self.Draw(pen = self.pen['box'], brush = self.brush['box'], pdc = self.pdcTmp, drawid = self.idZoomBoxTmp,
                             pdctype = 'rect', bb = r)
                             
-            # panning                
-            if self.mouse["use"] == 'pan':
-                self.mouse['end'] = event.GetPosition()
-                view = self.mouse['begin'][0] - self.mouse['end'][0], self.mouse['begin'][1] - self.mouse['end'][1]
-                zoomFactor = 1
-                self.Zoom(zoomFactor, view)
-                self.mouse['begin'] = event.GetPosition()
-                
-            #move object
-            if self.mouse['use'] == 'pointer' and self.dragId != -1:
-                
-                self.mouse['end'] = event.GetPosition()
-                dx, dy = self.mouse['end'][0] - self.begin[0], self.mouse['end'][1] - self.begin[1]
-                self.pdcObj.TranslateId(self.dragId, dx, dy)
-                self.pdcTmp.TranslateId(self.idBoxTmp, dx, dy)
-                self.pdcTmp.TranslateId(self.idResizeBoxTmp, dx, dy)
-                if self.instruction[self.dragId].type == 'text': 
-                    self.instruction[self.dragId]['coords'] = self.instruction[self.dragId]['coords'][0] + dx,\
-                                                            self.instruction[self.dragId]['coords'][1] + dy
-                self.begin = event.GetPosition()
-                self.Refresh()
-                
-            # resize object
-            if self.mouse['use'] == 'resize':
-                type = self.instruction[self.dragId].type
-                pos = event.GetPosition()
-                x, y = self.mapBounds.GetX(), self.mapBounds.GetY()
-                width, height = self.mapBounds.GetWidth(), self.mapBounds.GetHeight()
-                diffX = pos[0] - self.mouse['begin'][0]
-                diffY = pos[1] - self.mouse['begin'][1]
-                # match given region
-                if self.constraint:
-                    if width > height:
-                        newWidth = width + diffX
-                        newHeight = height + diffX * (float(height) / width)
-                    else:
-                        newWidth = width + diffY * (float(width) / height)
-                        newHeight = height + diffY
-                else:
-                    newWidth = width + diffX
-                    newHeight = height + diffY
-                    
-                if newWidth < 10 or newHeight < 10:
-                    return
-                
-                bounds = wx.Rect(x, y, newWidth, newHeight)    
-                self.Draw(pen = self.pen[type], brush = self.brush[type], pdc = self.pdcObj, drawid = self.dragId,
-                            pdctype = 'rectText', bb = bounds)
-                self.RedrawSelectBox(self.dragId)
+            # panning, moving and resizing is done on timer
+            if self.mouse['use'] == 'pan' or self.mouse['use'] == 'resize' or \
+                    (self.mouse['use'] == 'pointer' and self.dragId != -1):
+                self.dragPos = event.GetPosition()
+                if not self.dragTimer.IsRunning():
+                    self.dragTimer.Start(self.dragInterval, wx.TIMER_ONE_SHOT)
                 
         elif event.LeftUp():
+            # finish pending drag
+            self.dragTimer.Stop()
+            self.OnDragTimer(None)
+            
             # zoom in, zoom out
             if self.mouse['use'] in ('zoomin','zoomout'):
                 zoomR = self.pdcTmp.GetIdBounds(self.idZoomBoxTmp)
@@ -1407,6 +1506,7 @@ class PsMapBufferedWindow(wx.Window):
                     SetResolution(dpi = self.instruction[mapId]['resolution'],
                                     width = self.instruction[mapId]['rect'].width,
                                     height = self.instruction[mapId]['rect'].height)
+                    self.UpdateThumbnail()
                         
                     self.RedrawSelectBox(mapId)
                     self.Zoom(zoomFactor = 1, view = (0, 0))
@@ -1437,6 +1537,62 @@ class PsMapBufferedWindow(wx.Window):
                     
                     
                 
+    def OnDragTimer(self, event):
+        """!Pan, move or resize object according to the last mouse position"""
+        if self.dragPos is None:
+            return
+        pos = self.dragPos
+        self.dragPos = None
+        
+        # panning
+        if self.mouse["use"] == 'pan':
+            self.mouse['end'] = pos
+            view = self.mouse['begin'][0] - self.mouse['end'][0], self.mouse['begin'][1] - self.mouse['end'][1]
+            zoomFactor = 1
+            self.Zoom(zoomFactor, view)
+            self.mouse['begin'] = pos
+            
+        #move object
+        if self.mouse['use'] == 'pointer' and self.dragId != -1:
+            
+            self.mouse['end'] = pos
+            dx, dy = self.mouse['end'][0] - self.begin[0], self.mouse['end'][1] - self.begin[1]
+            self.pdcObj.TranslateId(self.dragId, dx, dy)
+            self.pdcTmp.TranslateId(self.idBoxTmp, dx, dy)
+            self.pdcTmp.TranslateId(self.idResizeBoxTmp, dx, dy)
+            if self.instruction[self.dragId].type == 'text': 
+                self.instruction[self.dragId]['coords'] = self.instruction[self.dragId]['coords'][0] + dx,\
+                                                        self.instruction[self.dragId]['coords'][1] + dy
+            self.begin = pos
+            self.Refresh()
+            
+        # resize object
+        if self.mouse['use'] == 'resize':
+            type = self.instruction[self.dragId].type
+            x, y = self.mapBounds.GetX(), self.mapBounds.GetY()
+            width, height = self.mapBounds.GetWidth(), self.mapBounds.GetHeight()
+            diffX = pos[0] - self.mouse['begin'][0]
+            diffY = pos[1] - self.mouse['begin'][1]
+            # match given region
+            if self.constraint:
+                if width > height:
+                    newWidth = width + diffX
+                    newHeight = height + diffX * (float(height) / width)
+                else:
+                    newWidth = width + diffY * (float(width) / height)
+                    newHeight = height + diffY
+            else:
+                newWidth = width + diffX
+                newHeight = height + diffY
+                
+            if newWidth < 10 or newHeight < 10:
+                return
+            
+            bounds = wx.Rect(x, y, newWidth, newHeight)    
+            self.Draw(pen = self.pen[type], brush = self.brush[type], pdc = self.pdcObj, drawid = self.dragId,
+                        pdctype = 'rectText', bb = bounds)
+            self.RedrawSelectBox(self.dragId)
+            
     def RecalculatePosition(self, ids):
         for id in ids:
             itype = self.instruction[id].type
@@ -1479,7 +1635,7 @@ class PsMapBufferedWindow(wx.Window):
                 
                 self.instruction[id]['where'] = self.CanvasPaperCoordinates(rect = wx.Rect2D(x, y, 0, 0),
                                                             canvasToPaper = True)[:2]
-                self.RecalculateEN()
+                self.RecalculateEN(ids = [id])
         
     def ComputeZoom(self, rect):
         """!Computes zoom factor and scroll view"""
@@ -1540,25 +1696,26 @@ class PsMapBufferedWindow(wx.Window):
             
             #redraw objects
             for id in self.objectId:
-                oRect = self.CanvasPaperCoordinates(
-                                    rect = self.instruction[id]['rect'], canvasToPaper = False)
-                    
                 type = self.instruction[id].type
                 if type == 'text':
                     coords = self.instruction[id]['coords']# recalculate coordinates, they are not equal to BB
                     self.instruction[id]['coords'] = coords = [(int(coord) - view[i]) * zoomFactor
                                                                         for i, coord in enumerate(coords)]
-                    self.DrawRotText(pdc = self.pdcObj, drawId = id, textDict = self.instruction[id],
-                     coords = coords, bounds = oRect )
-                    extent = self.parent.getTextExtent(textDict = self.instruction[id])
+                    if self.IsLowDetail(textDict = self.instruction[id]):
+                        extent = self.EstimateTextExtent(textDict = self.instruction[id])
+                    else:
+                        extent = self.parent.getTextExtent(textDict = self.instruction[id])
                     if self.instruction[id]['rotate']:
                         rot = float(self.instruction[id]['rotate']) 
                     else:
                         rot = 0
 
                     self.instruction[id]['rect'] = bounds = self.parent.getModifiedTextBounds(coords[0], coords[1], extent, rot)
-                    self.pdcObj.SetIdBounds(id, bounds)
+                    self.DrawRotText(pdc = self.pdcObj, drawId = id, textDict = self.instruction[id],
+                                     coords = coords, bounds = bounds)
                 else:
+                    oRect = self.CanvasPaperCoordinates(
+                                    rect = self.instruction[id]['rect'], canvasToPaper = False)
                     self.Draw(pen = self.pen[type], brush = self.brush[type], pdc = self.pdcObj,
                             drawid = id, pdctype = 'rectText', bb = oRect)
             #redraw tmp objects
@@ -1596,29 +1753,29 @@ class PsMapBufferedWindow(wx.Window):
         pdc.SetBrush(brush)
         if pdctype in ('rect', 'rectText'):
             pdc.DrawRectangle(*bb)
+        if pdctype == 'rectText' and self.thumbnail and self.instruction[drawid].type == 'map':
+            bitmap = self.GetThumbnailBitmap(size = (bb[2], bb[3]))
+            if bitmap:
+                pdc.DrawBitmap(bitmap, bb[0], bb[1])
         if pdctype == 'rectText':
-            dc = wx.PaintDC(self) # dc created because of method GetTextExtent, which pseudoDC lacks
-            font = self.font
-            size = 10
-            font.SetPointSize(size)
-            font.SetStyle(wx.ITALIC)
-            dc.SetFont(font)
-            pdc.SetFont(font)
             text = '\n'.join(self.itemLabels[self.instruction[drawid].type])
-            textExtent = dc.GetTextExtent(text)
-            textRect = wx.Rect(0, 0, *textExtent).CenterIn(bb)
-            r = map(int, bb)
-            while not wx.Rect(*r).ContainsRect(textRect) and size >= 8:
-                size -= 2
+            r = wx.Rect(*map(int, bb))
+            # skip label which can't fit even with the smallest font
+            minExtent = self.GetLabelExtent(text = text, size = self.labelMinSize)
+            if r.GetWidth() >= minExtent[0] and r.GetHeight() >= minExtent[1]:
+                size = 10
+                textRect = wx.Rect(0, 0, *self.GetLabelExtent(text = text, size = size)).CenterIn(bb)
+                while not r.ContainsRect(textRect) and size > self.labelMinSize:
+                    size -= 2
+                    textRect = wx.Rect(0, 0, *self.GetLabelExtent(text = text, size = size)).CenterIn(bb)
+                font = self.font
                 font.SetPointSize(size)
-                dc.SetFont(font)
+                font.SetStyle(wx.ITALIC)
                 pdc.SetFont(font)
-                textExtent = dc.GetTextExtent(text)
-                textRect = wx.Rect(0, 0, *textExtent).CenterIn(bb)
-            pdc.SetTextForeground(wx.Color(100,100,100,200)) 
-            pdc.SetBackgroundMode(wx.TRANSPARENT)
+                pdc.SetTextForeground(wx.Color(100,100,100,200)) 
+                pdc.SetBackgroundMode(wx.TRANSPARENT)
 
-            pdc.DrawText(text = text, x = textRect.x, y = textRect.y)
+                pdc.DrawText(text = text, x = textRect.x, y = textRect.y)
             
         pdc.SetIdBounds(drawid, bb)
         pdc.EndDrawing()
@@ -1626,37 +1783,112 @@ class PsMapBufferedWindow(wx.Window):
 
         return drawid
     
+    def GetLabelExtent(self, text, size):
+        """!Returns extent of object label with given font size (cached)"""
+        if (text, size) not in self.labelExtents:
+            dc = wx.MemoryDC()
+            dc.SelectObject(wx.EmptyBitmap(1, 1))
+            font = self.font
+            font.SetPointSize(size)
+            font.SetStyle(wx.ITALIC)
+            dc.SetFont(font)
+            self.labelExtents[(text, size)] = dc.GetMultiLineTextExtent(text)[:2]
+            dc.SelectObject(wx.NullBitmap)
+        return self.labelExtents[(text, size)]
+    
+    def IsLowDetail(self, textDict):
+        """!Check if text is too small at current zoom to be drawn in full detail"""
+        return textDict['fontsize'] * self.currScale < self.lodTextSize
+    
+    def EstimateTextExtent(self, textDict):
+        """!Rough text extent used in low detail mode instead of measuring text"""
+        size = textDict['fontsize'] * self.currScale
+        lines = textDict['text'].split('\n')
+        return int(ceil(0.6 * size * max([len(line) for line in lines]))), int(ceil(1.2 * size * len(lines)))
+    
     def DrawRotText(self, pdc, drawId, textDict, coords, bounds):
+        """!Draw (rotated) text from cached bitmap or box in low detail mode"""
         if textDict['rotate']:
             rot = float(textDict['rotate']) 
         else:
             rot = 0
 
-        fontsize = str(textDict['fontsize'] * self.currScale)
-        if textDict['background'] != 'none':
-            background = textDict['background'] 
-        else:
-            background = None
-
-        
+        pdc.BeginDrawing()
         pdc.RemoveId(drawId)
         pdc.SetId(drawId)
-        pdc.BeginDrawing()
-        # doesn't work
-        if background:
-            pdc.SetBackground(wx.Brush(convertRGB(background)))
-            pdc.SetBackgroundMode(wx.SOLID)
-        else:
-            pdc.SetBackground(wx.TRANSPARENT_BRUSH)
-            pdc.SetBackgroundMode(wx.TRANSPARENT)
+        if self.IsLowDetail(textDict = textDict):
+            pdc.SetPen(wx.TRANSPARENT_PEN)
+            pdc.SetBrush(wx.Brush(convertRGB(textDict['color'])))
+            pdc.DrawRectangleRect(wx.Rect(*bounds))
+            pdc.SetIdBounds(drawId, wx.Rect(*bounds))
+            pdc.EndDrawing()
+            self.Refresh()
+            return
         
-        pdc.SetFont(wx.FontFromNativeInfoString(textDict['font'] + " " + fontsize))    
-        pdc.SetTextForeground(convertRGB(textDict['color']))        
-        pdc.DrawRotatedText(textDict['text'], coords[0], coords[1], rot)
+        bitmap, offset, polygon = self.GetTextBitmap(textDict = textDict, rot = rot)
+        x, y = int(round(coords[0])), int(round(coords[1]))
+        if textDict['background'] != 'none':
+            pdc.SetPen(wx.TRANSPARENT_PEN)
+            pdc.SetBrush(wx.Brush(convertRGB(textDict['background'])))
+            pdc.DrawPolygon(polygon, x, y)
+        pdc.DrawBitmap(bitmap, x + offset[0], y + offset[1], True)
 
         pdc.SetIdBounds(drawId, wx.Rect(*bounds))
-        self.Refresh()
         pdc.EndDrawing()
+        self.Refresh()
+        
+    def GetTextBitmap(self, textDict, rot):
+        """!Returns bitmap with rendered (rotated) text
+        
+        Bitmaps are cached, font size is rounded to size buckets so that
+        panning and small zoom changes reuse already rendered text.
+        
+        @param textDict text instruction
+        @param rot rotation in degrees
+        
+        @return bitmap, offset of bitmap from text origin, polygon of text background
+        """
+        bucket = max(1, int(round(textDict['fontsize'] * self.currScale * self.textBucketsPerPoint)))
+        key = (textDict['text'], textDict['font'], bucket, rot,
+               textDict['color'], textDict['background'])
+        if key in self.textBitmaps:
+            return self.textBitmaps[key]
+        
+        if len(self.textBitmaps) >= self.textBitmapsMax:
+            self.textBitmaps.clear()
+        
+        fontsize = float(bucket) / self.textBucketsPerPoint
+        dc = wx.MemoryDC()
+        dc.SelectObject(wx.EmptyBitmap(1, 1))
+        dc.SetFont(wx.FontFromNativeInfoString(textDict['font'] + " " + str(fontsize)))
+        w, h = dc.GetMultiLineTextExtent(textDict['text'])[:2]
+        
+        # corners of rotated text relative to text origin
+        a = rot / 180 * pi
+        polygon = [(0, 0), (w * cos(a), - w * sin(a)),
+                   (w * cos(a) + h * sin(a), h * cos(a) - w * sin(a)), (h * sin(a), h * cos(a))]
+        xMin = int(floor(min([p[0] for p in polygon])))
+        yMin = int(floor(min([p[1] for p in polygon])))
+        width = int(ceil(max([p[0] for p in polygon]))) - xMin + 1
+        height = int(ceil(max([p[1] for p in polygon]))) - yMin + 1
+        
+        # white text on black, intensity is then converted to alpha
+        bitmap = wx.EmptyBitmap(width, height)
+        dc.SelectObject(bitmap)
+        dc.SetBackground(wx.BLACK_BRUSH)
+        dc.Clear()
+        dc.SetBackgroundMode(wx.TRANSPARENT)
+        dc.SetTextForeground(wx.WHITE)
+        dc.DrawRotatedText(textDict['text'], -xMin, -yMin, rot)
+        dc.SelectObject(wx.NullBitmap)
+        
+        color = convertRGB(textDict['color'])
+        image = bitmap.ConvertToImage()
+        image.ConvertColourToAlpha(color.Red(), color.Green(), color.Blue())
+        
+        self.textBitmaps[key] = (image.ConvertToBitmap(), (xMin, yMin),
+                                 [wx.Point(int(round(px)), int(round(py))) for px, py in polygon])
+        return self.textBitmaps[key]
         
     def DrawImage(self, rect):
         """!Draw preview image to pseudoDC"""
@@ -1755,6 +1987,107 @@ class PsMapBufferedWindow(wx.Window):
             for map in self.instruction[vectorId]['list']:
                 self.itemLabels['map'].append('vector: ' + map[0].split('@')[0])
             
+    def GetThumbnailLayers(self):
+        """!Returns display commands for map frame thumbnail"""
+        layers = []
+        raster = self.instruction.FindInstructionByType('raster')
+        if raster and raster['isRaster'] and raster['raster']:
+            layers.append(('d.rast', (('map', raster['raster']),)))
+        vector = self.instruction.FindInstructionByType('vector')
+        if vector and vector['list']:
+            # first vector in list is on top
+            for map in reversed(vector['list']):
+                vProp = self.instruction[map[2]]
+                if not vProp:
+                    continue
+                opts = dict(map = map[0], color = vProp['color'])
+                if map[1] == 'areas':
+                    opts['type'] = 'area'
+                else:
+                    opts['type'] = ','.join(vProp['type'].split(' or '))
+                if map[1] in ('points', 'areas'):
+                    opts['fcolor'] = vProp['fcolor']
+                if map[1] == 'lines':
+                    opts['width'] = vProp['width']
+                # data selection, so that thumbnail is rerendered when it changes
+                if vProp['connection']:
+                    opts['layer'] = vProp['layer']
+                    for key in ('cats', 'where'):
+                        if vProp.GetInstruction().has_key(key):
+                            opts[key] = vProp[key]
+                            break
+                layers.append(('d.vect', tuple(sorted(opts.items()))))
+        return tuple(layers)
+    
+    def UpdateThumbnail(self):
+        """!Request new map frame thumbnail if region or layers changed"""
+        map = self.instruction.FindInstructionByType('map')
+        layers = self.GetThumbnailLayers()
+        if not map or not layers:
+            self.thumbnailKey = self.thumbnail = self.thumbnailBitmap = None
+            return
+        
+        # region is read in thumbnail thread, only its stamp is compared here
+        region = GetRegionStamp() or os.getenv('GRASS_REGION')
+        rect = map['rect']
+        ratio = float(self.thumbnailSize) / max(rect.width, rect.height)
+        size = max(1, int(rect.width * ratio)), max(1, int(rect.height * ratio))
+        
+        key = (layers, region, size)
+        if key == self.thumbnailKey:
+            return
+        self.thumbnailKey = key
+        if key in self.thumbnailFiles:
+            self.OnThumbnail(key, self.thumbnailFiles[key])
+            return
+        
+        if not self.thumbnailThread:
+            env = grass.gisenv()
+            tmpDir = os.path.join(env['GISDBASE'], env['LOCATION_NAME'], env['MAPSET'], '.tmp')
+            self.thumbnailThread = ThumbnailThread(callback = self.OnThumbnail, tmpDir = tmpDir)
+            self.thumbnailThread.start()
+        self.thumbnailThread.Render(key = key, layers = layers, size = size)
+        
+    def OnThumbnail(self, key, filename):
+        """!Thumbnail rendered, draw it if it is still the current one"""
+        if not self or not filename:
+            return
+        if key not in self.thumbnailFiles:
+            if len(self.thumbnailFiles) >= self.thumbnailFilesMax:
+                for each in self.thumbnailFiles.keys():
+                    if each != self.thumbnailKey:
+                        grass.try_remove(self.thumbnailFiles.pop(each))
+            self.thumbnailFiles[key] = filename
+        if key != self.thumbnailKey:
+            return
+        
+        self.thumbnail = wx.Image(filename, wx.BITMAP_TYPE_PNG)
+        self.thumbnailBitmap = None
+        map = self.instruction.FindInstructionByType('map')
+        if map and map.id in self.objectId:
+            rectCanvas = self.CanvasPaperCoordinates(rect = map['rect'], canvasToPaper = False)
+            self.Draw(pen = self.pen['map'], brush = self.brush['map'], pdc = self.pdcObj,
+                      drawid = map.id, pdctype = 'rectText', bb = rectCanvas)
+            self.RedrawSelectBox(map.id)
+        
+    def GetThumbnailBitmap(self, size):
+        """!Returns thumbnail scaled to map frame size"""
+        size = tuple(map(int, size))
+        if size[0] < 1 or size[1] < 1 or not self.thumbnail.IsOk():
+            return None
+        if not self.thumbnailBitmap or self.thumbnailBitmap[0] != size:
+            image = self.thumbnail.Scale(size[0], size[1], wx.IMAGE_QUALITY_NORMAL)
+            self.thumbnailBitmap = (size, image.ConvertToBitmap())
+        return self.thumbnailBitmap[1]
+        
+    def CleanupThumbnails(self):
+        """!Stop thumbnail thread and remove rendered files"""
+        if self.thumbnailThread:
+            self.thumbnailThread.Terminate()
+        for filename in self.thumbnailFiles.values():
+            grass.try_remove(filename)
+        self.thumbnailFiles = dict()
+        
     def OnSize(self, event):
         """!Init image size to match window size
         """
@@ -1783,6 +2116,89 @@ class PsMapBufferedWindow(wx.Window):
         return wx.Rect(rect.GetLeft()*scale, rect.GetTop()*scale,
                     rect.GetSize()[0]*scale, rect.GetSize()[1]*scale)   
                      
+class ThumbnailThread(threading.Thread):
+    """!Thread rendering low resolution map frame thumbnails
+
+    Only the last request waiting in queue is rendered.
+    """
+    def __init__(self, callback, tmpDir):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        
+        self.callback = callback
+        self.tmpDir = tmpDir
+        self.requestQ = Queue.Queue()
+        self.regionName = 'tmp_psmap_thumbnail_%d' % os.getpid()
+        self.count = 0
+        
+    def Render(self, key, layers, size):
+        """!Add render request, current region is used
+
+        @param key request key passed to callback
+        @param layers tuple of display commands and their options
+        @param size thumbnail size in pixels
+        """
+        self.requestQ.put((key, layers, size))
+        
+    def Terminate(self):
+        """!Stop thread after current request"""
+        self.requestQ.put(None)
+        
+    def run(self):
+        while True:
+            request = self.requestQ.get()
+            # skip outdated requests
+            while request and not self.requestQ.empty():
+                request = self.requestQ.get()
+            if request is None:
+                break
+            
+            key = request[0]
+            filename = self._render(*request[1:])
+            wx.CallAfter(self.callback, key, filename)
+        
+        grass.run_command('g.remove', quiet = True, region = self.regionName)
+        
+    def _render(self, layers, size):
+        """!Render layers to png file, returns file name or None on failure"""
+        self.count += 1
+        filename = os.path.join(self.tmpDir, 'psmap_thumbnail_%d_%d.png' % (os.getpid(), self.count))
+        try:
+            region = Region()
+            n, s, e, w, nsres, ewres = [region[key] for key in ('n', 's', 'e', 'w', 'nsres', 'ewres')]
+            ret = grass.run_command('g.region', flags = 'u', quiet = True, overwrite = True,
+                                    save = self.regionName, n = n, s = s, e = e, w = w,
+                                    nsres = nsres, ewres = ewres)
+            if ret != 0:
+                return None
+            
+            env = os.environ.copy()
+            env['WIND_OVERRIDE'] = self.regionName
+            env['GRASS_RENDER_IMMEDIATE'] = 'TRUE'
+            env['GRASS_PNGFILE'] = filename
+            env['GRASS_WIDTH'] = str(size[0])
+            env['GRASS_HEIGHT'] = str(size[1])
+            env['GRASS_TRUECOLOR'] = 'TRUE'
+            env['GRASS_TRANSPARENT'] = 'FALSE'
+            env['GRASS_BACKGROUNDCOLOR'] = 'FFFFFF'
+            env['GRASS_PNG_AUTO_WRITE'] = 'TRUE'
+            for i, (cmd, opts) in enumerate(layers):
+                env['GRASS_PNG_READ'] = ('FALSE', 'TRUE')[i > 0]
+                # read error output, full pipe would block the command
+                p = grass.start_command(cmd, quiet = True, env = env,
+                                        stderr = grass.PIPE, **dict(opts))
+                p.communicate()
+                if p.returncode != 0:
+                    grass.try_remove(filename)
+                    return None
+        except (IOError, OSError):
+            grass.try_remove(filename)
+            return None
+        
+        if not os.path.isfile(filename):
+            return None
+        return filename
+        
 def main():
     app = wx.PySimpleApp()
     wx.InitAllImageHandlers()
@@ -0,0 +1,674 @@
+"""!
+@package psmap_atlas
+
+@brief map series (atlas) generated from ps.map GUI layout
+
+Layout is used as a template, map frame is moved to each sheet of tile
+index (areas of vector map) or regular grid. Texts can contain
+placeholders ${name} or ${name:format} (see TextTemplate), available
+names are sheet, number, count, date, scale, row and col (grid) and
+attribute columns of tile index.
+
+Rendered sheets are kept in a cache (RenderCache), a sheet is rendered
+again only when its instructions, region or used maps change. Used maps
+can be copied to local temporary directory before rendering (MapStage).
+
+Classes:
+ - TextTemplate
+ - RenderCache
+ - MapStage
+ - Atlas
+ - AtlasThread
+
+(C) 2011 by Anna Kratochvilova, and the GRASS Development Team
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author Anna Kratochvilova <anna.kratochvilova fsv.cvut.cz> (bachelor's project)
+@author Martin Landa <landa.martin gmail.com> (mentor)
+"""
+
+import os
+import re
+import sys
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+from math import ceil
+from itertools import islice
+from datetime import date
+
+import grass.script as grass
+
+from gcmd import RunCommand
+from psmap_dialogs import FixedScaleExtent, FixedScaleRegion, GetVectorDBInfo, ClipVectors, PaperMapCoordinates, \
+     GeneralizeVector
+from psmap_worker import GetEnv, FindFile, SetWindOverride
+
+import wx
+
+def VectorSheets(vector, column = None):
+    """!Returns sheets given by areas of vector map
+
+    Sheet is centered to area centroid and named by attribute column
+    (or category), attributes of the area are kept for texts.
+    """
+    # attributes of all areas are read at once
+    attributes = dict()
+    layers = GetVectorDBInfo(vector).layers
+    if 1 in layers:
+        ret = RunCommand('v.db.select', read = True, quiet = True, map = vector, layer = 1)
+        lines = (ret or '').splitlines()
+        if lines:
+            columns = lines[0].split('|')
+            for line in lines[1:]:
+                row = dict(zip(columns, line.split('|')))
+                if layers[1]['key'] in row:
+                    attributes[row[layers[1]['key']]] = row
+
+    sheets = []
+    ret = RunCommand('v.to.db', read = True, flags = 'p', quiet = True, map = vector,
+                     type = 'centroid', option = 'coor')
+    for line in (ret or '').splitlines():
+        values = line.split('|')
+        try:
+            cat = str(int(values[0]))
+            center = (float(values[1]), float(values[2]))
+        except (ValueError, IndexError): # header
+            continue
+        row = attributes.get(cat, dict())
+        if column and row.get(column):
+            name = row[column]
+        else:
+            name = cat
+        sheets.append(dict(number = len(sheets) + 1, name = name, center = center, attributes = row))
+    return sheets
+
+def GridSheets(mapDict, region):
+    """!Returns sheets of regular grid covering region
+
+    Size of sheet is given by map frame size and scale.
+    """
+    width, height = FixedScaleExtent(mapDict)
+    cols = max(1, int(ceil((region['e'] - region['w']) / width)))
+    rows = max(1, int(ceil((region['n'] - region['s']) / height)))
+    sheets = []
+    for row in range(rows):
+        for col in range(cols):
+            sheets.append(dict(number = len(sheets) + 1, name = '%d-%d' % (row + 1, col + 1),
+                               center = (region['w'] + (col + 0.5) * width, region['n'] - (row + 0.5) * height),
+                               attributes = dict(row = row + 1, col = col + 1)))
+    return sheets
+
+def CpuCount():
+    """!Returns number of processors (for number of ps.map processes)"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 2
+
+class TextTemplate:
+    """!Text with placeholders ${name} or ${name:format}
+
+    Text is parsed only once and then expanded for each sheet. Format is
+    used with % operator (${number:03d}) or strftime for dates
+    (${date:%d.%m.%Y}). Unknown placeholders are kept.
+    """
+    pattern = re.compile(r'\$\{(\w+)(?::([^}]*))?\}')
+    
+    def __init__(self, text):
+        # literal strings and placeholders (name, format, original text)
+        self.parts = []
+        pos = 0
+        for match in self.pattern.finditer(text):
+            if match.start() > pos:
+                self.parts.append(text[pos:match.start()])
+            self.parts.append((match.group(1), match.group(2), match.group(0)))
+            pos = match.end()
+        if pos < len(text) or not self.parts:
+            self.parts.append(text[pos:])
+        self.names = [part[0] for part in self.parts if isinstance(part, tuple)]
+        
+    def Substitute(self, values):
+        """!Returns text with placeholders replaced by values"""
+        if not self.names:
+            return self.parts[0]
+        result = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                result.append(self._format(part, values))
+            else:
+                result.append(part)
+        return ''.join(result)
+        
+    def _format(self, part, values):
+        name, format, placeholder = part
+        if name not in values:
+            return placeholder
+        value = values[name]
+        if format:
+            try:
+                if hasattr(value, 'strftime'):
+                    return value.strftime(format)
+                return ('%' + format) % value
+            except (TypeError, ValueError):
+                pass
+        return '%s' % value
+
+class RenderCache:
+    """!Cache of ps.map output files
+
+    Output is identified by hash of instructions, region and modification
+    times of used maps. When total size exceeds maxSize, least recently
+    used files are removed.
+    """
+    maxSize = 512 * 1024 * 1024
+    
+    def __init__(self, path = None):
+        if not path:
+            env = GetEnv()
+            path = os.path.join(env['GISDBASE'], env['LOCATION_NAME'], env['MAPSET'],
+                                '.tmp', 'psmap_render_cache')
+        self.path = path
+        
+    def GetMapStamps(self, instruction):
+        """!Returns modification times of files of data used in instructions"""
+        stamps = []
+        for dependency in instruction.GetDependencies():
+            stamps.append((dependency['type'], dependency['name'], sorted(dependency['files'])))
+        return stamps
+        
+    def GetKey(self, textHash, regionName, mapStamps):
+        """!Returns key of output
+
+        @param textHash md5 of instructions (without timestamp)
+        @param regionName name of saved region used for rendering
+        @param mapStamps modification times of maps (see GetMapStamps)
+        """
+        key = hashlib.md5(textHash)
+        info = FindFile(regionName, element = 'windows')
+        if info['file']:
+            fd = open(info['file'], 'r')
+            try:
+                key.update(fd.read())
+            finally:
+                fd.close()
+        key.update(repr(mapStamps))
+        return key.hexdigest()
+        
+    def Get(self, key, output):
+        """!Copy cached file to output, returns False if it's not cached"""
+        path = os.path.join(self.path, key)
+        try:
+            shutil.copyfile(path, output)
+            # mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            return False
+        return True
+        
+    def Store(self, key, output):
+        """!Add output file to cache"""
+        path = os.path.join(self.path, key)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            shutil.copyfile(output, path + '.tmp')
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            return
+        self.Evict()
+        
+    def Evict(self):
+        """!Remove least recently used files while cache is too big"""
+        files = []
+        total = 0
+        for file in os.listdir(self.path):
+            try:
+                stat = os.stat(os.path.join(self.path, file))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+            total += stat.st_size
+        files.sort()
+        while files and total > self.maxSize:
+            mtime, size, file = files.pop(0)
+            try:
+                os.remove(os.path.join(self.path, file))
+            except OSError:
+                continue
+            total -= size
+
+class MapStage:
+    """!Copies maps to local temporary directory and rewrites instructions to use the copies
+
+    Directory is kept, so copies are shared by all sheets and by other
+    atlases generated on the same computer. Files are copied again only
+    when they change. Directory is linked into location as mapset
+    'psmap_stage_<host>_<pid>' while atlas is generated (see Unlink).
+    """
+    def __init__(self):
+        env = GetEnv()
+        self.gisdbase = env['GISDBASE']
+        self.location = env['LOCATION_NAME']
+        self.currentMapset = env['MAPSET']
+        locationPath = os.path.join(self.gisdbase, self.location)
+        host = re.sub(r'\W', '_', socket.gethostname())
+        self.path = os.path.join(tempfile.gettempdir(), 'psmap_stage_%s_%s' % (host,
+                                                                             hashlib.md5(locationPath).hexdigest()))
+        self.mapset = 'psmap_stage_%s_%d' % (host, os.getpid())
+        self.link = os.path.join(locationPath, self.mapset)
+        # original name -> name of copy
+        self.names = dict()
+        
+    def _link(self):
+        """!Create directory and link it into location as mapset"""
+        if not hasattr(os, 'symlink'):
+            return False
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            if os.path.islink(self.link) and os.readlink(self.link) != self.path:
+                os.remove(self.link)
+            if not os.path.lexists(self.link):
+                os.symlink(self.path, self.link)
+        except OSError:
+            return False
+        return os.path.realpath(self.link) == os.path.realpath(self.path)
+        
+    def Unlink(self):
+        """!Remove link from location, copies are kept for next atlas"""
+        try:
+            if os.path.islink(self.link):
+                os.remove(self.link)
+        except OSError:
+            pass
+        
+    def _read(self, path):
+        """!Returns content of file"""
+        fd = open(path, 'r')
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+        
+    def _copy(self, source, target, replace = None):
+        """!Copy file or directory (recursively) if target is missing or differs
+
+        @param replace dict of strings replaced in copied file
+        """
+        if os.path.isdir(source):
+            for each in os.listdir(source):
+                self._copy(os.path.join(source, each), os.path.join(target, each), replace)
+            return
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        if replace:
+            text = self._read(source)
+            for old, new in replace.iteritems():
+                text = text.replace(old, new)
+            if os.path.exists(target) and self._read(target) == text:
+                return
+        else:
+            stat = os.stat(source)
+            if os.path.exists(target):
+                targetStat = os.stat(target)
+                if (targetStat.st_size, targetStat.st_mtime) == (stat.st_size, stat.st_mtime):
+                    return
+        # copy is renamed at the end, other processes never see incomplete file
+        tmpFile = '%s.tmp%d' % (target, os.getpid())
+        if replace:
+            fd = open(tmpFile, 'w')
+            try:
+                fd.write(text)
+            finally:
+                fd.close()
+        else:
+            shutil.copy2(source, tmpFile)
+        if os.path.exists(target) and sys.platform == 'win32':
+            os.remove(target)
+        os.rename(tmpFile, target)
+        
+    def Stage(self, dependencies):
+        """!Copy maps to local directory
+
+        @param dependencies list of dependencies (from Instruction.GetDependencies())
+
+        @return False if maps can't be copied
+        """
+        if not self._link():
+            return False
+        self.names = dict()
+        # path of map -> name of copy
+        copied = dict()
+        used = set()
+        try:
+            for dependency in dependencies:
+                if dependency['type'] not in ('raster', 'vector') or not dependency['path']:
+                    continue
+                name = dependency['name']
+                if dependency['path'] in copied:
+                    self.names[name] = copied[dependency['path']]
+                    continue
+                # path is <mapset>/cellhd/<name> or <mapset>/vector/<name>
+                mapsetPath = os.path.dirname(os.path.dirname(dependency['path']))
+                mapset = os.path.basename(mapsetPath)
+                basename = os.path.basename(dependency['path'])
+                newName = basename
+                if (dependency['type'], newName) in used:
+                    newName = '%s_%s' % (basename, mapset)
+                used.add((dependency['type'], newName))
+                
+                if dependency['type'] == 'raster':
+                    for element in ('cellhd', 'cell', 'fcell', 'colr', 'cats', 'hist'):
+                        source = os.path.join(mapsetPath, element, basename)
+                        if element == 'colr':
+                            # secondary color table in current mapset overrides the map's one
+                            colr2 = os.path.join(self.gisdbase, self.location, self.currentMapset,
+                                                 'colr2', mapset, basename)
+                            if os.path.exists(colr2):
+                                source = colr2
+                        if os.path.exists(source):
+                            self._copy(source, os.path.join(self.path, element, newName))
+                    source = os.path.join(mapsetPath, 'cell_misc', basename)
+                    if os.path.isdir(source):
+                        self._copy(source, os.path.join(self.path, 'cell_misc', newName))
+                else:
+                    target = os.path.join(self.path, 'vector', newName)
+                    for each in os.listdir(dependency['path']):
+                        # attribute tables stay in original database
+                        if each == 'dbln':
+                            replace = {'$GISDBASE' : self.gisdbase, '$LOCATION_NAME' : self.location,
+                                       '$MAPSET' : mapset}
+                        else:
+                            replace = None
+                        self._copy(os.path.join(dependency['path'], each), os.path.join(target, each),
+                                   replace)
+                self.names[name] = copied[dependency['path']] = '%s@%s' % (newName, self.mapset)
+        except (IOError, OSError):
+            self.names = dict()
+            return False
+        return True
+        
+    def Rewrite(self, instruction):
+        """!Replace names of copied maps in instructions"""
+        for each in instruction.instruction:
+            if each.type in ('raster', 'rasterLegend') and each['raster'] in self.names:
+                each['raster'] = self.names[each['raster']]
+            elif each.type == 'vProperties' and each['name'] in self.names:
+                each['name'] = self.names[each['name']]
+            elif each.type == 'vector' and each['list']:
+                each['list'] = [[self.names.get(vector[0], vector[0])] + vector[1:]
+                                for vector in each['list']]
+
+class Atlas:
+    """!Creates instructions and regions of sheets from template instructions
+
+    Sheets are prepared in AtlasThread, template is copied first so that
+    layout can be edited in the meantime.
+    """
+    def __init__(self, instruction, sheets, cache = None, stage = None):
+        self.instruction = instruction.Clone(shared = False)
+        self.sheets = sheets
+        self.cache = cache
+        self.stage = stage
+        # maps could not be copied by stage, original maps are used
+        self.stageFailed = False
+        # modification times of used maps (for cache), read in thread
+        self.mapStamps = None
+        # id of vector properties -> name of generalized vector, set in thread
+        self.generalized = dict()
+        # saved regions and instruction files to be removed
+        self.regions = []
+        self.files = []
+        # number of sheets taken from cache
+        self.cached = 0
+        # texts are parsed only once for all sheets
+        self.templates = dict()
+        for each in self.instruction.FindInstructionByType('text', list = True):
+            self.templates[each.id] = TextTemplate(each['text'])
+        
+    def GetValues(self, sheet):
+        """!Returns values of placeholders for the sheet"""
+        values = dict(sheet.get('attributes', dict()))
+        values.update(sheet = sheet['name'], number = sheet['number'], count = len(self.sheets),
+                      date = date.today())
+        map = self.instruction.FindInstructionByType('map')
+        if map and map['scale']:
+            values['scale'] = '1:%.0f' % (1 / map['scale'])
+        return values
+
+    def GetSheetInstruction(self, sheet):
+        """!Returns copy of template instructions with map frame moved to the sheet
+
+        Texts placed on paper keep their position, their map coordinates
+        are computed from region of the sheet.
+        """
+        instruction = self.instruction.Clone()
+        values = self.GetValues(sheet)
+        map = instruction.FindInstructionByType('map')
+        map['scaleType'] = 3
+        map['center'] = sheet['center']
+        region = FixedScaleRegion(map.GetInstruction())
+        for each in instruction.FindInstructionByType('text', list = True):
+            if each.id in self.templates and self.templates[each.id].names:
+                each['text'] = self.templates[each.id].Substitute(values)
+            if each['XY']:
+                each['east'], each['north'] = PaperMapCoordinates(map, each['where'][0], each['where'][1],
+                                                                  paperToMap = True, region = region)
+        return instruction
+
+    def Prepare(self, filename):
+        """!Returns list of (sheet, output file)
+
+        @param filename output file, sheet name is added to each file name
+        """
+        base, ext = os.path.splitext(filename)
+        if not ext:
+            ext = '.ps'
+        outputs = []
+        for sheet in self.sheets:
+            name = re.sub(r'[^\w.-]', '_', str(sheet['name']))
+            outputs.append((sheet, '%s_%s%s' % (base, name, ext)))
+        return outputs
+        
+    def GetFlags(self, output):
+        """!Returns flags of ps.map for the output file (EPS, landscape)"""
+        flags = ''
+        if os.path.splitext(output)[1] == '.eps':
+            flags += 'e'
+        page = self.instruction.FindInstructionByType('page')
+        if page and page['Orientation'] == 'Landscape':
+            flags += 'r'
+        return flags
+        
+    def Generalize(self):
+        """!Generalize vectors for scale and resolution of map frame (called from AtlasThread)"""
+        map = self.instruction.FindInstructionByType('map')
+        if not map or not map['scale']:
+            return
+        for vector in self.instruction.FindInstructionByType('vProperties', list = True):
+            if vector['generalize']:
+                self.generalized[vector.id] = GeneralizeVector(vector['name'], vector.subType,
+                                                               layer = vector['layer'], scale = map['scale'],
+                                                               dpi = map['resolution'])
+        
+    def _useGeneralized(self, instruction):
+        """!Replace names of generalized vectors in instructions"""
+        for id, name in self.generalized.iteritems():
+            instruction[id]['name'] = name
+        
+    def GetProcessing(self, instruction):
+        """!Returns parameters of generalization and clipping (for cache key)"""
+        map = instruction.FindInstructionByType('map')
+        processing = [map['resolution']]
+        for vector in instruction.FindInstructionByType('vProperties', list = True):
+            processing.append((vector['name'], vector['generalize'], vector['clip']))
+        return processing
+        
+    def Stage(self):
+        """!Copy used maps to local directory (called from AtlasThread)
+
+        Generalized vectors are copied instead of original ones.
+        Original maps are used if they can't be copied.
+        """
+        if not self.stage:
+            return
+        instruction = self.instruction.Clone()
+        self._useGeneralized(instruction)
+        try:
+            staged = self.stage.Stage(instruction.GetDependencies())
+        except (IOError, OSError, grass.ScriptError):
+            staged = False
+        if not staged:
+            self.stage.Unlink()
+            self.stage = None
+            self.stageFailed = True
+        
+    def PrepareSheet(self, sheet, output):
+        """!Save region and instruction file of the sheet (called from AtlasThread)
+
+        Sheet found in cache is copied to output file directly,
+        instruction file refers to generalized vectors, to copies of maps
+        if stage is given and to vectors clipped to sheet (if required).
+        Cache key is given by template with original map names, their
+        modification times and parameters of generalization and clipping.
+
+        @return (instruction file, region name, cache key), None if output
+        was taken from cache, False if region can't be saved
+        """
+        instruction = self.GetSheetInstruction(sheet)
+        regionName = 'tmp_psmap_atlas_%d_%d' % (os.getpid(), sheet['number'])
+        kwargs = FixedScaleRegion(instruction.FindInstructionByType('map').GetInstruction())
+        raster = instruction.FindInstructionByType('raster')
+        if raster and raster['isRaster']:
+            kwargs['rast'] = raster['raster']
+        ret = grass.run_command('g.region', flags = 'u', quiet = True, overwrite = True,
+                                save = regionName, **kwargs)
+        if ret != 0:
+            return False
+        self.regions.append(regionName)
+        # region comment in instruction file is given by sheet region
+        SetWindOverride(regionName)
+        try:
+            key = None
+            if self.cache:
+                if self.mapStamps is None:
+                    self.mapStamps = self.cache.GetMapStamps(self.instruction)
+                # key doesn't depend on names of copied maps, timestamp is skipped
+                textHash = hashlib.md5()
+                for piece in islice(instruction.IterText(), 1, None):
+                    textHash.update(piece)
+                textHash.update(repr(self.GetProcessing(instruction)))
+                key = self.cache.GetKey(textHash.hexdigest(), regionName, self.mapStamps) + \
+                    os.path.splitext(output)[1]
+                if self.cache.Get(key, output):
+                    self.cached += 1
+                    return None
+            
+            self._useGeneralized(instruction)
+            if self.stage:
+                self.stage.Rewrite(instruction)
+            # vectors (local copies if staged) are clipped to sheet region, copies for all sheets are kept
+            ClipVectors(instruction, copies = max(100, len(self.sheets)))
+            instrFile = grass.tempfile()
+            fd = open(instrFile, 'w')
+            try:
+                instruction.Write(fd)
+            finally:
+                fd.close()
+            self.files.append(instrFile)
+        finally:
+            SetWindOverride(None)
+        return instrFile, regionName, key
+
+    def Cleanup(self):
+        """!Remove saved regions and instruction files"""
+        if self.regions:
+            RunCommand('g.remove', quiet = True, region = ','.join(self.regions))
+        for each in self.files:
+            grass.try_remove(each)
+        self.regions = []
+        self.files = []
+
+class AtlasThread(threading.Thread):
+    """!Prepares atlas sheets and runs ps.map for them, several processes at once
+
+    Vectors are generalized and maps are staged first (if required), next sheet is prepared while
+    ps.map runs for previous ones, link to staged maps is removed at the end.
+    Callback is called (in main thread) with number of finished sheets,
+    number of all sheets and list of output files which failed, the last
+    call (all sheets finished) is made even if thread fails. Sheet which
+    can't be prepared or rendered is failed, other sheets continue.
+    Rendered sheets are stored in cache (if atlas has one).
+    """
+    def __init__(self, atlas, outputs, callback, processes = None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.atlas = atlas
+        self.outputs = outputs
+        self.callback = callback
+        self.processes = processes or CpuCount()
+
+    def run(self):
+        # finished output files and failed ones
+        self.finished = []
+        self.failed = []
+        # ps.map processes running: (process, output, cache key)
+        self.running = []
+        try:
+            self.atlas.Generalize()
+            self.atlas.Stage()
+            self._run()
+        finally:
+            for process, output, key in self.running:
+                process.wait()
+            if self.atlas.stage:
+                self.atlas.stage.Unlink()
+            for sheet, output in self.outputs:
+                if output not in self.finished:
+                    self.failed.append(output)
+            wx.CallAfter(self.callback, len(self.outputs), len(self.outputs), self.failed)
+        
+    def _finish(self, output, failed = False):
+        """!Mark sheet as finished and report progress"""
+        self.finished.append(output)
+        if failed:
+            self.failed.append(output)
+        if len(self.finished) < len(self.outputs):
+            wx.CallAfter(self.callback, len(self.finished), len(self.outputs), list(self.failed))
+        
+    def _run(self):
+        waiting = list(self.outputs)
+        while waiting or self.running:
+            while waiting and len(self.running) < self.processes:
+                sheet, output = waiting.pop(0)
+                try:
+                    job = self.atlas.PrepareSheet(sheet, output)
+                except (IOError, OSError, grass.ScriptError):
+                    job = False
+                if not job:
+                    self._finish(output, failed = job is False)
+                    continue
+                instrFile, regionName, key = job
+                env = os.environ.copy()
+                env['WIND_OVERRIDE'] = regionName
+                try:
+                    process = grass.start_command('ps.map', flags = self.atlas.GetFlags(output),
+                                                  overwrite = True, quiet = True, input = instrFile,
+                                                  output = output, env = env)
+                except OSError:
+                    self._finish(output, failed = True)
+                    continue
+                self.running.append((process, output, key))
+            if self.running:
+                process, output, key = self.running.pop(0)
+                if process.wait() != 0:
+                    self._finish(output, failed = True)
+                    continue
+                if self.atlas.cache and key:
+                    self.atlas.cache.Store(key, output)
+                self._finish(output)
@@ -5,6 +5,9 @@
 
 Classes:
  - UnitConversion
+ - SymbolCatalog
+ - MetadataFuture
+ - MetadataService
  - TCValidator
  - PenStyleComboBox
  - CheckListCtrl
@@ -34,6 +37,7 @@ Classes:
  - MapinfoDialog
  - ScalebarDialog
  - TextDialog
+ - AtlasDialog
 
 (C) 2011 by Anna Kratochvilova, and the GRASS Development Team
 This program is free software under the GNU General Public License
@@ -45,11 +49,18 @@ This program is free software under the GNU General Public License
 
 
 import os
+import re
 import sys
 import string
-from math import ceil, floor
-from copy import deepcopy
-from time import strftime, localtime
+import shutil
+import socket
+import cPickle
+import hashlib
+import threading
+import Queue
+from math import ceil, floor, sin, cos, pi
+from copy import copy, deepcopy
+from time import strftime, localtime, time
 
 import grass.script as grass
 if int(grass.version()['version'].split('.')[0]) > 6:
@@ -63,8 +74,11 @@ import dbm_base
 from   utils      import CmdToTuple, GetCmdString
 from   gselect    import Select
 from   gcmd       import RunCommand, GError, GMessage, GWarning
+from   psmap_worker import Region, FindFile, GetWindOverride, RasterInfo, VectorTopoInfo, \
+                           ProjInfo, MapBounds, PaperSizes
 
 import wx
+import wx.combo
 import wx.lib.scrolledpanel as scrolled
 import  wx.lib.filebrowsebutton as filebrowse
 from wx.lib.mixins.listctrl import CheckListCtrlMixin, ListCtrlAutoWidthMixin
@@ -78,6 +92,36 @@ grass.set_raise_on_error(True)
 
 PSMAP_COLORS = ['aqua', 'black', 'blue', 'brown', 'cyan', 'gray', 'grey', 'green', 'indigo',
                 'magenta','orange', 'purple', 'red', 'violet', 'white', 'yellow']
+# ps.map named colors as 0-255 RGB tuples
+PSMAP_COLORS_RGB = dict([(name, tuple([int(c * 255) for c in color])) for name, color in (
+                        ("white", (1.00, 1.00, 1.00)), ("black", (0.00, 0.00, 0.00)),
+                        ("red", (1.00, 0.00, 0.00)), ("green", (0.00, 1.00, 0.00)),
+                        ("blue", (0.00, 0.00, 1.00)), ("yellow", (1.00, 1.00, 0.00)),
+                        ("magenta", (1.00, 0.00, 1.00)), ("cyan", (0.00, 1.00, 1.00)),
+                        ("aqua", (0.00, 0.75, 0.75)), ("grey", (0.75, 0.75, 0.75)),
+                        ("gray", (0.75, 0.75, 0.75)), ("orange", (1.00, 0.50, 0.00)),
+                        ("brown", (0.75, 0.50, 0.25)), ("purple", (0.50, 0.00, 1.00)),
+                        ("violet", (0.50, 0.00, 1.00)), ("indigo", (0.00, 0.50, 1.00)))])
+# packed RGB -> color name, 'gray' and 'purple' preferred to their synonyms
+PSMAP_COLORS_PACKED = dict([((r << 16) | (g << 8) | b, name) for name, (r, g, b) in PSMAP_COLORS_RGB.items()
+                            if name not in ('grey', 'violet')])
+# (r, g, b) tuples parsed by convertRGB, new wx.Colour is returned for each call
+colourPool = dict()
+# GRASS variables (GISDBASE, LOCATION_NAME, ...) and stamp of GISRC file they were read from
+gisenvCache = dict()
+# full names of vector maps, key is (name, search path stamp)
+vectorNameCache = dict()
+# vector attribute metadata (dbm_base.VectorDBInfo), key is map name
+vectorDBInfoCache = dict()
+# vector topology summaries, key is map name
+vectorTopoCache = dict()
+# guards vector caches, they are filled also by metadata service threads
+vectorCacheLock = threading.Lock()
+# projection information (g.proj)
+projInfoCache = dict()
+# mapset for temporary maps (name, path, gisrc, location)
+tmpMapsetCache = dict()
+
 class UnitConversion:
     """! Class for converting units"""
     def __init__(self, parent = None):
@@ -115,6 +159,284 @@ class UnitConversion:
     def convert(self, value, fromUnit = None, toUnit = None):
         return float(value)/self._units[fromUnit]*self._units[toUnit]
     
+class SymbolCatalog:
+    """!Catalog of ps.map symbols and area patterns
+
+    Directories are scanned only once, the index with parsed symbol shapes
+    is stored in mapset's .tmp directory and reused while modification
+    times of symbol and pattern directories don't change.
+    """
+    cacheVersion = 1
+    
+    def __init__(self):
+        gisbase = os.getenv("GISBASE")
+        self.symbolPath = os.path.join(gisbase, 'etc', 'symbol')
+        self.patternPath = os.path.join(gisbase, 'etc', 'paint', 'patterns')
+        
+        self.symbols = None
+        self.patterns = None
+        # symbol name -> (box, list of (filled, points))
+        self.shapes = dict()
+        # (symbol name, size) -> wx.Bitmap
+        self.previews = dict()
+        
+    def GetSymbols(self):
+        """!Returns list of symbols ('dir/name')"""
+        self._load()
+        return self.symbols
+    
+    def GetPatterns(self):
+        """!Returns list of pattern files"""
+        self._load()
+        return self.patterns
+    
+    def GetPreview(self, symbol, size = 24):
+        """!Returns bitmap with symbol preview"""
+        if (symbol, size) in self.previews:
+            return self.previews[(symbol, size)]
+        self._load()
+        
+        bitmap = wx.EmptyBitmap(size, size)
+        dc = wx.MemoryDC(bitmap)
+        dc.SetBackground(wx.WHITE_BRUSH)
+        dc.Clear()
+        if symbol in self.shapes:
+            box, parts = self.shapes[symbol]
+            w, h = box[2] - box[0], box[3] - box[1]
+            if w > 0 and h > 0:
+                scale = (size - 4) / max(w, h)
+                x0 = (size - w * scale) / 2
+                y0 = (size + h * scale) / 2
+                dc.SetPen(wx.BLACK_PEN)
+                dc.SetBrush(wx.BLACK_BRUSH)
+                for filled, points in parts:
+                    points = [wx.Point(int(x0 + (x - box[0]) * scale), int(y0 - (y - box[1]) * scale))
+                              for x, y in points]
+                    if filled and len(points) > 2:
+                        dc.DrawPolygon(points)
+                    elif len(points) > 1:
+                        dc.DrawLines(points)
+        dc.SelectObject(wx.NullBitmap)
+        
+        self.previews[(symbol, size)] = bitmap
+        return bitmap
+    
+    def _getMtimes(self):
+        """!Returns modification times of symbol and pattern directories"""
+        dirs = [self.symbolPath, self.patternPath]
+        if os.path.isdir(self.symbolPath):
+            dirs += [os.path.join(self.symbolPath, dir) for dir in os.listdir(self.symbolPath)
+                     if os.path.isdir(os.path.join(self.symbolPath, dir))]
+        mtimes = dict()
+        for dir in dirs:
+            try:
+                mtimes[dir] = os.path.getmtime(dir)
+            except OSError:
+                mtimes[dir] = None
+        return mtimes
+    
+    def _getCacheFile(self):
+        gisenv = GetGisEnv()
+        return os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'],
+                            gisenv['MAPSET'], '.tmp', 'psmap_symbols.cache')
+        
+    def _load(self):
+        """!Load index from cache file or scan directories"""
+        if self.symbols is not None:
+            return
+        mtimes = self._getMtimes()
+        cacheFile = self._getCacheFile()
+        try:
+            fd = open(cacheFile, 'rb')
+            try:
+                data = cPickle.load(fd)
+            finally:
+                fd.close()
+            if data['version'] == self.cacheVersion and data['mtimes'] == mtimes:
+                self.symbols, self.patterns, self.shapes = data['symbols'], data['patterns'], data['shapes']
+                return
+        except (IOError, EOFError, KeyError, TypeError, ValueError, cPickle.UnpicklingError):
+            pass
+        
+        self.symbols = []
+        self.shapes = dict()
+        for dir in sorted([dir for dir, mtime in mtimes.items() if mtime is not None]):
+            if os.path.dirname(dir) != self.symbolPath:
+                continue
+            for symbol in sorted(os.listdir(dir)):
+                name = os.path.join(os.path.basename(dir), symbol)
+                self.symbols.append(name)
+                self.shapes[name] = self._parseSymbol(os.path.join(dir, symbol))
+        self.patterns = []
+        if mtimes[self.patternPath] is not None:
+            self.patterns = [os.path.join(self.patternPath, pattern)
+                             for pattern in sorted(os.listdir(self.patternPath))]
+        
+        try:
+            fd = open(cacheFile, 'wb')
+            try:
+                cPickle.dump(dict(version = self.cacheVersion, mtimes = mtimes, symbols = self.symbols,
+                                  patterns = self.patterns, shapes = self.shapes), fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+        except IOError:
+            pass
+        
+    def _parseSymbol(self, filename):
+        """!Read symbol file, returns bounding box and list of parts (filled, points)"""
+        box = (-1., -1., 1., 1.)
+        parts = []
+        stack = []
+        points = None
+        inLine = False
+        try:
+            fd = open(filename)
+            lines = fd.readlines()
+            fd.close()
+        except IOError:
+            return box, parts
+        
+        for line in lines:
+            tok = line.split()
+            if not tok:
+                continue
+            key = tok[0].upper()
+            try:
+                if inLine:
+                    if key == 'END':
+                        inLine = False
+                    else:
+                        points.append((float(tok[0]), float(tok[1])))
+                elif key == 'BOX':
+                    box = tuple(map(float, tok[1:5]))
+                elif key in ('STRING', 'POLYGON', 'RING'):
+                    stack.append(key)
+                    if key != 'POLYGON':
+                        points = []
+                elif key == 'LINE' and points is not None:
+                    inLine = True
+                elif key == 'ARC' and points is not None:
+                    x, y, r, a1, a2 = map(float, tok[1:6])
+                    if len(tok) > 6 and tok[6].upper() == 'C':
+                        if a2 > a1:
+                            a2 -= 360
+                    elif a2 < a1:
+                        a2 += 360
+                    n = max(4, int(abs(a2 - a1) / 10))
+                    for i in range(n + 1):
+                        a = (a1 + (a2 - a1) * i / n) / 180 * pi
+                        points.append((x + r * cos(a), y + r * sin(a)))
+                elif key == 'END' and stack:
+                    element = stack.pop()
+                    if element in ('STRING', 'RING'):
+                        if points:
+                            parts.append((element == 'RING', points))
+                        points = None
+            except (ValueError, IndexError):
+                continue
+        
+        return box, parts
+        
+# symbols and patterns available for vector points and areas
+symbolCatalog = SymbolCatalog()
+
+class MetadataFuture:
+    """!Result of metadata request, which may not be available yet"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        
+    def IsDone(self):
+        """!Check if result is available"""
+        return self.done.isSet()
+    
+    def GetResult(self):
+        """!Returns result, waits for it if necessary
+
+        Exception raised by request is raised again.
+        """
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+    
+    def AddCallback(self, callback):
+        """!Call callback(future) in GUI thread when result is available"""
+        self.lock.acquire()
+        try:
+            if not self.IsDone():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        wx.CallAfter(callback, self)
+        
+    def SetResult(self, result = None, error = None):
+        """!Set result of request (called from worker thread)"""
+        self.lock.acquire()
+        try:
+            self.result, self.error = result, error
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            wx.CallAfter(callback, self)
+        
+class MetadataService:
+    """!Pool of threads getting information about maps, paper sizes, etc.
+
+    Dialogs request data and fill them in when they are available
+    instead of waiting for GRASS modules.
+    """
+    def __init__(self, workers = 2):
+        self.workers = workers
+        self.threads = []
+        self.requestQ = Queue.Queue()
+        # futures of requests which don't need to be repeated
+        self.cache = dict()
+        
+    def Request(self, function, *args, **kwargs):
+        """!Run function in worker thread, returns MetadataFuture"""
+        future = MetadataFuture()
+        self._start()
+        self.requestQ.put((future, None, function, args, kwargs))
+        return future
+    
+    def RequestCached(self, key, function, *args, **kwargs):
+        """!Same as Request but successful result is kept and returned for the same key"""
+        if key in self.cache:
+            return self.cache[key]
+        future = self.cache[key] = MetadataFuture()
+        self._start()
+        self.requestQ.put((future, key, function, args, kwargs))
+        return future
+    
+    def _start(self):
+        """!Start worker threads when needed"""
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target = self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+            
+    def _run(self):
+        while True:
+            future, key, function, args, kwargs = self.requestQ.get()
+            try:
+                result = function(*args, **kwargs)
+            except Exception, e:
+                if key is not None:
+                    self.cache.pop(key, None)
+                future.SetResult(error = e)
+            else:
+                future.SetResult(result = result)
+                
+# shared metadata service used by dialogs
+metadataService = MetadataService()
     
 class TCValidator(wx.PyValidator):
     """!validates input in textctrls, combobox, taken from wxpython demo"""
@@ -227,28 +549,80 @@ class CheckListCtrl(wx.ListCtrl, CheckListCtrlMixin, ListCtrlAutoWidthMixin):
         
 class Instruction:
     """!Class which represents instruction file"""
+    # increase when options of instruction objects change,
+    # older snapshots would lack them
+    snapshotVersion = 4
+    # types of instructions with map names found by ResolveMaps
+    mapTypes = ('raster', 'rasterLegend', 'vector', 'vProperties')
+    
     def __init__(self, parent, objectsToDraw):
         
         self.parent = parent
         self.objectsToDraw = objectsToDraw
         #here are kept objects like mapinfo, rasterlegend, etc.
         self.instruction = list()
+        # region used when reading file (for message)
+        self.regionString = None
+        # map names read from file are resolved on first access
+        self.unresolved = False
         
     def __str__(self):
         """!Returns text for instruction file"""
-        comment = "# timestamp: " + strftime("%Y-%m-%d %H:%M", localtime()) + '\n'
-        env = grass.gisenv()
-        comment += "# location: %s\n" % env['LOCATION_NAME']
-        comment += "# mapset: %s\n" % env['MAPSET']
-        border = ''
+        buf = []
+        self.Emit(buf.append)
+        return ''.join(buf)
+    
+    def Emit(self, write):
+        """!Write text for instruction file piece by piece
+
+        @param write function called with each piece of text
+        """
+        for piece in self.IterText():
+            write(piece)
+            
+    def IterText(self):
+        """!Generator of pieces of text for instruction file"""
+        if self.unresolved:
+            self.ResolveMaps()
+        yield "# timestamp: " + strftime("%Y-%m-%d %H:%M", localtime()) + '\n'
+        gisenv = GetGisEnv()
+        yield "# location: %s\n# mapset: %s\n" % (gisenv['LOCATION_NAME'], gisenv['MAPSET'])
         if not self.FindInstructionByType('map'):
-            border = 'border n\n'
-        text = [str(each) for each in self.instruction]
-        return comment + border + '\n'.join(text) + '\nend'
+            yield 'border n\n'
+        # only changed objects are serialized again
+        for i, each in enumerate(self.instruction):
+            if i:
+                yield '\n'
+            yield each.GetText()
+        yield '\nend'
+        
+    def Clone(self, shared = True):
+        """!Returns copy of instructions, copies of objects share values until they access them
+
+        @param shared if False, values are copied at once (copy can be used
+        in other thread while original is changed)
+        """
+        if self.unresolved:
+            self.ResolveMaps()
+        clone = Instruction(parent = self.parent, objectsToDraw = list(self.objectsToDraw))
+        clone.instruction = [each.Clone(shared) for each in self.instruction]
+        clone.regionString = self.regionString
+        if hasattr(self, 'filename'):
+            clone.filename = self.filename
+        return clone
+        
+    def Write(self, fileObj):
+        """!Write instruction file into file-like object (file, pipe) without creating whole text
+        
+        @param fileObj object with method write
+        """
+        self.Emit(fileObj.write)
     
     def __getitem__(self, id):
         for each in self.instruction:
             if each.id == id:
+                if self.unresolved and each.type in self.mapTypes:
+                    self.ResolveMaps()
                 return each
         return None
 
@@ -292,8 +666,13 @@ class Instruction:
                 self.objectsToDraw.append(instruction.id) 
                 
             
-    def FindInstructionByType(self, type, list = False):
-        """!Find instruction(s) with the given type"""
+    def FindInstructionByType(self, type, list = False, resolve = True):
+        """!Find instruction(s) with the given type
+
+        @param resolve False to not resolve map names read from file
+        """
+        if resolve and self.unresolved and type in self.mapTypes:
+            self.ResolveMaps()
         inst = []
         for each in self.instruction:
             if each.type == type:
@@ -323,7 +702,7 @@ class Instruction:
         # then run ps.map -b to get information for maploc
         # compute scale and center 
         map = self.FindInstructionByType('map')
-        region = grass.region()
+        region = Region()
         map['center'] = (region['n'] + region['s']) / 2, (region['w'] + region['e']) / 2
         mapRect = GetMapBounds(self.filename)
         map['rect'] = mapRect
@@ -341,6 +720,8 @@ class Instruction:
         isBuffer = False
         buffer = []
         instruction = None
+        # the last raster or vector, GUI options can follow it
+        lastMap = None
         vectorMapNumber = 1
         file.seek(0)
         for line in file:
@@ -362,9 +743,17 @@ class Instruction:
                         vectorMapNumber += 1
                     ok = self.SendToRead(instruction, buffer, **kwargs)
                     if not ok: return False
+                    if instruction in ('vpoints', 'vlines', 'vareas'):
+                        lastMap = self.FindInstructionByType('vProperties', list = True, resolve = False)[-1]
+                    else:
+                        lastMap = None
                     buffer = []
                 continue 
             
+            elif line.startswith('# psmap:'):
+                if lastMap:
+                    lastMap.ReadOptions(line.split()[2:])
+            
             elif line.startswith('paper'):
                 instruction = 'paper'
                 isBuffer = True
@@ -390,6 +779,7 @@ class Instruction:
             elif line.startswith('raster'):
                 ok = self.SendToRead(instruction = 'raster', text = line)
                 if not ok: return False
+                lastMap = self.FindInstructionByType('raster', resolve = False)
             
             elif line.startswith('mapinfo'):
                 instruction = 'mapinfo'
@@ -434,14 +824,15 @@ class Instruction:
                 isBuffer = True
                 buffer.append(line)
 
-
+        # maps are searched when they are needed
+        self.unresolved = True
         
-        rasterLegend = self.FindInstructionByType('rasterLegend')
-        raster = self.FindInstructionByType('raster')
+        rasterLegend = self.FindInstructionByType('rasterLegend', resolve = False)
+        raster = self.FindInstructionByType('raster', resolve = False)
         page = self.FindInstructionByType('page')
-        vector = self.FindInstructionByType('vector')
+        vector = self.FindInstructionByType('vector', resolve = False)
         vectorLegend = self.FindInstructionByType('vectorLegend')
-        vectorMaps = self.FindInstructionByType('vProperties', list = True)
+        vectorMaps = self.FindInstructionByType('vProperties', list = True, resolve = False)
 
         # check (in case of scaletype 0) if map is drawn also
         map['drawMap'] = False
@@ -485,10 +876,14 @@ class Instruction:
             for vmap in vectorMaps:
                 for i, each in enumerate(vector['list']):
                     if each[2] == vmap.id:
-                        
-                        vector['list'][i][4] = vmap['label']
+                        # default label is set by ResolveMaps
+                        if vmap['label'] is not None:
+                            vector['list'][i][4] = vmap['label']
                         vector['list'][i][3] = vmap['lpos']
+            vector.SetDirty()
             if vectorLegend:
+                # size depends on labels
+                self.ResolveMaps()
                 size = vectorLegend.EstimateSize(vectorInstr = vector, fontsize = vectorLegend['fontsize'],
                                             width = vectorLegend['width'], cols = vectorLegend['cols'])                            
                 vectorLegend['rect'] = wx.Rect2D(x = float(vectorLegend['where'][0]), y = float(vectorLegend['where'][1]),
@@ -504,6 +899,43 @@ class Instruction:
         #
         return True
         
+    def ResolveMaps(self):
+        """!Find full names of maps read from instruction file
+
+        All names are searched at once (one g.mlist for each map type)
+        instead of running g.findfile for each map. It's done when maps
+        are accessed first time after Read.
+        """
+        self.unresolved = False
+        rasters = self.FindInstructionByType('raster', list = True, resolve = False) + \
+                  self.FindInstructionByType('rasterLegend', list = True, resolve = False)
+        vectors = self.FindInstructionByType('vProperties', list = True, resolve = False)
+        rastNames = FindMaps([each['raster'] for each in rasters if each['raster']], type = 'rast')
+        vectNames = FindMaps([each['name'] for each in vectors], type = 'vect')
+        notFound = []
+        for each in rasters:
+            if each['raster'] in rastNames:
+                each['raster'] = rastNames[each['raster']]
+            elif each['raster']:
+                notFound.append(each['raster'])
+        
+        vector = self.FindInstructionByType('vector', resolve = False)
+        for each in vectors:
+            if each['name'] in vectNames:
+                each['name'] = vectNames[each['name']]
+                each['connection'] = bool(GetVectorDBInfo(each['name']).layers)
+            else:
+                notFound.append(each['name'])
+            if each['label'] is None:
+                each['label'] = '('.join(each['name'].split('@')) + ')'
+            if vector:
+                for layer in vector['list']:
+                    if layer[2] == each.id:
+                        layer[0], layer[4] = each['name'], each['label']
+                vector.SetDirty()
+        if notFound:
+            GWarning(_("Maps not found: %s") % ', '.join(notFound))
+        
     def SendToRead(self, instruction, text, **kwargs):
         #print 'send to read', instruction, text
         psmapInstrDict = dict(  paper = ['page'],
@@ -584,10 +1016,11 @@ class Instruction:
         else:
             map['scaleType'] = 2
             grass.del_temp_region()
-            region = grass.region()
+            region = Region()
             grass.use_temp_region()    
             cmd = ['g.region', region]
         cmdString = GetCmdString(cmd).replace('g.region', '')
+        self.regionString = cmdString
         GMessage(_("Instruction file will be loaded with following region: %s\n") % cmdString)
         try:
             RunCommand(cmd[0], **cmd[1])
@@ -595,6 +1028,205 @@ class Instruction:
         except grass.ScriptError, e:
             GError(_("Region cannot be set\n%s") % e)
             return False
+        
+    def GetSnapshotFile(self, filename):
+        """!Returns path to snapshot of instruction file (in mapset's .tmp directory)"""
+        gisenv = GetGisEnv()
+        key = hashlib.md5(os.path.abspath(filename)).hexdigest()
+        return os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'],
+                            gisenv['MAPSET'], '.tmp', 'psmap_%s.snapshot' % key)
+        
+    def GetDependencies(self):
+        """!Returns data instructions depend on (maps, saved regions, symbol, EPS and pattern files)
+
+        @return list of dictionaries with keys 'type' ('raster', 'vector', 'region', 'file'),
+        'name', 'path' (empty if not found) and 'files' (list of (path, mtime), mtime is None
+        for missing file, e.g. color table which can be created later)
+        """
+        names = []
+        map = self.FindInstructionByType('map')
+        if map and map['scaleType'] == 0 and map['map']:
+            names.append((map['mapType'], map['map']))
+        elif map and map['scaleType'] == 1 and map['region']:
+            names.append(('region', map['region']))
+        for each in self.FindInstructionByType('raster', list = True) + \
+                    self.FindInstructionByType('rasterLegend', list = True):
+            if each['raster']:
+                names.append(('raster', each['raster']))
+        vector = self.FindInstructionByType('vector')
+        if vector and vector['list']:
+            names += [('vector', each[0]) for each in vector['list']]
+        symbolPath = os.path.join(os.getenv('GISBASE', ''), 'etc', 'symbol')
+        for each in self.FindInstructionByType('vProperties', list = True):
+            names.append(('vector', each['name']))
+            if each.subType == 'points' and each['symbol']:
+                names.append(('file', os.path.join(symbolPath, each['symbol'])))
+            elif each.subType == 'points' and each['eps']:
+                names.append(('file', each['eps']))
+            elif each.subType == 'areas' and each['pat']:
+                names.append(('file', each['pat']))
+        
+        gisenv = GetGisEnv()
+        locationPath = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+        dependencies = []
+        seen = set()
+        for type, name in names:
+            if (type, name) in seen:
+                continue
+            seen.add((type, name))
+            files = []
+            if type == 'raster':
+                path = self._findMapPath(name, 'cell', locationPath)
+                if path:
+                    mapsetPath = os.path.dirname(os.path.dirname(path))
+                    basename = os.path.basename(path)
+                    path = os.path.join(mapsetPath, 'cellhd', basename)
+                    files = [os.path.join(mapsetPath, element, basename)
+                             for element in ('cellhd', 'cell', 'fcell', 'colr', 'cats')]
+                    # secondary color table in current mapset
+                    files.append(os.path.join(locationPath, gisenv['MAPSET'], 'colr2',
+                                              os.path.basename(mapsetPath), basename))
+            elif type == 'vector':
+                path = self._findMapPath(name, 'vector', locationPath)
+                if path:
+                    files = [os.path.join(path, element) for element in ('head', 'coor', 'topo', 'dbln')]
+            elif type == 'region':
+                path = self._findMapPath(name, 'windows', locationPath)
+                if path:
+                    files = [path]
+            else:
+                path = ''
+                if os.path.isfile(name):
+                    path = name
+                files = [name]
+            dependency = dict(type = type, name = name, path = path, files = [])
+            for file in files:
+                try:
+                    dependency['files'].append((file, os.path.getmtime(file)))
+                except OSError:
+                    dependency['files'].append((file, None))
+            dependencies.append(dependency)
+        return dependencies
+        
+    def _findMapPath(self, name, element, locationPath):
+        """!Returns path to map element, empty string if map is not found
+
+        Names with mapset (as resolved by Read) are not searched again.
+        """
+        if '@' in name:
+            name, mapset = name.split('@', 1)
+            path = os.path.join(locationPath, mapset, element, name)
+            if os.path.exists(path):
+                return path
+            return ''
+        return FindFile(name, element = element)['file']
+        
+    def _getSnapshotFiles(self):
+        """!Returns list of files (instruction file and used maps) snapshot depends on,
+        missing files are included too, they must stay missing"""
+        files = [os.path.abspath(self.filename)]
+        for dependency in self.GetDependencies():
+            if not dependency['path'] and dependency['type'] != 'file':
+                return None
+            files += [path for path, mtime in dependency['files']]
+        return files
+        
+    def _getFileStamps(self, files):
+        """!Returns modification times and sizes of files, None for missing file"""
+        stamps = dict()
+        for path in files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stamps[path] = None
+                continue
+            stamps[path] = (stat.st_mtime, stat.st_size)
+        return stamps
+        
+    def SaveSnapshot(self):
+        """!Save read instructions together with current region into binary snapshot
+
+        Snapshot is used instead of reading instruction file again
+        while the file and used maps are not changed.
+        """
+        files = self._getSnapshotFiles()
+        if not files:
+            return False
+        stamps = self._getFileStamps(files)
+        region = GetRegionStamp()
+        if not stamps[files[0]] or not region:
+            return False
+        try:
+            fd = open(region[0], 'r')
+            try:
+                regionText = fd.read()
+            finally:
+                fd.close()
+            payload = cPickle.dumps(dict(filename = os.path.abspath(self.filename), stamps = stamps,
+                                         instruction = self.instruction, objectsToDraw = list(self.objectsToDraw),
+                                         region = regionText, regionString = self.regionString,
+                                         projInfo = projInfo()), cPickle.HIGHEST_PROTOCOL)
+            fd = open(self.GetSnapshotFile(self.filename), 'wb')
+            try:
+                fd.write("psmap snapshot %d %s\n" % (self.snapshotVersion, hashlib.md5(payload).hexdigest()))
+                fd.write(payload)
+            finally:
+                fd.close()
+        except (IOError, TypeError, cPickle.PicklingError):
+            return False
+        return True
+        
+    def ReadSnapshot(self, filename):
+        """!Read instructions from snapshot if it is valid, without running GRASS modules
+
+        @return False if there is no valid snapshot of the file
+        """
+        region = GetRegionStamp()
+        if not region:
+            return False
+        try:
+            fd = open(self.GetSnapshotFile(filename), 'rb')
+            try:
+                header = fd.readline().split()
+                payload = fd.read()
+            finally:
+                fd.close()
+            if header != ['psmap', 'snapshot', str(self.snapshotVersion), hashlib.md5(payload).hexdigest()]:
+                return False
+            data = cPickle.loads(payload)
+        except (IOError, EOFError, AttributeError, ImportError, TypeError, ValueError, cPickle.UnpicklingError):
+            return False
+        if data['filename'] != os.path.abspath(filename) or \
+                self._getFileStamps(data['stamps'].keys()) != data['stamps']:
+            return False
+        
+        try:
+            fd = open(region[0], 'w')
+            try:
+                fd.write(data['region'])
+            finally:
+                fd.close()
+        except IOError:
+            return False
+        
+        self.filename = filename
+        self.regionString = data['regionString']
+        if data['regionString'] is not None:
+            GMessage(_("Instruction file will be loaded with following region: %s\n") % data['regionString'])
+        if not projInfoCache:
+            projInfoCache.update(data['projInfo'])
+        # ids are valid only in one session
+        ids = dict()
+        for each in data['instruction']:
+            ids[each.id] = each.id = wx.NewId()
+            each.SetDirty()
+        for each in data['instruction']:
+            if each.type == 'vector' and each['list']:
+                for layer in each['list']:
+                    layer[2] = ids.get(layer[2], layer[2])
+        self.instruction = data['instruction']
+        self.objectsToDraw[:] = [ids[id] for id in data['objectsToDraw']]
+        return True
           
 
 class InstructionObject:
@@ -608,31 +1240,104 @@ class InstructionObject:
         self.instruction = self.defaultInstruction   
         # converting units
         self.unitConv = UnitConversion() 
+        # cached text of instruction
+        self.text = None
+        self.textKey = None
+        self.dirty = True
+        # keys of lists and dicts shared with original (in clone)
+        self.sharedKeys = set()
     
     def __str__(self):
         """!Returns particular part of text instruction"""
-        return ''
+        return self.GetText()
+    
+    def Emit(self, write):
+        """!Write particular part of text instruction using write function"""
+        pass
+        
+    def GetText(self):
+        """!Returns particular part of text instruction, generated again only if changed"""
+        key = self.GetTextKey()
+        if self.dirty or self.text is None or key != self.textKey:
+            buf = []
+            self.Emit(buf.append)
+            self.text = ''.join(buf)
+            self.textKey = key
+            self.dirty = False
+        return self.text
+        
+    def GetTextKey(self):
+        """!Returns key of state outside of instruction which the text depends on"""
+        return None
+        
+    def SetDirty(self):
+        """!Text has to be generated again"""
+        self.dirty = True
+        
+    def Clone(self, shared = True):
+        """!Returns copy of instruction object
+
+        Original is not affected. Copy gets its own dictionary of values,
+        lists and dicts (and generated text) are shared until the copy
+        accesses them.
+
+        @param shared if False, lists and dicts are copied at once
+        """
+        clone = copy(self)
+        clone.instruction = dict(self.instruction)
+        clone.sharedKeys = set([key for key, value in self.instruction.iteritems()
+                                if isinstance(value, (list, dict))])
+        if not shared:
+            clone._ownValues()
+        return clone
+        
+    def _ownValues(self):
+        """!Copy shared values before they are changed (lists and dicts can be changed in place)"""
+        for key in self.sharedKeys:
+            self.instruction[key] = deepcopy(self.instruction[key])
+        self.sharedKeys = set()
         
     def __getitem__(self, key):
-        for each in self.instruction.keys():
-            if each == key:
-                return self.instruction[key]
+        if key in self.instruction:
+            if key in self.sharedKeys:
+                self.instruction[key] = deepcopy(self.instruction[key])
+                self.sharedKeys.discard(key)
+            return self.instruction[key]
         return None
                
     def __setitem__(self, key, value):
+        self.sharedKeys.discard(key)
         self.instruction[key] = value
+        self.dirty = True
     
     def GetInstruction(self):
         """!Get current values"""
+        # values can be changed by caller, who marks object dirty
+        # by SetInstruction or SetDirty then
+        self._ownValues()
         return self.instruction
     
     def SetInstruction(self, instruction):
         """!Set default values"""
         self.instruction = instruction
+        self.sharedKeys = set()
+        self.dirty = True
         
     def Read(self, instruction, text, **kwargs):
         """!Read instruction and save them"""
         pass
+    
+    def ValidateColors(self, instr, instruction, keys = ('color', 'fcolor', 'hcolor', 'background', 'border')):
+        """!Check and normalize colors read from instruction file"""
+        for key in keys:
+            if key in instr:
+                color = ValidateColor(instr[key])
+                if color is None:
+                    GError(_("Failed to read instruction %(instr)s, invalid color '%(color)s'") % \
+                               {'instr' : instruction, 'color' : instr[key]})
+                    return False
+                instr[key] = color
+        return True
         
 class InitMap(InstructionObject):
     """!Class representing virtual map"""
@@ -658,50 +1363,47 @@ class MapFrame(InstructionObject):
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
-        instr = ''
-        comment = ''
+    # instruction templates
+    regionTemplate = "# g.region n=%(n)s s=%(s)s e=%(e)s w=%(w)s rows=%(rows)s cols=%(cols)s \n"
+    borderTemplate = "border y\n    width %(width)s\n    color %(color)s\n    end\n"
+    
+    def GetTextKey(self):
+        """!Text depends on current region"""
+        if self.instruction['scaleType'] in (0, 2, 3):
+            stamp = GetRegionStamp()
+            if stamp is None:
+                self.dirty = True
+            return stamp
+        return None
+        
+    def Emit(self, write):
+        dic = self.instruction
         
         #region settings
-        region = grass.region()
-        if self.instruction['scaleType'] == 0: #match map
-            map = self.instruction['map']
-            if self.instruction['mapType'] == 'raster':
-                comment = "# g.region rast=%s cols=%s rows=%s\n" % (map, region['cols'], region['rows'])
+        if dic['scaleType'] == 0: #match map
+            if dic['mapType'] == 'raster':
+                region = Region()
+                write("# g.region rast=%s cols=%s rows=%s\n\n" % (dic['map'], region['cols'], region['rows']))
             else:
-                comment = "# g.region vect=%s\n" % (map)
-        elif self.instruction['scaleType'] == 1:# saved region
-            region = self.instruction['region']
-            comment = "# g.region region=%s\n" % region
-        elif self.instruction['scaleType'] in (2, 3): #current region, fixed scale
-            comment = string.Template("# g.region n=$n s=$s e=$e w=$w rows=$rows cols=$cols \n").substitute(**region)
-        
-        instr += comment
-        instr += '\n'
+                write("# g.region vect=%s\n\n" % (dic['map'],))
+        elif dic['scaleType'] == 1:# saved region
+            write("# g.region region=%s\n\n" % (dic['region'],))
+        elif dic['scaleType'] in (2, 3): #current region, fixed scale
+            write(self.regionTemplate % Region() + '\n')
+        else:
+            write('\n')
         # maploc
-        maplocInstruction = "maploc %.3f %.3f" % (self.instruction['rect'].x, self.instruction['rect'].y)
-        if self.instruction['scaleType'] != 3:
-            maplocInstruction += "  %.3f %.3f"% (self.instruction['rect'].width, self.instruction['rect'].height)
-        instr += maplocInstruction
-        instr += '\n'
-        
-        # scale
-        if self.instruction['scaleType'] == 3: #fixed scale
-            scaleInstruction = "scale 1:%.0f" % (1/self.instruction['scale'])
-            instr += scaleInstruction
-            instr += '\n'
+        if dic['scaleType'] != 3:
+            write("maploc %.3f %.3f  %.3f %.3f\n" % (dic['rect'].x, dic['rect'].y, dic['rect'].width, dic['rect'].height))
+        else:
+            write("maploc %.3f %.3f\n" % (dic['rect'].x, dic['rect'].y))
+            # scale
+            write("scale 1:%.0f\n" % (1/dic['scale']))
         # border
-        borderInstruction = ''
-        if self.instruction['border'] == 'n':
-            borderInstruction = "border n"
+        if dic['border'] == 'n':
+            write("border n\n")
         else:
-            borderInstruction = "border y\n"
-            borderInstruction += string.Template("    width $width\n    color $color\n").substitute(self.instruction)
-            borderInstruction += "    end"
-        instr += borderInstruction
-        instr += '\n'
-
-        return instr  
+            write(self.borderTemplate % dic)
      
     def Read(self, instruction, text, **kwargs):
         """!Read instruction and save information"""
@@ -758,6 +1460,8 @@ class MapFrame(InstructionObject):
                     GWarning(_("Map frame size changed, old value: %s %s\nnew value: %s %s") %(
                                             maploc[2], maploc[3], self.instruction['rect'].Get()[2], self.instruction['rect'].Get()[3]))
                 #instr['rect'] = wx.Rect2D(*map(float, maploc))
+        if not self.ValidateColors(instr, instruction, keys = ('color',)):
+            return False
         self.instruction.update(instr)   
         return True 
     
@@ -772,14 +1476,17 @@ class PageSetup(InstructionObject):
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
+    # instruction templates
+    customTemplate = "paper\n    width %(Width)s\n    height %(Height)s\n"
+    formatTemplate = "paper %(Format)s\n"
+    marginsTemplate = "    left %(Left)s\n    right %(Right)s\n    bottom %(Bottom)s\n    top %(Top)s\n    end"
+    
+    def Emit(self, write):
         if self.instruction['Format'] == 'custom':
-            instr = string.Template("paper\n    width $Width\n    height $Height\n").substitute(self.instruction)
+            write(self.customTemplate % self.instruction)
         else:
-            instr = string.Template("paper $Format\n").substitute(self.instruction)
-        instr += string.Template("    left $Left\n    right $Right\n    bottom $Bottom\n    top $Top\n    end").substitute(self.instruction)
-
-        return instr
+            write(self.formatTemplate % self.instruction)
+        write(self.marginsTemplate % self.instruction)
     
     def Read(self, instruction, text):
         """!Read instruction and save information"""
@@ -792,7 +1499,7 @@ class PageSetup(InstructionObject):
                 if line.startswith('paper'): 
                     if len(line.split()) > 1:
                         pformat = line.split()[1]
-                        availableFormats = self._toDict(grass.read_command('ps.map', flags = 'p'))
+                        availableFormats = self._toDict(RequestPaperSizes().GetResult())
                         # e.g. paper a3 
                         try:
                             instr['Format'] = pformat
@@ -841,13 +1548,13 @@ class Mapinfo(InstructionObject):
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
-        instr = "mapinfo\n"
-        instr += "    where %.3f %.3f\n" % (self.instruction['where'][0], self.instruction['where'][1])
-        instr += string.Template("    font $font\n    fontsize $fontsize\n    color $color\n").substitute(self.instruction)            
-        instr += string.Template("    background $background\n    border $border\n").substitute(self.instruction)  
-        instr += "    end"
-        return instr
+    # instruction templates
+    template = "    font %(font)s\n    fontsize %(fontsize)s\n    color %(color)s\n" \
+               "    background %(background)s\n    border %(border)s\n    end"
+    
+    def Emit(self, write):
+        write("mapinfo\n    where %.3f %.3f\n" % tuple(self.instruction['where'][:2]))
+        write(self.template % self.instruction)
     
     def Read(self, instruction, text):
         """!Read instruction and save information"""
@@ -870,6 +1577,8 @@ class Mapinfo(InstructionObject):
         except (ValueError, IndexError):
             GError(_("Failed to read instruction %s") % instruction)
             return False
+        if not self.ValidateColors(instr, instruction):
+            return False
         self.instruction.update(instr)
         self.instruction['rect'] = self.EstimateRect(mapinfoDict = self.instruction)
         return True
@@ -895,26 +1604,26 @@ class Text(InstructionObject):
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
-        text = self.instruction['text'].replace('\n','\\n')
-        instr = "text %s %s" % (self.instruction['east'], self.instruction['north'])
-        instr += " %s\n" % text
-        instr += string.Template("    font $font\n    fontsize $fontsize\n    color $color\n").substitute(self.instruction)
-        instr += string.Template("    hcolor $hcolor\n").substitute(self.instruction)
-        if self.instruction['hcolor'] != 'none':
-            instr += string.Template("    hwidth $hwidth\n").substitute(self.instruction)
-        instr += string.Template("    border $border\n").substitute(self.instruction)
-        if self.instruction['border'] != 'none':
-            instr += string.Template("    width $width\n").substitute(self.instruction)
-        instr += string.Template("    background $background\n").substitute(self.instruction)
-        if self.instruction["ref"] != '0':
-            instr += string.Template("    ref $ref\n").substitute(self.instruction)
-        if self.instruction["rotate"]:
-            instr += string.Template("    rotate $rotate\n").substitute(self.instruction)
-        if float(self.instruction["xoffset"]) or float(self.instruction["yoffset"]):
-            instr += string.Template("    xoffset $xoffset\n    yoffset $yoffset\n").substitute(self.instruction)
-        instr += "    end"
-        return instr
+    # instruction templates
+    fontTemplate = "    font %(font)s\n    fontsize %(fontsize)s\n    color %(color)s\n    hcolor %(hcolor)s\n"
+    
+    def Emit(self, write):
+        dic = self.instruction
+        write("text %s %s %s\n" % (dic['east'], dic['north'], dic['text'].replace('\n','\\n')))
+        write(self.fontTemplate % dic)
+        if dic['hcolor'] != 'none':
+            write("    hwidth %s\n" % (dic['hwidth'],))
+        write("    border %s\n" % (dic['border'],))
+        if dic['border'] != 'none':
+            write("    width %s\n" % (dic['width'],))
+        write("    background %s\n" % (dic['background'],))
+        if dic["ref"] != '0':
+            write("    ref %s\n" % (dic['ref'],))
+        if dic["rotate"]:
+            write("    rotate %s\n" % (dic['rotate'],))
+        if float(dic["xoffset"]) or float(dic["yoffset"]):
+            write("    xoffset %s\n    yoffset %s\n" % (dic['xoffset'], dic['yoffset']))
+        write("    end")
     
     def Read(self, instruction, text, **kwargs):
         """!Read instruction and save information"""
@@ -965,6 +1674,8 @@ class Text(InstructionObject):
             except(IndexError, ValueError):
                 GError(_("Failed to read instruction %s") % instruction)
                 return False
+        if not self.ValidateColors(instr, instruction):
+            return False
         instr['where'] = PaperMapCoordinates(map = map, x = instr['east'], y = instr['north'], paperToMap = False)       
         self.instruction.update(instr)
 
@@ -973,7 +1684,7 @@ class Text(InstructionObject):
     def PercentToReal(self, e, n):
         """!Converts text coordinates from percent of region to map coordinates"""
         e, n = float(e.strip('%')), float(n.strip('%'))
-        region = grass.region()
+        region = Region()
         N = region['s'] + (region['n'] - region['s']) / 100 * n
         E = region['w'] + (region['e'] - region['w']) / 100 * e
         return E, N
@@ -992,15 +1703,14 @@ class Scalebar(InstructionObject):
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
-        instr = string.Template("scalebar $scalebar\n").substitute(self.instruction)
-        instr += "    where %.3f %.3f\n" % (self.instruction['where'][0], self.instruction['where'][1])
-        instr += string.Template("    length $length\n    units $unitsLength\n").substitute(self.instruction)
-        instr += string.Template("    height $height\n").substitute(self.instruction)
-        instr += string.Template("    segment $segment\n    numbers $numbers\n").substitute(self.instruction)
-        instr += string.Template("    fontsize $fontsize\n    background $background\n").substitute(self.instruction)
-        instr += "    end"
-        return instr
+    # instruction templates
+    template = "    length %(length)s\n    units %(unitsLength)s\n    height %(height)s\n" \
+               "    segment %(segment)s\n    numbers %(numbers)s\n" \
+               "    fontsize %(fontsize)s\n    background %(background)s\n    end"
+    
+    def Emit(self, write):
+        write("scalebar %s\n    where %.3f %.3f\n" % ((self.instruction['scalebar'],) + tuple(self.instruction['where'][:2])))
+        write(self.template % self.instruction)
     
     def Read(self, instruction, text, **kwargs):
         """!Read instruction and save information"""
@@ -1075,26 +1785,24 @@ class RasterLegend(InstructionObject):
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
-        instr = "colortable y\n"
-        instr += string.Template("    raster $raster\n").substitute(self.instruction)
-        instr += "    where %.3f %.3f\n" % (self.instruction['where'][0], self.instruction['where'][1])
-        if self.instruction['width']:
-            instr += string.Template("    width $width\n").substitute(self.instruction)
-        instr += string.Template("    discrete $discrete\n").substitute(self.instruction)
-        if self.instruction['discrete'] == 'n':
-            if self.instruction['height']:
-                instr += string.Template("    height $height\n").substitute(self.instruction)
-            instr += string.Template("    tickbar $tickbar\n").substitute(self.instruction)
-            if self.instruction['range']:
-                instr += string.Template("    range $min $max\n").substitute(self.instruction)
+    # instruction templates
+    fontTemplate = "    font %(font)s\n    fontsize %(fontsize)s\n    color %(color)s\n    end"
+    
+    def Emit(self, write):
+        dic = self.instruction
+        write("colortable y\n    raster %s\n    where %.3f %.3f\n" % ((dic['raster'],) + tuple(dic['where'][:2])))
+        if dic['width']:
+            write("    width %s\n" % (dic['width'],))
+        write("    discrete %s\n" % (dic['discrete'],))
+        if dic['discrete'] == 'n':
+            if dic['height']:
+                write("    height %s\n" % (dic['height'],))
+            write("    tickbar %s\n" % (dic['tickbar'],))
+            if dic['range']:
+                write("    range %s %s\n" % (dic['min'], dic['max']))
         else:
-            instr += string.Template("    cols $cols\n").substitute(self.instruction)
-            instr += string.Template("    nodata $nodata\n").substitute(self.instruction)
-        instr += string.Template("    font $font\n    fontsize $fontsize\n    color $color\n")\
-                                .substitute(self.instruction)
-        instr += "    end"
-        return instr    
+            write("    cols %s\n    nodata %s\n" % (dic['cols'], dic['nodata']))
+        write(self.fontTemplate % dic)
     
     
     def Read(self, instruction, text, **kwargs):
@@ -1142,6 +1850,8 @@ class RasterLegend(InstructionObject):
             except(IndexError, ValueError):
                 GError(_("Failed to read instruction %s") % instruction)
                 return False
+        if not self.ValidateColors(instr, instruction, keys = ('color',)):
+            return False
             
         if 'raster' in instr:
             instr['rasterDefault'] = False
@@ -1175,7 +1885,7 @@ class RasterLegend(InstructionObject):
             else:
                 cols = 1 
 
-            rinfo = grass.raster_info(raster)
+            rinfo = RasterInfo(raster)
             if rinfo['datatype'] in ('DCELL', 'FCELL'):
                 minim, maxim = rinfo['min'], rinfo['max']
                 rows = ceil( maxim / cols )
@@ -1193,7 +1903,7 @@ class RasterLegend(InstructionObject):
         """!Estimate size to draw raster legend"""
         
         if discrete == 'n':
-            rinfo = grass.raster_info(raster)
+            rinfo = RasterInfo(raster)
             minim, maxim = rinfo['min'], rinfo['max']
             if width:
                 width = width
@@ -1232,16 +1942,16 @@ class VectorLegend(InstructionObject):
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
-        instr = "vlegend\n"
-        instr += "    where %.3f %.3f\n" % (self.instruction['where'][0], self.instruction['where'][1])
-        instr += string.Template("    font $font\n    fontsize $fontsize\n").substitute(self.instruction)
-        instr += string.Template("    width $width\n    cols $cols\n").substitute(self.instruction)
-        if self.instruction['span']:
-            instr += string.Template("    span $span\n").substitute(self.instruction)
-        instr += string.Template("    border $border\n").substitute(self.instruction)  
-        instr += "    end"  
-        return instr
+    # instruction templates
+    template = "    font %(font)s\n    fontsize %(fontsize)s\n    width %(width)s\n    cols %(cols)s\n"
+    
+    def Emit(self, write):
+        dic = self.instruction
+        write("vlegend\n    where %.3f %.3f\n" % tuple(dic['where'][:2]))
+        write(self.template % dic)
+        if dic['span']:
+            write("    span %s\n" % (dic['span'],))
+        write("    border %s\n    end" % (dic['border'],))
 
     def Read(self, instruction, text, **kwargs):
         """!Read instruction and save information"""
@@ -1267,6 +1977,8 @@ class VectorLegend(InstructionObject):
             except(IndexError, ValueError):
                 GError(_("Failed to read instruction %s") % instruction)
                 return False
+        if not self.ValidateColors(instr, instruction):
+            return False
             
         self.instruction.update(instr)
             
@@ -1301,13 +2013,20 @@ class Raster(InstructionObject):
         InstructionObject.__init__(self, id = id)
         self.type = 'raster'
         # default values
-        self.defaultInstruction = dict(isRaster = False, raster = None)
+        self.defaultInstruction = dict(isRaster = False, raster = None, resample = False)
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
-        instr = string.Template("raster $raster").substitute(self.instruction)
-        return instr
+    def Emit(self, write):
+        write("raster %s" % (self.instruction['raster'],))
+        # option of GUI, ps.map ignores comments
+        if self.instruction['resample']:
+            write("\n# psmap: resample")
+    
+    def ReadOptions(self, options):
+        """!Read options of GUI (from comment following the instruction)"""
+        if 'resample' in options:
+            self.instruction['resample'] = True
     
     def Read(self, instruction, text):
         """!Read instruction and save information"""
@@ -1318,12 +2037,8 @@ class Raster(InstructionObject):
         except IndexError:
             GError(_("Failed to read instruction %s") % instruction)
             return False
-        try:
-            info = grass.find_file(map, element = 'cell')
-        except grass.ScriptError, e:
-            GError(message = e.value)
-            return False
-        instr['raster'] = info['fullname']
+        # full name is found later (Instruction.ResolveMaps)
+        instr['raster'] = map
 
         
         self.instruction.update(instr)
@@ -1338,8 +2053,8 @@ class Vector(InstructionObject):
         self.defaultInstruction = dict(list = None)# [vmap, type, id, lpos, label] 
         # current values
         self.instruction = dict(self.defaultInstruction)
-    def __str__(self):
-        return ''
+    def Emit(self, write):
+        pass
     
     def Read(self, instruction, text, **kwargs):
         """!Read instruction and save information"""
@@ -1356,12 +2071,6 @@ class Vector(InstructionObject):
                     subType = 'areas'
                 # name of vector map
                 vmap = line.split()[1]
-                try:
-                    info = grass.find_file(vmap, element = 'vector')
-                except grass.ScriptError, e:
-                    GError(message = e.value)
-                    return False
-                vmap = info['fullname']
                 # id
                 id = kwargs['id']
                 # lpos
@@ -1400,89 +2109,84 @@ class VProperties(InstructionObject):
                         masked = 'n', color = '0:0:0', width = 1,
                         fcolor = 'none', rgbcolumn = None,
                         pat = None, pwidth = 1, scale = 1, label = None, lpos = None)
+        if self.subType in ('lines', 'areas'):
+            dd['generalize'] = False
+        dd['clip'] = False
         self.defaultInstruction = dd
         # current values
         self.instruction = dict(self.defaultInstruction)
         
-    def __str__(self):
+    def Emit(self, write):
         dic = self.instruction
-        vInstruction = string.Template("v$subType $name\n").substitute(dic)
+        write("v%s %s\n" % (dic['subType'], dic['name']))
         #data selection
         if self.subType in ('points', 'lines'):
-           vInstruction += string.Template("    type $type\n").substitute(dic) 
+            write("    type %s\n" % (dic['type'],))
         if dic['connection']:
-            vInstruction += string.Template("    layer $layer\n").substitute(dic)
+            write("    layer %s\n" % (dic['layer'],))
             if dic.has_key('cats'):
-                vInstruction += string.Template("    cats $cats\n").substitute(dic)
+                write("    cats %s\n" % (dic['cats'],))
             elif dic.has_key('where'):
-                    vInstruction += string.Template("    where $where\n").substitute(dic)
-        vInstruction += string.Template("    masked $masked\n").substitute(dic)
+                write("    where %s\n" % (dic['where'],))
+        write("    masked %s\n" % (dic['masked'],))
         #colors
-        vInstruction += string.Template("    color $color\n").substitute(dic)
+        write("    color %s\n" % (dic['color'],))
         if self.subType in ('points', 'areas'):
             if dic['color'] != 'none':
-                vInstruction += string.Template("    width $width\n").substitute(dic)
+                write("    width %s\n" % (dic['width'],))
             if dic['rgbcolumn']:
-                vInstruction += string.Template("    rgbcolumn $rgbcolumn\n").substitute(dic)
-            vInstruction += string.Template("    fcolor $fcolor\n").substitute(dic)
+                write("    rgbcolumn %s\n" % (dic['rgbcolumn'],))
+            write("    fcolor %s\n" % (dic['fcolor'],))
         else:
             if dic['rgbcolumn']:
-                vInstruction += string.Template("    rgbcolumn $rgbcolumn\n").substitute(dic)
+                write("    rgbcolumn %s\n" % (dic['rgbcolumn'],))
             elif dic['hcolor'] != 'none':
-                vInstruction += string.Template("    hwidth $hwidth\n").substitute(dic)
-                vInstruction += string.Template("    hcolor $hcolor\n").substitute(dic)
+                write("    hwidth %s\n    hcolor %s\n" % (dic['hwidth'], dic['hcolor']))
         
         # size and style
         if self.subType == 'points':
             if dic['symbol']:
-                vInstruction += string.Template("    symbol $symbol\n").substitute(dic)
+                write("    symbol %s\n" % (dic['symbol'],))
             else: #eps
-                vInstruction += string.Template("    eps $eps\n").substitute(dic)
+                write("    eps %s\n" % (dic['eps'],))
             if dic['size']:
-                vInstruction += string.Template("    size $size\n").substitute(dic)            
+                write("    size %s\n" % (dic['size'],))
             else: # sizecolumn
-                vInstruction += string.Template("    sizecolumn $sizecolumn\n").substitute(dic)
-                vInstruction += string.Template("    scale $scale\n").substitute(dic)
+                write("    sizecolumn %s\n    scale %s\n" % (dic['sizecolumn'], dic['scale']))
             if dic['rotation']:
                 if dic['rotate'] is not None:
-                    vInstruction += string.Template("    rotate $rotate\n").substitute(dic)
+                    write("    rotate %s\n" % (dic['rotate'],))
                 else:
-                    vInstruction += string.Template("    rotatecolumn $rotatecolumn\n").substitute(dic)
+                    write("    rotatecolumn %s\n" % (dic['rotatecolumn'],))
                     
         if self.subType == 'areas':
             if dic['pat'] is not None:
-                vInstruction += string.Template("    pat $pat\n").substitute(dic)
-                vInstruction += string.Template("    pwidth $pwidth\n").substitute(dic)
-                vInstruction += string.Template("    scale $scale\n").substitute(dic)
+                write("    pat %s\n    pwidth %s\n    scale %s\n" % (dic['pat'], dic['pwidth'], dic['scale']))
                 
         if self.subType == 'lines':
             if dic['width'] is not None:
-                vInstruction += string.Template("    width $width\n").substitute(dic)
+                write("    width %s\n" % (dic['width'],))
             else:
-                vInstruction += string.Template("    cwidth $cwidth\n").substitute(dic)
-            vInstruction += string.Template("    style $style\n").substitute(dic)
-            vInstruction += string.Template("    linecap $linecap\n").substitute(dic)
+                write("    cwidth %s\n" % (dic['cwidth'],))
+            write("    style %s\n    linecap %s\n" % (dic['style'], dic['linecap']))
         #position and label in vlegend
-        vInstruction += string.Template("    label $label\n    lpos $lpos\n").substitute(dic)
-        
-        vInstruction += "    end"
-        return vInstruction
+        write("    label %s\n    lpos %s\n    end" % (dic['label'], dic['lpos']))
+        # options of GUI, ps.map ignores comments
+        options = [key for key in ('generalize', 'clip') if dic.get(key)]
+        if options:
+            write("\n# psmap: %s" % ' '.join(options))
+    
+    def ReadOptions(self, options):
+        """!Read options of GUI (from comment following the instruction)"""
+        for key in ('generalize', 'clip'):
+            if key in options and key in self.instruction:
+                self.instruction[key] = True
     
     def Read(self, instruction, text, **kwargs):
         """!Read instruction and save information"""
         instr = {}
-        try:
-            info = grass.find_file(name = text[0].split()[1], element = 'vector')
-        except grass.ScriptError, e:
-            GError(message = e.value)
-            return False
-        instr['name'] = info['fullname']
-        #connection
-        instr['connection'] = True
-        self.mapDBInfo = dbm_base.VectorDBInfo(instr['name'])
-        self.layers = self.mapDBInfo.layers.keys()
-        if not self.layers:
-            instr['connection'] = False
+        # full name and connection are found later (Instruction.ResolveMaps)
+        instr['name'] = text[0].split()[1]
             
         # points
         if text[0].startswith('vpoints'):
@@ -1573,10 +2277,10 @@ class VProperties(InstructionObject):
             elif line.startswith('width'):
                 instr['width'] = float(line.split()[1])
                 
-        if 'label' not in instr:
-            instr['label'] = '('.join(instr['name'].split('@')) + ')'
         if 'lpos' not in instr:
             instr['lpos'] = kwargs['vectorMapNumber']
+        if not self.ValidateColors(instr, instruction):
+            return False
         self.instruction.update(instr)
         
         return True
@@ -1728,12 +2432,16 @@ class PageSetupDialog(PsmapDialog):
         PsmapDialog.__init__(self, parent = parent, id = id, title = "Page setup",  settings = settings)
         
         self.cat = ['Units', 'Format', 'Orientation', 'Width', 'Height', 'Left', 'Right', 'Top', 'Bottom']
-        paperString = RunCommand('ps.map', flags = 'p', read = True)
-        self.paperTable = self._toList(paperString) 
         self.unitsList = self.unitConv.getPageUnits()
         self.pageSetupDict = settings[id].GetInstruction()
+        # only current paper is known until list of paper sizes is read
+        self.paperFuture = RequestPaperSizes()
+        self.paperTable = self._toList(self._currentPaper())
 
         self._layout()
+        if not self.paperFuture.IsDone():
+            self.getCtrl('Format').Disable()
+            self.paperFuture.AddCallback(self.OnPaperTable)
         
         if self.pageSetupDict:
             for item in self.cat[:3]:
@@ -1761,6 +2469,7 @@ class PageSetupDialog(PsmapDialog):
         for item in self.cat[3:]:
             self.pageSetupDict[item] = self.unitConv.convert(value = float(self.getCtrl(item).GetValue()),
                                         fromUnit = self.pageSetupDict['Units'], toUnit = 'inch')
+        self.instruction[self.id].SetInstruction(self.pageSetupDict)
             
 
             
@@ -1849,10 +2558,39 @@ class PageSetupDialog(PsmapDialog):
     def getCtrl(self, item):
          return self.hBoxDict[item].GetItem(1).GetWindow()
         
+    def _currentPaper(self):
+        """!Returns paper sizes (ps.map -p format), only current paper if they are not read yet"""
+        if self.paperFuture.IsDone() and not self.paperFuture.error:
+            return self.paperFuture.GetResult()
+        if not self.pageSetupDict or self.pageSetupDict['Format'] == 'custom':
+            return ''
+        sizes = [self.pageSetupDict[item] for item in self.cat[3:]]
+        if self.pageSetupDict['Orientation'] == 'Landscape':
+            sizes[0], sizes[1] = sizes[1], sizes[0]
+        return ' '.join([self.pageSetupDict['Format']] + map(str, sizes))
+        
+    def OnPaperTable(self, future):
+        """!List of paper sizes is available"""
+        if not self:
+            return
+        try:
+            paperString = future.GetResult()
+        except (grass.ScriptError, OSError):
+            GError(parent = self, message = _("Unable to run `ps.map -p`"))
+            return
+        format = self.paperTable[self.getCtrl('Format').GetSelection()]['Format']
+        self.paperTable = self._toList(paperString)
+        formatCtrl = self.getCtrl('Format')
+        formatCtrl.SetItems([item['Format'] for item in self.paperTable])
+        formatCtrl.SetSelection(formatCtrl.FindString(format))
+        formatCtrl.Enable()
+        
     def _toList(self, paperStr):
         
         sizeList = list()
         for line in paperStr.strip().split('\n'):
+            if not line.strip():
+                continue
             d = dict(zip([self.cat[1]]+ self.cat[3:],line.split()))
             sizeList.append(d)
         d = {}.fromkeys([self.cat[1]]+ self.cat[3:], 100)
@@ -1903,6 +2641,8 @@ class MapDialog(PsmapDialog):
                 self.parent.DialogDataChanged(id = self.id[2])
             if okR and self.id[1] in self.instruction:
                 self.parent.DialogDataChanged(id = self.id[1])
+            # removed layers do not pass DialogDataChanged
+            self.parent.canvas.UpdateThumbnail()
             if not okR or not okV:
                 return False
 
@@ -2159,6 +2899,11 @@ class MapFramePanel(wx.Panel):
                                                 mapType = mapType, rect = self.mapFrameDict['rect'])
             #self.center[0] = self.RegionCenter(self.RegionDict(scaleType = 0))
 
+            # topology is needed to add vector map, get it in background
+            if mapType == 'vector' and self.selected and \
+                    FindFile(name = self.selected, element = 'vector')['file']:
+                metadataService.Request(GetVectorTopoInfo, self.selected)
+
         elif self.scaleChoice.GetSelection() == 1:
             self.selectedRegion = self.selected
             self.scale[1], self.center[1],  foo = AutoAdjust(self, scaleType = 1, region = self.selected, rect = self.mapFrameDict['rect'])
@@ -2283,7 +3028,7 @@ class MapFramePanel(wx.Panel):
                 if mapFrameDict['drawMap']:
 
                     if mapFrameDict['mapType'] == 'raster':
-                        mapFile = grass.find_file(mapFrameDict['map'], element = 'cell')
+                        mapFile = FindFile(mapFrameDict['map'], element = 'cell')
                         if mapFile['file'] == '':
                             GMessage("Raster %s not found" % mapFrameDict['map'])
                             return False
@@ -2298,7 +3043,7 @@ class MapFramePanel(wx.Panel):
 
                     elif mapFrameDict['mapType'] == 'vector':
                         
-                        mapFile = grass.find_file(mapFrameDict['map'], element = 'vector')
+                        mapFile = FindFile(mapFrameDict['map'], element = 'vector')
                         if mapFile['file'] == '':
                             GMessage("Vector %s not found" % mapFrameDict['map'])
                             return False
@@ -2310,7 +3055,7 @@ class MapFramePanel(wx.Panel):
                                 if each[0] == mapFrameDict['map']:
                                     isAdded = True
                         if not isAdded:
-                            topoInfo = grass.vector_info_topo(map = mapFrameDict['map'])
+                            topoInfo = GetVectorTopoInfo(mapFrameDict['map'])
                             if topoInfo:
                                 if bool(topoInfo['areas']):
                                     topoType = 'areas'
@@ -2326,6 +3071,7 @@ class MapFramePanel(wx.Panel):
                                     self.instruction.AddInstruction(vector)
                                 id = wx.NewId()
                                 vector['list'].insert(0, [mapFrameDict['map'], topoType, id, 1, label])
+                                vector.SetDirty()
                                 vProp = VProperties(id, topoType)
                                 vProp['name'], vProp['label'], vProp['lpos'] = mapFrameDict['map'], label, 1
                                 self.instruction.AddInstruction(vProp)
@@ -2408,7 +3154,7 @@ class MapFramePanel(wx.Panel):
                 windFile = open(windFilePath, 'r').read()
                 region = grass.parse_key_val(windFile, sep = ':', val_type = float)
             except IOError:
-                region = grass.region()
+                region = Region()
             
             raster = self.instruction.FindInstructionByType('raster')
             if raster:
@@ -2521,6 +3267,11 @@ class RasterPanel(wx.Panel):
         gridBagSizer.Add(self.rasterYesRadio, pos = (1, 0),  flag = wx.ALIGN_CENTER_VERTICAL, border = 0)
         gridBagSizer.Add(self.rasterSelect, pos = (1, 1), flag = wx.ALIGN_CENTER_VERTICAL|wx.EXPAND, border = 0)
         
+        self.resampleCheck = wx.CheckBox(self, id = wx.ID_ANY,
+                                         label = _("resample raster to output resolution before rendering"))
+        self.resampleCheck.SetValue(self.rasterDict['resample'])
+        gridBagSizer.Add(self.resampleCheck, pos = (2, 0), span = (1, 2), flag = wx.ALIGN_CENTER_VERTICAL|wx.LEFT, border = 20)
+        
         sizer.Add(gridBagSizer, proportion = 1, flag = wx.EXPAND|wx.ALL, border = 5)
         border.Add(item = sizer, proportion = 0, flag = wx.ALL | wx.EXPAND, border = 5)
         
@@ -2534,6 +3285,7 @@ class RasterPanel(wx.Panel):
     def OnRaster(self, event):
         """!Enable/disable raster selection"""
         self.rasterSelect.Enable(self.rasterYesRadio.GetValue())
+        self.resampleCheck.Enable(self.rasterYesRadio.GetValue())
         
     def update(self):
         #draw raster
@@ -2548,6 +3300,7 @@ class RasterPanel(wx.Panel):
         else:
             self.rasterDict['isRaster'] = True
             self.rasterDict['raster'] = self.rasterSelect.GetValue()
+            self.rasterDict['resample'] = self.resampleCheck.GetValue()
             if self.rasterDict['raster'] != map['drawMap']:
                 map['drawMap'] = False
             
@@ -2581,6 +3334,8 @@ class VectorPanel(wx.Panel):
         else:
             self.id = wx.NewId()
             self.vectorList = []
+        # delayed topology check while typing map name
+        self.topoTimer = None
 
         vLegend = self.instruction.FindInstructionByType('vectorLegend')
         if vLegend:
@@ -2657,18 +3412,37 @@ class VectorPanel(wx.Panel):
         self.Bind(wx.EVT_BUTTON, self.OnUp, self.btnUp)
         self.Bind(wx.EVT_BUTTON, self.OnDown, self.btnDown)
         self.Bind(wx.EVT_BUTTON, self.OnProperties, self.btnProp)
-        self.select.GetTextCtrl().Bind(wx.EVT_TEXT, self.OnVector)
+        self.select.GetTextCtrl().Bind(wx.EVT_TEXT, self.OnVectorText)
         
         self.SetSizer(border)
         self.Fit()
         
         self.Bind(wx.EVT_LISTBOX_DCLICK, self.OnProperties, self.listbox)
 
+    def OnVectorText(self, event):
+        """!Vector map name is being typed, wait for pause before getting topology"""
+        if self.topoTimer and self.topoTimer.IsRunning():
+            self.topoTimer.Restart()
+        else:
+            self.topoTimer = wx.CallLater(300, self.OnVector, None)
+        event.Skip()
+        
     def OnVector(self, event):
-        """!Gets info about toplogy and enables/disables choices point/line/area"""
-        vmap = self.select.GetValue()   
+        """!Requests info about toplogy of selected map"""
+        if not self:
+            return
+        vmap = self.select.GetValue()
+        if not FindFile(name = vmap, element = 'vector')['file']:
+            return
+        metadataService.Request(GetVectorTopoInfo, vmap).AddCallback(lambda future:
+                                                                        self.OnTopoInfo(future, vmap))
+        
+    def OnTopoInfo(self, future, vmap):
+        """!Enables/disables choices point/line/area according to topology of map"""
+        if not self or self.select.GetValue() != vmap:
+            return
         try:     
-            topoInfo = grass.vector_info_topo(map = vmap)
+            topoInfo = future.GetResult()
         except grass.ScriptError:
             return
         
@@ -2704,6 +3478,8 @@ class VectorPanel(wx.Panel):
             vector = VProperties(id, type)
             self.tmpDialogDict[id] = vector.GetInstruction()
             self.tmpDialogDict[id]['name'] = vmap
+            # properties dialog will need attribute info
+            metadataService.Request(GetVectorDBInfo, vmap)
 
             
             self.listbox.SetSelection(0)  
@@ -2910,10 +3686,11 @@ class VPropertiesDialog(PsmapDialog):
                 self.type = item[1]
         self.SetTitle(self.vectorName + " "+ _("properties"))
         
-        #vector map info
+        #vector map info, usually cached since it was requested
+        #when map was added (VectorPanel) or instructions were read
         self.connection = True
         try:
-            self.mapDBInfo = dbm_base.VectorDBInfo(self.vectorName)
+            self.mapDBInfo = GetVectorDBInfo(self.vectorName)
             self.layers = self.mapDBInfo.layers.keys()
         except grass.ScriptError:
             self.connection = False
@@ -2925,13 +3702,9 @@ class VPropertiesDialog(PsmapDialog):
         self.currLayer = self.vPropertiesDict['layer']
         
         #path to symbols, patterns
-        gisbase = os.getenv("GISBASE")
-        self.symbolPath = os.path.join(gisbase, 'etc', 'symbol')
-        self.symbols = []
-        for dir in os.listdir(self.symbolPath):
-            for symbol in os.listdir(os.path.join(self.symbolPath, dir)):
-                self.symbols.append(os.path.join(dir, symbol))
-        self.patternPath = os.path.join(gisbase, 'etc', 'paint', 'patterns')
+        self.symbolPath = symbolCatalog.symbolPath
+        self.symbols = symbolCatalog.GetSymbols()
+        self.patternPath = symbolCatalog.patternPath
 
         #notebook
         notebook = wx.Notebook(parent = self, id = wx.ID_ANY, style = wx.BK_DEFAULT)
@@ -3056,6 +3829,23 @@ class VPropertiesDialog(PsmapDialog):
         
         sizer.Add(self.mask, proportion = 1, flag = wx.EXPAND|wx.ALL, border = 5)
         border.Add(item = sizer, proportion = 0, flag = wx.ALL | wx.EXPAND, border = 5)
+        
+        #processing before rendering
+        box   = wx.StaticBox (parent = panel, id = wx.ID_ANY, label = " %s " % _("Before rendering"))
+        sizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        
+        self.clip = wx.CheckBox(panel, id = wx.ID_ANY, label = _("Use only features in map frame"))
+        self.clip.SetValue(bool(self.vPropertiesDict['clip']))
+        sizer.Add(self.clip, proportion = 0, flag = wx.EXPAND|wx.ALL, border = 5)
+        self.generalize = None
+        if self.type in ('lines', 'areas'):
+            self.generalize = wx.CheckBox(panel, id = wx.ID_ANY,
+                                          label = _("Simplify %s to map scale") % \
+                                              {'lines' : _("lines"), 'areas' : _("boundaries")}[self.type])
+            self.generalize.SetValue(bool(self.vPropertiesDict['generalize']))
+            sizer.Add(self.generalize, proportion = 0, flag = wx.EXPAND|wx.ALL, border = 5)
+        
+        border.Add(item = sizer, proportion = 0, flag = wx.ALL | wx.EXPAND, border = 5)
 
         self.Bind(wx.EVT_CHOICE, self.OnLayer, self.layerChoice)
         
@@ -3285,7 +4075,9 @@ class VPropertiesDialog(PsmapDialog):
         self.symbolRadio.SetValue(bool(self.vPropertiesDict['symbol']))
             
          
-        self.symbolChoice = wx.Choice(panel, id = wx.ID_ANY, choices = self.symbols)
+        self.symbolChoice = wx.combo.BitmapComboBox(panel, id = wx.ID_ANY, style = wx.CB_READONLY)
+        for symbol in self.symbols:
+            self.symbolChoice.Append(symbol, symbolCatalog.GetPreview(symbol))
             
         self.epsRadio = wx.RadioButton(panel, id = wx.ID_ANY, label = _("eps file:"))
         self.epsRadio.SetValue(bool(self.vPropertiesDict['eps']))
@@ -3475,10 +4267,12 @@ class VPropertiesDialog(PsmapDialog):
         gridBagSizer.AddGrowableCol(1)
         
         self.patternCheck = wx.CheckBox(panel, id = wx.ID_ANY, label = _("use pattern:"))
-        self.patFileCtrl = filebrowse.FileBrowseButton(panel, id = wx.ID_ANY, labelText = _("Choose pattern file:"),
+        # installed patterns are offered in drop-down list
+        self.patFileCtrl = filebrowse.FileBrowseButtonWithHistory(panel, id = wx.ID_ANY, labelText = _("Choose pattern file:"),
                                 buttonText =  _("Browse"), toolTip = _("Type filename or click browse to choose file"), 
                                 dialogTitle = _("Choose a file"), startDirectory = self.patternPath, initialValue = '',
-                                fileMask = "Encapsulated PostScript (*.eps)|*.eps|All files (*.*)|*.*", fileMode = wx.OPEN)
+                                fileMask = "Encapsulated PostScript (*.eps)|*.eps|All files (*.*)|*.*", fileMode = wx.OPEN,
+                                history = symbolCatalog.GetPatterns())
         self.patWidthText = wx.StaticText(panel, id = wx.ID_ANY, label = _("pattern line width (pts):"))
         self.patWidthSpin = wx.SpinCtrl(panel, id = wx.ID_ANY, min = 1, max = 25, initial = 1)
         self.patScaleText = wx.StaticText(panel, id = wx.ID_ANY, label = _("pattern scale factor:"))
@@ -3612,7 +4406,10 @@ class VPropertiesDialog(PsmapDialog):
             self.vPropertiesDict['masked'] = 'y' 
         else:
             self.vPropertiesDict['masked'] = 'n'
-
+        #processing before rendering
+        self.vPropertiesDict['clip'] = self.clip.GetValue()
+        if self.generalize:
+            self.vPropertiesDict['generalize'] = self.generalize.GetValue()
         
         #colors
         if self.type in ('points', 'areas'):
@@ -3762,6 +4559,11 @@ class LegendDialog(PsmapDialog):
             self.currRaster = self.instruction[self.rasterId]['raster'] 
         else:
             self.currRaster = None
+        # type and range of current raster are read in background
+        self.currRasterType = None
+        self.minim, self.maxim = 0, 0
+        # raster map -> MetadataFuture of its info
+        self.rasterInfo = dict()
 
         
         #notebook
@@ -3777,6 +4579,16 @@ class LegendDialog(PsmapDialog):
         
         self._layout(self.notebook)
         self.notebook.ChangeSelection(page)
+        if self.currRaster:
+            self.RequestRasterInfo(self.currRaster, callback = self.OnRasterInfo)
+        
+    def RequestRasterInfo(self, raster, callback = None):
+        """!Request type and range of raster map, returns MetadataFuture"""
+        if raster not in self.rasterInfo:
+            self.rasterInfo[raster] = metadataService.Request(getRasterInfo, raster)
+        if callback:
+            self.rasterInfo[raster].AddCallback(callback)
+        return self.rasterInfo[raster]
         
     def _rasterLegend(self, notebook):
         panel = scrolled.ScrolledPanel(parent = notebook, id = wx.ID_ANY, size = (-1, 500), style = wx.TAB_TRAVERSAL)
@@ -3801,8 +4613,10 @@ class LegendDialog(PsmapDialog):
         self.rasterDefault.SetValue(self.rLegendDict['rasterDefault'])#
         self.rasterOther.SetValue(not self.rLegendDict['rasterDefault'])#
 
-        rasterType = getRasterType(map = self.currRaster)
-
+        if self.currRaster:
+            rasterType = '...'
+        else:
+            rasterType = None
         self.rasterCurrent = wx.StaticText(panel, id = wx.ID_ANY,
                                 label = _("%s: type %s" % (self.currRaster, rasterType)))
         self.rasterSelect = Select( panel, id = wx.ID_ANY, size = globalvar.DIALOG_GSELECT_SIZE,
@@ -3856,11 +4670,6 @@ class LegendDialog(PsmapDialog):
         else:
             self.ticks.SetValue(False)
         # range
-        if self.rasterId and self.instruction[self.rasterId]['raster']:
-            rinfo = grass.raster_info(self.instruction[self.rasterId]['raster'])
-            self.minim, self.maxim = rinfo['min'], rinfo['max']
-        else:
-            self.minim, self.maxim = 0,0
         self.range = wx.CheckBox(panel, id = wx.ID_ANY, label = _("range"))
         self.range.SetValue(self.rLegendDict['range'])
         self.minText =  wx.StaticText(panel, id = wx.ID_ANY, label = "min (%s)" % self.minim)
@@ -4141,14 +4950,49 @@ class LegendDialog(PsmapDialog):
                     if i != 0:
                         widget.Disable()
                     
+    def OnRasterInfo(self, future):
+        """!Type and range of current raster are available"""
+        if not self or future is not self.rasterInfo.get(self.currRaster):
+            return
+        try:
+            rinfo = future.GetResult()
+        except grass.ScriptError:
+            return
+        if not rinfo:
+            self.currRasterType = None
+            self.rasterCurrent.SetLabel(_("%s: type %s") % (self.currRaster, None))
+            return
+        self.currRasterType = rinfo['datatype']
+        self.minim, self.maxim = rinfo['min'], rinfo['max']
+        self.rasterCurrent.SetLabel(_("%s: type %s") % (self.currRaster, self.currRasterType))
+        self.minText.SetLabel("min (%s)" % self.minim)
+        self.maxText.SetLabel("max (%s)" % self.maxim)
+        self.panelRaster.Layout()
+        # switch legend type only if it is not given and differs,
+        # size control is rebuilt then, otherwise keep what user typed
+        if not self.rasterDefault.GetValue() or self.rLegendDict['discrete'] in ('y', 'n'):
+            return
+        if self.currRasterType == 'CELL' and not self.discrete.GetValue():
+            self.discrete.SetValue(True)
+        elif self.currRasterType in ('FCELL', 'DCELL') and not self.continuous.GetValue():
+            self.continuous.SetValue(True)
+        else:
+            return
+        self.OnDiscrete(None)
+            
     def OnRaster(self, event):
         if self.rasterDefault.GetValue():#default
             self.rasterSelect.Disable()
-            type = getRasterType(self.currRaster)
+            type = self.currRasterType
         else:#select raster
             self.rasterSelect.Enable()
             map = self.rasterSelect.GetValue()
-            type = getRasterType(map)
+            # type of selected raster is applied when it is available
+            type = None
+            initial = event is None
+            if map:
+                self.RequestRasterInfo(map, callback = lambda future:
+                                           self.OnSelectedRasterInfo(future, map, initial))
   
         if type == 'CELL':
             self.discrete.SetValue(True)
@@ -4161,6 +5005,26 @@ class LegendDialog(PsmapDialog):
                 self.continuous.SetValue(True)
         self.OnDiscrete(None)
         
+    def OnSelectedRasterInfo(self, future, raster, initial):
+        """!Type of selected raster is available, switch legend type
+
+        @param initial True if raster was selected when dialog was opened
+        """
+        if not self or self.rasterDefault.GetValue() or self.rasterSelect.GetValue() != raster:
+            return
+        try:
+            rinfo = future.GetResult()
+        except grass.ScriptError:
+            return
+        # legend type given in instruction is kept
+        if not rinfo or (initial and self.rLegendDict['discrete'] in ('y', 'n')):
+            return
+        if rinfo['datatype'] == 'CELL':
+            self.discrete.SetValue(True)
+        elif rinfo['datatype'] in ('FCELL', 'DCELL'):
+            self.continuous.SetValue(True)
+        self.OnDiscrete(None)
+        
     def OnDiscrete(self, event):
         """! Change control according to the type of legend"""
         enabledSize = self.panelRaster.heightOrColumnsCtrl.IsEnabled()
@@ -4296,11 +5160,14 @@ class LegendDialog(PsmapDialog):
             return False
             
         if self.rLegendDict['raster']:
-            # type and range of map
-            rasterType = getRasterType(self.rLegendDict['raster'])
-            if rasterType is None:
+            # type of map, request is usually done since raster was selected
+            try:
+                rinfo = self.RequestRasterInfo(self.rLegendDict['raster']).GetResult()
+            except grass.ScriptError:
+                rinfo = None
+            if rinfo is None:
                 return False
-            self.rLegendDict['type'] = rasterType
+            self.rLegendDict['type'] = rinfo['datatype']
             
             
             #discrete
@@ -4511,8 +5378,13 @@ class LegendDialog(PsmapDialog):
         else:
             currRaster = None
 
-        rasterType = getRasterType(map = currRaster)
-        self.rasterCurrent.SetLabel( _("%s: type %s") % (currRaster, str(rasterType)))
+        # type is filled in by OnRasterInfo, raster could be changed meanwhile
+        self.currRaster = currRaster
+        self.currRasterType = None
+        self.rasterCurrent.SetLabel( _("%s: type %s") % (currRaster, None))
+        if currRaster:
+            self.rasterInfo.pop(currRaster, None)
+            self.RequestRasterInfo(currRaster, callback = self.OnRasterInfo)
         
         # vector legend
         
@@ -4849,7 +5721,7 @@ class ScalebarDialog(PsmapDialog):
         if self.scalebarDict['length']:
             self.lengthTextCtrl.SetValue(str(self.scalebarDict['length']))
         else: #estimate default
-            reg = grass.region()
+            reg = Region()
             w = int((reg['e'] - reg['w'])/3)
             w = round(w, -len(str(w)) + 2) #12345 -> 12000
             self.lengthTextCtrl.SetValue(str(w))
@@ -5468,49 +6340,145 @@ class TextDialog(PsmapDialog):
         self.eastingCtrl.SetValue(str(self.textDict['east']))
         self.northingCtrl.SetValue(str(self.textDict['north']))
 
+class AtlasDialog(PsmapDialog):
+    """!Dialog for generating map series (atlas) from current layout"""
+    def __init__(self, parent, id, settings):
+        PsmapDialog.__init__(self, parent = parent, id = id, title = _("Generate atlas"),
+                             settings = settings, apply = False)
+        self.objectType = ('atlas',)
+        self.atlasDict = dict(source = 'vector', vector = '', column = '', filename = '', stage = False)
+        
+        self.panel = self._atlasPanel()
+        self._layout(self.panel)
+        self.OnSource(None)
+        
+    def _atlasPanel(self):
+        panel = wx.Panel(parent = self, id = wx.ID_ANY, style = wx.TAB_TRAVERSAL)
+        border = wx.BoxSizer(wx.VERTICAL)
+        
+        # sheets
+        box   = wx.StaticBox (parent = panel, id = wx.ID_ANY, label = " %s " % _("Sheets"))
+        sizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        gridBagSizer = wx.GridBagSizer (hgap = 5, vgap = 5)
+        
+        self.vectorRadio = wx.RadioButton(panel, id = wx.ID_ANY, label = _("areas of vector map:"), style = wx.RB_GROUP)
+        self.vectorSelect = Select(panel, id = wx.ID_ANY, size = globalvar.DIALOG_GSELECT_SIZE,
+                                   type = 'vector', multiple = False,
+                                   updateOnPopup = True, onPopup = None)
+        self.columnLabel = wx.StaticText(panel, id = wx.ID_ANY, label = _("sheet name column (optional):"))
+        self.columnCtrl = wx.TextCtrl(panel, id = wx.ID_ANY, value = '')
+        self.gridRadio = wx.RadioButton(panel, id = wx.ID_ANY, label = _("grid covering current region"))
+        comment = wx.StaticText(panel, id = wx.ID_ANY,
+                                label = _("Map frame keeps its size and scale, texts can contain\n"
+                                          "${sheet}, ${number}, ${count}, ${date}, ${scale}\n"
+                                          "and ${column} for attributes of tile index."))
+        
+        gridBagSizer.Add(self.vectorRadio, pos = (0, 0), flag = wx.ALIGN_CENTER_VERTICAL, border = 0)
+        gridBagSizer.Add(self.vectorSelect, pos = (0, 1), flag = wx.ALIGN_CENTER_VERTICAL|wx.EXPAND, border = 0)
+        gridBagSizer.Add(self.columnLabel, pos = (1, 0), flag = wx.ALIGN_CENTER_VERTICAL|wx.LEFT, border = 20)
+        gridBagSizer.Add(self.columnCtrl, pos = (1, 1), flag = wx.ALIGN_CENTER_VERTICAL|wx.EXPAND, border = 0)
+        gridBagSizer.Add(self.gridRadio, pos = (2, 0), span = (1, 2), flag = wx.ALIGN_CENTER_VERTICAL, border = 0)
+        gridBagSizer.Add(comment, pos = (3, 0), span = (1, 2), flag = wx.ALIGN_CENTER_VERTICAL, border = 0)
+        
+        sizer.Add(gridBagSizer, proportion = 1, flag = wx.EXPAND|wx.ALL, border = 5)
+        border.Add(item = sizer, proportion = 0, flag = wx.ALL | wx.EXPAND, border = 5)
+        
+        # output
+        box   = wx.StaticBox (parent = panel, id = wx.ID_ANY, label = " %s " % _("Output"))
+        sizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        self.fileCtrl = filebrowse.FileBrowseButton(panel, id = wx.ID_ANY, labelText = _("PostScript file:"),
+                                buttonText =  _("Browse"), toolTip = _("Sheet name is added to the file name"), 
+                                dialogTitle = _("Choose a file"), startDirectory = '', initialValue = '',
+                                fileMask = "PostScript (*.ps)|*.ps|All files (*.*)|*.*", fileMode = wx.SAVE)
+        self.stageCheck = wx.CheckBox(panel, id = wx.ID_ANY,
+                                      label = _("copy maps to local temporary directory before rendering"))
+        self.stageCheck.SetValue(self.atlasDict['stage'])
+        sizer.Add(self.fileCtrl, proportion = 1, flag = wx.EXPAND|wx.ALL, border = 5)
+        sizer.Add(self.stageCheck, proportion = 0, flag = wx.ALL, border = 5)
+        border.Add(item = sizer, proportion = 0, flag = wx.ALL | wx.EXPAND, border = 5)
+        
+        self.Bind(wx.EVT_RADIOBUTTON, self.OnSource, self.vectorRadio)
+        self.Bind(wx.EVT_RADIOBUTTON, self.OnSource, self.gridRadio)
+        
+        panel.SetSizer(border)
+        panel.Fit()
+        return panel
+        
+    def OnSource(self, event):
+        """!Enable vector map selection"""
+        enable = self.vectorRadio.GetValue()
+        for each in (self.vectorSelect, self.columnLabel, self.columnCtrl):
+            each.Enable(enable)
+        
+    def update(self):
+        if self.vectorRadio.GetValue():
+            self.atlasDict['source'] = 'vector'
+            self.atlasDict['vector'] = self.vectorSelect.GetValue()
+            if not self.atlasDict['vector']:
+                wx.MessageBox(message = _("No vector map selected!"), caption = _('No vector map'),
+                              style = wx.OK|wx.ICON_ERROR)
+                return False
+        else:
+            self.atlasDict['source'] = 'grid'
+        self.atlasDict['column'] = self.columnCtrl.GetValue().strip()
+        self.atlasDict['filename'] = self.fileCtrl.GetValue()
+        self.atlasDict['stage'] = self.stageCheck.GetValue()
+        if not self.atlasDict['filename']:
+            wx.MessageBox(message = _("No output file given!"), caption = _('No output file'),
+                          style = wx.OK|wx.ICON_ERROR)
+            return False
+        return True
+        
+    def OnApply(self, event):
+        ok = self.update()
+        if ok:
+            self.parent.GenerateAtlas(self.atlasDict)
+        return ok
         
 def convertRGB(rgb):
     """!Converts wx.Colour(255,255,255,255) and string '255:255:255',
             depends on input""" 
-    psmapColors = { "white" : (1.00, 1.00, 1.00),
-                    "black" : (0.00, 0.00, 0.00),
-                    "red" : (1.00, 0.00, 0.00),
-                    "green" : (0.00, 1.00, 0.00),
-                    "blue" : (0.00, 0.00, 1.00),
-                    "yellow" : (1.00, 1.00, 0.00),
-                    "magenta" : (1.00, 0.00, 1.00),
-                    "cyan" : (0.00, 1.00, 1.00),
-                    "aqua" : (0.00, 0.75, 0.75),
-                    "grey" : (0.75, 0.75, 0.75),
-                    "gray" : (0.75, 0.75, 0.75),
-                    "orange" : (1.00, 0.50, 0.00),
-                    "brown" : (0.75, 0.50, 0.25),
-                    "purple" : (0.50, 0.00, 1.00),
-                    "violet" : (0.50, 0.00, 1.00),
-                    "indigo" : (0.00, 0.50, 1.00)}
-    
-    if type(rgb) == wx.Colour:
-        for name, color in psmapColors.items(): 
-            if  rgb.Red() == int(color[0] * 255) and\
-                rgb.Green() == int(color[1] * 255) and\
-                rgb.Blue() == int(color[2] * 255):
-                return name
-        return str(rgb.Red()) + ':' + str(rgb.Green()) + ':' + str(rgb.Blue())
-    elif type(rgb) == str or type(rgb) == unicode:
-        if ':' in rgb:
-            return wx.Colour(*map(int, rgb.split(':')))
-        else:
-            color = map(lambda x: int(x * 255), psmapColors[rgb])
-            color = wx.Color(*color)
-            if color.IsOk():
-                return color  
-            return None
-        
+    if isinstance(rgb, wx.Colour):
+        r, g, b = rgb.Red(), rgb.Green(), rgb.Blue()
+        name = PSMAP_COLORS_PACKED.get((r << 16) | (g << 8) | b)
+        if name:
+            return name
+        return '%d:%d:%d' % (r, g, b)
+    elif isinstance(rgb, basestring):
+        if rgb not in colourPool:
+            if ':' in rgb:
+                color = wx.Colour(*map(int, rgb.split(':')))
+            else:
+                color = wx.Colour(*PSMAP_COLORS_RGB[rgb])
+                if not color.IsOk():
+                    return None
+            colourPool[rgb] = color.Get()
+        return wx.Colour(*colourPool[rgb])
+        
+def ValidateColor(color):
+    """!Returns normalized color string ('R:G:B', name or 'none') or None if color is invalid"""
+    color = color.strip()
+    if color.lower() == 'none' or color.lower() in PSMAP_COLORS_RGB:
+        return color.lower()
+    try:
+        rgb = map(int, color.split(':'))
+    except ValueError:
+        return None
+    if len(rgb) != 3 or min(rgb) < 0 or max(rgb) > 255:
+        return None
+    return '%d:%d:%d' % tuple(rgb)
+    
         
-def PaperMapCoordinates(map, x, y, paperToMap = True):
-    """!Converts paper (inch) coordinates -> map coordinates"""
+def PaperMapCoordinates(map, x, y, paperToMap = True, region = None):
+    """!Converts paper (inch) coordinates -> map coordinates
+
+    @param region current region (dict from Region()), if None it's read
+    """
     unitConv = UnitConversion()
-    currRegionDict = grass.region()
+    if region:
+        currRegionDict = region
+    else:
+        currRegionDict = Region()
     cornerEasting, cornerNorthing = currRegionDict['w'], currRegionDict['n']
     xMap = map['rect'][0]
     yMap = map['rect'][1]
@@ -5575,7 +6543,7 @@ def AutoAdjust(self, scaleType,  rect, map = None, mapType = None, region = None
         try:
             windFile = open(windFilePath, 'r').read()
         except IOError:
-            currRegionDict = grass.region()
+            currRegionDict = Region()
         regionDict = grass.parse_key_val(windFile, sep = ':', val_type = float)
         region = grass.read_command("g.region", flags = 'gu', n = regionDict['north'], s = regionDict['south'],
                                                                 e = regionDict['east'], w = regionDict['west'])
@@ -5624,31 +6592,325 @@ def SetResolution(dpi, width, height):
     @param width map frame width
     @param height map frame height
     """
-    region = grass.region()
+    region = Region()
     if region['cols'] > width * dpi or region['rows'] > height * dpi:
         rows = height * dpi
         cols = width * dpi
         RunCommand('g.region', rows = rows, cols = cols)
         
+def ResampleRaster(raster, copies = 4):
+    """!Returns raster map resampled to current region (when raster is finer than region)
+
+    Floating point maps are averaged (r.resamp.stats), integer maps keep
+    their categories (r.resample). Copies are kept in cache mapset
+    (see CacheMapset) and reused while raster and region don't change,
+    only the last copies of each raster are kept.
+
+    @param raster name of raster map
+    @param copies max number of kept copies of the raster
+
+    @return name of resampled raster map, original name if resampling is not needed or fails
+    """
+    info = FindFile(raster, element = 'cellhd')
+    if not info['file']:
+        return raster
+    mapsetPath = os.path.dirname(os.path.dirname(info['file']))
+    header = dict()
+    try:
+        fd = open(info['file'], 'r')
+        try:
+            for line in fd:
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    header[key.strip()] = value.strip()
+        finally:
+            fd.close()
+        nsres = (float(header['north']) - float(header['south'])) / int(header['rows'])
+        ewres = (float(header['east']) - float(header['west'])) / int(header['cols'])
+    except (IOError, KeyError, ValueError, ZeroDivisionError):
+        # e.g. latitude-longitude in degrees, minutes, seconds
+        rasterInfo = RasterInfo(info['fullname'])
+        nsres, ewres = rasterInfo['nsres'], rasterInfo['ewres']
+    region = Region()
+    if nsres >= region['nsres'] and ewres >= region['ewres']:
+        return raster
+    
+    # name is given by raster and its version and by region
+    files = [os.path.join(mapsetPath, element, info['name']) for element in ('cellhd', 'cell', 'fcell')]
+    stamps = [os.path.getmtime(file) for file in files if os.path.exists(file)]
+    state = repr((stamps, [region[key] for key in ('n', 's', 'e', 'w', 'rows', 'cols')]))
+    prefix = 'psmap_resampled_%s_' % hashlib.md5(info['fullname']).hexdigest()[:8]
+    name = prefix + hashlib.md5(state).hexdigest()[:8]
+    tmpMapset, tmpPath, env = CacheMapset()
+    cellhd = os.path.join(tmpPath, 'cellhd', name)
+    if os.path.exists(cellhd):
+        # mark as recently used
+        os.utime(cellhd, None)
+        return '%s@%s' % (name, tmpMapset)
+    
+    if os.path.exists(os.path.join(mapsetPath, 'fcell', info['name'])):
+        ret = grass.run_command('r.resamp.stats', quiet = True, overwrite = True, input = info['fullname'],
+                                output = name, method = 'average', env = env)
+        if ret == 0:
+            ret = grass.run_command('r.colors', quiet = True, map = name, raster = info['fullname'], env = env)
+    else:
+        ret = grass.run_command('r.resample', quiet = True, overwrite = True, input = info['fullname'],
+                                output = name, env = env)
+    if ret != 0:
+        return raster
+    
+    RemoveOldCopies(prefix, 'rast', copies)
+    return '%s@%s' % (name, tmpMapset)
+    
+def PrepareRenderInstruction(instruction, dpi = None):
+    """!Replace raster by its copy resampled to current region and vectors by generalized and clipped copies (if required)
+
+    Called in background thread before ps.map is run, instruction
+    must not be shared with GUI (see Instruction.Clone).
+
+    @param dpi output resolution, resolution of map frame by default
+
+    @return instruction
+    """
+    raster = instruction.FindInstructionByType('raster')
+    if raster and raster['isRaster'] and raster['resample']:
+        raster['raster'] = ResampleRaster(raster['raster'])
+    map = instruction.FindInstructionByType('map')
+    for vector in instruction.FindInstructionByType('vProperties', list = True):
+        if vector['generalize'] and map:
+            vector['name'] = GeneralizeVector(vector['name'], vector.subType, layer = vector['layer'],
+                                              scale = map['scale'], dpi = dpi or map['resolution'])
+    ClipVectors(instruction)
+    return instruction
+    
+def GeneralizeVector(vector, subType, layer, scale, dpi, copies = 4):
+    """!Returns vector map with lines or boundaries simplified for given scale
+
+    Vertices closer than output pixel are removed (v.generalize, Douglas-Peucker).
+    Copies are kept in cache mapset and reused while vector and
+    tolerance don't change, only the last copies of each vector are kept.
+
+    @param vector name of vector map
+    @param subType 'lines' or 'areas'
+    @param layer layer of attributes to copy
+    @param scale map scale (e.g. 1/10000.)
+    @param dpi output resolution
+
+    @return name of generalized vector map, original name if it fails
+    """
+    info = FindFile(vector, element = 'vector')
+    if not info['file'] or not scale:
+        return vector
+    # output pixel in map units
+    threshold = 0.0254 / dpi / scale
+    units = projInfo()
+    if units['proj'] == 'll':
+        threshold /= 111320.
+    else:
+        threshold /= float(units.get('meters', 1))
+    
+    files = [os.path.join(info['file'], element) for element in ('head', 'coor', 'dbln')]
+    stamps = [os.path.getmtime(file) for file in files if os.path.exists(file)]
+    state = repr((stamps, subType, layer, '%.6g' % threshold))
+    prefix = 'psmap_generalized_%s_' % hashlib.md5(info['fullname']).hexdigest()[:8]
+    name = prefix + hashlib.md5(state).hexdigest()[:8]
+    tmpMapset, tmpPath, env = CacheMapset()
+    head = os.path.join(tmpPath, 'vector', name, 'head')
+    if os.path.exists(head):
+        # mark as recently used
+        os.utime(head, None)
+        return '%s@%s' % (name, tmpMapset)
+    
+    ret = grass.run_command('v.generalize', flags = 'c', quiet = True, overwrite = True, input = info['fullname'],
+                            output = name, layer = layer, method = 'douglas', threshold = threshold,
+                            type = {'lines' : 'line', 'areas' : 'boundary'}[subType], env = env)
+    if ret != 0:
+        return vector
+    RemoveOldCopies(prefix, 'vect', copies)
+    return '%s@%s' % (name, tmpMapset)
+    
+def ClipVector(vector, type, layer, margin, copies = 100):
+    """!Returns vector map with features overlapping current region (v.select)
+
+    Copies are kept in cache mapset and reused while vector and clipped
+    extent don't change, only the last copies of each vector are kept.
+
+    @param vector name of vector map
+    @param type feature types (for v.select atype)
+    @param layer layer of attributes to copy
+    @param margin region is enlarged by margin (map units), e.g. for symbols
+
+    @return name of clipped vector map, original name if it fails
+    """
+    info = FindFile(vector, element = 'vector')
+    if not info['file']:
+        return vector
+    region = Region()
+    n, s = region['n'] + margin, region['s'] - margin
+    e, w = region['e'] + margin, region['w'] - margin
+    
+    files = [os.path.join(info['file'], element) for element in ('head', 'coor', 'dbln')]
+    stamps = [os.path.getmtime(file) for file in files if os.path.exists(file)]
+    state = repr((stamps, type, layer, ['%.6g' % value for value in (n, s, e, w)]))
+    prefix = 'psmap_clipped_%s_' % hashlib.md5(info['fullname']).hexdigest()[:8]
+    name = prefix + hashlib.md5(state).hexdigest()[:8]
+    tmpMapset, tmpPath, env = CacheMapset()
+    head = os.path.join(tmpPath, 'vector', name, 'head')
+    if os.path.exists(head):
+        # mark as recently used
+        os.utime(head, None)
+        return '%s@%s' % (name, tmpMapset)
+    
+    # area covering enlarged region, atlas sheets are clipped in other thread than preview
+    box = 'tmp_psmap_box_%d_%d' % (os.getpid(), threading.currentThread().ident)
+    ascii = "B 5\n %(w)f %(n)f\n %(e)f %(n)f\n %(e)f %(s)f\n %(w)f %(s)f\n %(w)f %(n)f\n" \
+            "C 1 1\n %(x)f %(y)f\n 1 1\n" % dict(n = n, s = s, e = e, w = w, x = (e + w) / 2, y = (n + s) / 2)
+    ret = grass.write_command('v.in.ascii', flags = 'n', quiet = True, overwrite = True, input = '-',
+                              output = box, format = 'standard', stdin = ascii, env = env)
+    if ret == 0:
+        ret = grass.run_command('v.select', quiet = True, overwrite = True, ainput = info['fullname'],
+                                atype = type, alayer = layer, binput = box, btype = 'area',
+                                output = name, operator = 'overlap', env = env)
+    grass.run_command('g.remove', quiet = True, vect = box, env = env)
+    if ret != 0:
+        return vector
+    RemoveOldCopies(prefix, 'vect', copies)
+    return '%s@%s' % (name, tmpMapset)
+    
+def ClipVectors(instruction, copies = 100):
+    """!Replace vectors (with clipping required) by their parts overlapping current region
+
+    Region is enlarged by 0.5 inch on paper for symbols. Called in
+    render thread (PrepareRenderInstruction) and for atlas sheets in
+    AtlasThread (region of the sheet is used there).
+
+    @param copies max number of kept clipped copies of each vector
+    """
+    map = instruction.FindInstructionByType('map')
+    if not map or not map['scale']:
+        return
+    margin = 0.5 * 0.0254 / map['scale']
+    units = projInfo()
+    if units['proj'] == 'll':
+        margin /= 111320.
+    else:
+        margin /= float(units.get('meters', 1))
+    for vector in instruction.FindInstructionByType('vProperties', list = True):
+        if not vector['clip']:
+            continue
+        if vector.subType == 'areas':
+            type = 'area'
+        else:
+            type = ','.join(vector['type'].split(' or '))
+        vector['name'] = ClipVector(vector['name'], type, vector['layer'], margin, copies = copies)
         
+def RemoveOldCopies(prefix, type, copies):
+    """!Remove the least recently used maps with given prefix from cache mapset
+
+    @param prefix prefix of map names
+    @param type 'rast' or 'vect'
+    @param copies number of kept maps
+    """
+    tmpMapset, mapsetPath, env = CacheMapset()
+    if type == 'rast':
+        path = lambda name: os.path.join(mapsetPath, 'cellhd', name)
+        element = 'cellhd'
+    else:
+        path = lambda name: os.path.join(mapsetPath, 'vector', name, 'head')
+        element = 'vector'
+    old = []
+    for each in os.listdir(os.path.join(mapsetPath, element)):
+        if each.startswith(prefix) and os.path.exists(path(each)):
+            old.append((os.path.getmtime(path(each)), each))
+    old.sort()
+    if len(old) > copies:
+        grass.run_command('g.remove', quiet = True, env = env,
+                          **{type : ','.join([each for mtime, each in old[:-copies]])})
+    
+def CacheMapset():
+    """!Returns name, path and environment of mapset for temporary maps (resampled, clipped...)
+
+    Mapset 'psmap_cache_<user>' is created in current location with the
+    first request and kept, copies are named by their source maps and
+    parameters, so they are reused by later sessions (and by other ps.map
+    GUIs of the same user). Stale copies are removed by RemoveStaleCopies.
+    Mapset is not in search path, so its maps are not offered in map
+    selectors. Modules run with returned environment write maps to this
+    mapset, current region (of calling thread) is used.
+    """
+    gisenv = GetGisEnv()
+    locationPath = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+    if tmpMapsetCache.get('location') != locationPath:
+        user = os.getenv('USER') or os.getenv('USERNAME') or 'user'
+        name = 'psmap_cache_%s' % re.sub(r'\W', '_', user)
+        path = os.path.join(locationPath, name)
+        for dir in ('windows', 'dbf'):
+            if not os.path.isdir(os.path.join(path, dir)):
+                os.makedirs(os.path.join(path, dir))
+        if not os.path.exists(os.path.join(path, 'WIND')):
+            shutil.copyfile(os.path.join(locationPath, gisenv['MAPSET'], 'WIND'), os.path.join(path, 'WIND'))
+        gisrc = os.path.join(path, 'GISRC')
+        for file, text in (('VAR', "DB_DRIVER: dbf\nDB_DATABASE: $GISDBASE/$LOCATION_NAME/$MAPSET/dbf/\n"),
+                           (gisrc, "GISDBASE: %s\nLOCATION_NAME: %s\nMAPSET: %s\n" % \
+                                (gisenv['GISDBASE'], gisenv['LOCATION_NAME'], name))):
+            file = os.path.join(path, file)
+            if os.path.exists(file):
+                continue
+            # other GUIs may use the mapset, file is renamed when complete
+            fd = open(file + '.tmp%d' % os.getpid(), 'w')
+            try:
+                fd.write(text)
+            finally:
+                fd.close()
+            os.rename(file + '.tmp%d' % os.getpid(), file)
+        tmpMapsetCache.clear()
+        tmpMapsetCache.update(name = name, path = path, gisrc = gisrc, location = locationPath)
+    
+    env = os.environ.copy()
+    env['GISRC'] = tmpMapsetCache['gisrc']
+    if 'WIND_OVERRIDE' in env:
+        del env['WIND_OVERRIDE']
+    # current region is copied as saved region of the thread
+    stamp = GetRegionStamp()
+    if stamp:
+        regionName = 'region_%d_%d' % (os.getpid(), threading.currentThread().ident)
+        shutil.copyfile(stamp[0], os.path.join(tmpMapsetCache['path'], 'windows', regionName))
+        env['WIND_OVERRIDE'] = regionName
+    return tmpMapsetCache['name'], tmpMapsetCache['path'], env
+    
+def RemoveStaleCopies(maxAge = 30 * 24 * 3600):
+    """!Remove copies not used for given time and saved regions of this process from cache mapset
+
+    @param maxAge max time (seconds) since the last use of kept copies
+    """
+    if not tmpMapsetCache:
+        return
+    name, mapsetPath, env = CacheMapset()
+    windows = os.path.join(mapsetPath, 'windows')
+    for each in os.listdir(windows):
+        if each.startswith('region_%d_' % os.getpid()):
+            grass.try_remove(os.path.join(windows, each))
+    limit = time() - maxAge
+    for type, element, path in (('rast', 'cellhd', lambda name: os.path.join(mapsetPath, 'cellhd', name)),
+                                ('vect', 'vector', lambda name: os.path.join(mapsetPath, 'vector', name, 'head'))):
+        if not os.path.isdir(os.path.join(mapsetPath, element)):
+            continue
+        stale = []
+        for each in os.listdir(os.path.join(mapsetPath, element)):
+            try:
+                if each.startswith('psmap_') and os.path.getmtime(path(each)) < limit:
+                    stale.append(each)
+            except OSError:
+                continue
+        if stale:
+            grass.run_command('g.remove', quiet = True, env = env, **{type : ','.join(stale)})
+    tmpMapsetCache.clear()
+    
 def ComputeSetRegion(self, mapDict):
     """!Computes and sets region from current scale, map center coordinates and map rectangle"""
 
     if mapDict['scaleType'] == 3: # fixed scale
-        scale = mapDict['scale']
-            
-        if not hasattr(self, 'unitConv'):
-            self.unitConv = UnitConversion(self)
-        
-        fromM = 1
-        if projInfo()['proj'] != 'xy':
-            fromM = float(projInfo()['meters'])
-        rectHalfInch = ( mapDict['rect'].width/2, mapDict['rect'].height/2)
-        rectHalfMeter = ( self.unitConv.convert(value = rectHalfInch[0], fromUnit = 'inch', toUnit = 'meter')/ fromM /scale,
-                                self.unitConv.convert(value = rectHalfInch[1], fromUnit = 'inch', toUnit = 'meter')/ fromM /scale) 
-        
-        centerE = mapDict['center'][0]
-        centerN = mapDict['center'][1]
+        region = FixedScaleRegion(mapDict)
         
         raster = self.instruction.FindInstructionByType('raster')
         if raster:
@@ -5658,57 +6920,259 @@ def ComputeSetRegion(self, mapDict):
 
 
         if rasterId:
-            RunCommand('g.region', n = ceil(centerN + rectHalfMeter[1]),
-                           s = floor(centerN - rectHalfMeter[1]),
-                           e = ceil(centerE + rectHalfMeter[0]),
-                           w = floor(centerE - rectHalfMeter[0]),
-                           rast = self.instruction[rasterId]['raster'])
+            RunCommand('g.region', rast = self.instruction[rasterId]['raster'], **region)
         else:
-            RunCommand('g.region', n = ceil(centerN + rectHalfMeter[1]),
-                           s = floor(centerN - rectHalfMeter[1]),
-                           e = ceil(centerE + rectHalfMeter[0]),
-                           w = floor(centerE - rectHalfMeter[0]))
+            RunCommand('g.region', **region)
+        
+def FixedScaleExtent(mapDict):
+    """!Returns width and height of map frame in map units (given by map frame size and scale)"""
+    unitConv = UnitConversion()
+    fromM = 1
+    if projInfo()['proj'] != 'xy':
+        fromM = float(projInfo()['meters'])
+    return (unitConv.convert(value = mapDict['rect'].width, fromUnit = 'inch', toUnit = 'meter') / fromM / mapDict['scale'],
+            unitConv.convert(value = mapDict['rect'].height, fromUnit = 'inch', toUnit = 'meter') / fromM / mapDict['scale'])
+    
+def FixedScaleRegion(mapDict):
+    """!Returns region (n, s, e, w) of map frame with fixed scale and center"""
+    width, height = FixedScaleExtent(mapDict)
+    centerE, centerN = mapDict['center']
+    return dict(n = ceil(centerN + height / 2), s = floor(centerN - height / 2),
+                e = ceil(centerE + width / 2), w = floor(centerE - width / 2))
                     
+def RequestPaperSizes():
+    """!Request list of paper sizes (ps.map -p), returns MetadataFuture"""
+    return metadataService.RequestCached('paper', PaperSizes)
+    
 def projInfo():
     """!Return region projection and map units information,
-    taken from render.py"""
-    
-    projinfo = dict()
+    taken from render.py
+
+    Information doesn't change during session, it's read only once
+    (by helper process).
+    """
+    if projInfoCache:
+        return dict(projInfoCache)
+    try:
+        projinfo = ProjInfo()
+    except grass.ScriptError, e:
+        GError(message = _("Unable to get projection information\n%s") % e)
+        return dict()
     
-    ret = RunCommand('g.proj', read = True, flags = 'p')
+    projInfoCache.update(projinfo)
+    return dict(projinfo)
+
+def FindMaps(names, type):
+    """!Find full names of maps using one run of g.mlist
+
+    Names with mapset are checked in the same listing, maps from mapsets
+    outside of search path are checked by their files.
+
+    @param names list of map names (with or without mapset)
+    @param type map type ('rast', 'vect')
+
+    @return dictionary name -> full name (maps not found are missing)
+    """
+    fullNames = dict()
+    names = set(names)
+    if not names:
+        return fullNames
     
-    if not ret:
-        return projinfo
+    # maps are listed in order of mapsets in search path
+    listed = set()
+    ret = RunCommand('g.mlist', read = True, quiet = True, type = type, flags = 'm')
+    if ret:
+        for fullName in ret.splitlines():
+            fullName = fullName.strip()
+            listed.add(fullName)
+            name = fullName.split('@')[0]
+            if name in names and name not in fullNames:
+                fullNames[name] = fullName
     
-    for line in ret.splitlines():
-        if ':' in line:
-            key, val = line.split(':')
-            projinfo[key.strip()] = val.strip()
-        elif "XY location (unprojected)" in line:
-            projinfo['proj'] = 'xy'
-            projinfo['units'] = ''
-            break
+    element = {'rast' : 'cellhd', 'vect' : 'vector'}[type]
+    for name in names:
+        if '@' not in name:
+            continue
+        if name in listed:
+            fullNames[name] = name
+            continue
+        mapName, mapset = name.split('@', 1)
+        gisenv = GetGisEnv()
+        if os.path.exists(os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'], mapset, element, mapName)):
+            fullNames[name] = name
+    return fullNames
     
-    return projinfo
-
 def GetMapBounds(filename):
     """!Run ps.map -b to get information about map bounding box"""
     try:
-        bb = map(float, grass.read_command('ps.map',
-                                        flags = 'b',
-                                        input = filename).strip().split('=')[1].split(','))
+        bb = map(float, MapBounds(filename).strip().split('=')[1].split(','))
     except (grass.ScriptError, IndexError):
         GError(message = _("Unable to run `ps.map -b`"))
         return None
     return wx.Rect2D(bb[0], bb[3], bb[2] - bb[0], bb[1] - bb[3])
 
+def GetGisEnv():
+    """!Returns GRASS variables (GISDBASE, LOCATION_NAME, MAPSET, ...)
+
+    Variables are read again when GISRC file changes (e.g. after g.mapset).
+    """
+    gisrc = os.getenv('GISRC')
+    try:
+        stamp = (gisrc, os.path.getmtime(gisrc), os.path.getsize(gisrc))
+    except (OSError, TypeError):
+        stamp = None
+    if 'env' not in gisenvCache or gisenvCache['stamp'] != stamp:
+        gisenvCache['env'] = grass.gisenv()
+        gisenvCache['stamp'] = stamp
+    return gisenvCache['env']
+    
+def SearchPathStamp():
+    """!Returns stamp of mapset search path (current mapset and time of SEARCH_PATH change)"""
+    gisenv = GetGisEnv()
+    mapsetPath = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'], gisenv['MAPSET'])
+    try:
+        mtime = os.path.getmtime(os.path.join(mapsetPath, 'SEARCH_PATH'))
+    except OSError:
+        mtime = None
+    return (mapsetPath, mtime)
+    
+def GetVectorFilePath(name, element):
+    """!Returns path to file of vector map (e.g. 'dbln', 'head', 'topo')
+
+    Full names of unqualified maps are cached for current search path.
+    Raises ValueError if map is not found.
+    """
+    gisenv = GetGisEnv()
+    location = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+    if '@' in name:
+        vmap, mapset = name.split('@', 1)
+        return os.path.join(location, mapset, 'vector', vmap, element)
+    
+    key = (name, SearchPathStamp())
+    vectorCacheLock.acquire()
+    try:
+        cached = vectorNameCache.get(key)
+    finally:
+        vectorCacheLock.release()
+    if cached:
+        vmap, mapset = cached
+        # map could be removed meanwhile
+        if os.path.isdir(os.path.join(location, mapset, 'vector', vmap)):
+            return os.path.join(location, mapset, 'vector', vmap, element)
+    
+    vmap, mapset = FindFile(name = name, element = 'vector')['fullname'].split('@', 1)
+    vectorCacheLock.acquire()
+    try:
+        vectorNameCache[key] = (vmap, mapset)
+    finally:
+        vectorCacheLock.release()
+    return os.path.join(location, mapset, 'vector', vmap, element)
+    
+def GetVectorStamp(name, elements):
+    """!Returns modification times of vector map files, None if map is not found
+
+    Missing file is stamped by modification time of map directory,
+    so that file created later changes the stamp.
+    """
+    try:
+        paths = [GetVectorFilePath(name, element) for element in elements]
+    except ValueError:
+        return None
+    stamp = []
+    for path in paths:
+        try:
+            stamp.append(os.path.getmtime(path))
+        except OSError:
+            try:
+                stamp.append(('missing', os.path.getmtime(os.path.dirname(path))))
+            except OSError:
+                return None
+    return tuple(stamp)
+    
+def GetRegionStamp():
+    """!Returns stamp (path and content hash) of current region file, None if not available
+
+    Content is hashed, modification time has only one second resolution
+    and region edits usually keep file size.
+    """
+    if os.getenv('GRASS_REGION'):
+        return None
+    gisenv = GetGisEnv()
+    mapsetPath = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'], gisenv['MAPSET'])
+    if GetWindOverride():
+        path = os.path.join(mapsetPath, 'windows', GetWindOverride())
+    else:
+        path = os.path.join(mapsetPath, 'WIND')
+    try:
+        fd = open(path, 'r')
+        try:
+            content = fd.read()
+        finally:
+            fd.close()
+    except IOError:
+        return None
+    return (path, hashlib.md5(content).hexdigest())
+    
+def GetVectorDBInfo(name):
+    """!Returns dbm_base.VectorDBInfo of vector map
+
+    Metadata are cached until map's dbln file changes (or is created).
+    """
+    stamp = GetVectorStamp(name, ('dbln',))
+    vectorCacheLock.acquire()
+    try:
+        cached = vectorDBInfoCache.get(name)
+    finally:
+        vectorCacheLock.release()
+    if stamp and cached and cached[0] == stamp:
+        return cached[1]
+    
+    mapDBInfo = dbm_base.VectorDBInfo(name)
+    if stamp:
+        vectorCacheLock.acquire()
+        try:
+            vectorDBInfoCache[name] = (stamp, mapDBInfo)
+        finally:
+            vectorCacheLock.release()
+    return mapDBInfo
+    
+def GetVectorTopoInfo(name):
+    """!Returns topology summary of vector map (see grass.vector_info_topo)
+
+    Summary is cached until map's head or topo file changes (or is created).
+    """
+    stamp = GetVectorStamp(name, ('head', 'topo'))
+    vectorCacheLock.acquire()
+    try:
+        cached = vectorTopoCache.get(name)
+    finally:
+        vectorCacheLock.release()
+    if stamp and cached and cached[0] == stamp:
+        return cached[1]
+    
+    topoInfo = VectorTopoInfo(name)
+    if stamp:
+        vectorCacheLock.acquire()
+        try:
+            vectorTopoCache[name] = (stamp, topoInfo)
+        finally:
+            vectorCacheLock.release()
+    return topoInfo
+    
+def getRasterInfo(map):
+    """!Returns information about raster map (see grass.raster_info), None if map is not found"""
+    file = FindFile(name = map, element = 'cell')
+    if not file['file']:
+        return None
+    return RasterInfo(map)
+    
 def getRasterType(map):
     """!Returns type of raster map (CELL, FCELL, DCELL)"""
     if map is None:
         map = ''
-    file = grass.find_file(name = map, element = 'cell')
+    file = FindFile(name = map, element = 'cell')
     if file['file']:
-        rasterType = grass.raster_info(map)['datatype']
+        rasterType = RasterInfo(map)['datatype']
         return rasterType
     else:
         return None
@@ -0,0 +1,430 @@
+"""!
+@package psmap_worker
+
+@brief region and map queries for ps.map GUI, persistent helper processes
+
+Region and map search queries are answered by reading mapset files
+directly in GUI process. Information about maps, projection and paper
+(r.info, v.info, g.proj, ps.map -b, ps.map -p) is requested from helper
+processes started once and reused, requests and responses are pickled
+over pipes. Helpers read maps by GRASS libraries (ctypes), modules are
+run only when it's not possible. Threads can use saved region instead of
+current region (SetWindOverride) without changing environment of the
+whole process.
+
+Classes:
+ - Worker
+ - WorkerPool
+
+(C) 2011 by Anna Kratochvilova, and the GRASS Development Team
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author Anna Kratochvilova <anna.kratochvilova fsv.cvut.cz> (bachelor's project)
+@author Martin Landa <landa.martin gmail.com> (mentor)
+"""
+
+import os
+import sys
+import Queue
+import cPickle
+import threading
+
+# saved region used instead of current region, per thread
+threadRegion = threading.local()
+# environment variables passed with each request
+passedEnv = ('GISRC', 'WIND_OVERRIDE', 'GRASS_REGION')
+# True in helper process, GRASS libraries are used only there
+# (fatal error in library ends the process)
+inWorker = False
+# GRASS libraries (gis, vector) loaded in helper process, False if not available
+libraries = None
+
+def GetEnv():
+    """!Read GRASS variables from GISRC file"""
+    env = dict()
+    fd = open(os.environ['GISRC'], 'r')
+    try:
+        for line in fd:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                env[key.strip()] = value.strip()
+    finally:
+        fd.close()
+    return env
+
+def SetWindOverride(name):
+    """!Use saved region instead of current region in calling thread
+
+    @param name name of saved region, None to use WIND_OVERRIDE again
+    """
+    threadRegion.name = name
+    
+def GetWindOverride():
+    """!Returns name of saved region used in calling thread, None for current region"""
+    return getattr(threadRegion, 'name', None) or os.getenv('WIND_OVERRIDE')
+    
+def ModuleRegion():
+    """!Returns region given by g.region (used region of calling thread)"""
+    import grass.script as grass
+    env = os.environ.copy()
+    if GetWindOverride():
+        env['WIND_OVERRIDE'] = GetWindOverride()
+    region = grass.parse_key_val(grass.read_command('g.region', flags = 'g', env = env), val_type = float)
+    for key in ('rows', 'cols'):
+        region[key] = int(region[key])
+    return region
+    
+def Region():
+    """!Returns current region (the same as grass.region())"""
+    keys = {'north' : 'n', 'south' : 's', 'east' : 'e', 'west' : 'w',
+            'n-s resol' : 'nsres', 'e-w resol' : 'ewres', 'rows' : 'rows', 'cols' : 'cols'}
+    if os.getenv('GRASS_REGION'):
+        lines = os.getenv('GRASS_REGION').split(';')
+    else:
+        env = GetEnv()
+        mapsetPath = os.path.join(env['GISDBASE'], env['LOCATION_NAME'], env['MAPSET'])
+        if GetWindOverride():
+            path = os.path.join(mapsetPath, 'windows', GetWindOverride())
+        else:
+            path = os.path.join(mapsetPath, 'WIND')
+        fd = open(path, 'r')
+        try:
+            lines = fd.readlines()
+        finally:
+            fd.close()
+
+    region = dict()
+    try:
+        for line in lines:
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            if key.strip() in keys:
+                region[keys[key.strip()]] = float(value)
+    except ValueError:
+        # degrees, minutes, seconds
+        return ModuleRegion()
+    if len(region) != len(keys):
+        return ModuleRegion()
+
+    for key in ('rows', 'cols'):
+        region[key] = int(region[key])
+    region['cells'] = float(region['rows'] * region['cols'])
+    return region
+
+def FindFile(name, element = 'cell', mapset = ''):
+    """!Returns information about file (the same as grass.find_file())"""
+    notFound = dict(name = '', mapset = '', fullname = '', file = '')
+    if not name:
+        return notFound
+    env = GetEnv()
+    locationPath = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+    if '@' in name:
+        name, mapset = name.split('@', 1)
+    if mapset:
+        mapsets = [mapset]
+    else:
+        try:
+            fd = open(os.path.join(locationPath, env['MAPSET'], 'SEARCH_PATH'), 'r')
+            try:
+                mapsets = [line.strip() for line in fd if line.strip()]
+            finally:
+                fd.close()
+        except IOError:
+            mapsets = [env['MAPSET'], 'PERMANENT']
+
+    for each in mapsets:
+        path = os.path.join(locationPath, each, element, name)
+        # vector map is directory with head file
+        if element == 'vector':
+            found = os.path.isfile(os.path.join(path, 'head'))
+        else:
+            found = os.path.isfile(path)
+        if found:
+            return dict(name = name, mapset = each, fullname = '%s@%s' % (name, each), file = path)
+    return notFound
+
+def GetLibraries():
+    """!Returns GRASS libraries (gis, vector), None if they can't be used
+
+    Libraries are loaded only in helper process.
+    """
+    global libraries
+    if not inWorker:
+        return None
+    if libraries is None:
+        libraries = False
+        try:
+            import ctypes
+            from grass.lib import gis as libgis
+            from grass.lib import vector as libvect
+        except ImportError:
+            return None
+        libgis.G_gisinit('psmap_worker')
+        libvect.Vect_set_fatal_error(libvect.GV_FATAL_RETURN)
+        libraries = (libgis, libvect)
+    if not libraries:
+        return None
+    return libraries
+
+def RasterInfoHandler(map):
+    """!Returns type, range, extent and resolution of raster map
+    (keys of grass.raster_info() used by GUI)"""
+    lib = GetLibraries()
+    if not lib:
+        import grass.script as grass
+        return grass.raster_info(map)
+    import ctypes
+    libgis = lib[0]
+    file = FindFile(map, element = 'cell')
+    if not file['file']:
+        raise ValueError("Raster map <%s> not found" % map)
+    name, mapset = file['name'], file['mapset']
+    cellhd = libgis.Cell_head()
+    if libgis.G_get_cellhd(name, mapset, ctypes.byref(cellhd)) < 0:
+        raise ValueError("Unable to read header of raster map <%s>" % map)
+    types = {libgis.CELL_TYPE : 'CELL', libgis.FCELL_TYPE : 'FCELL', libgis.DCELL_TYPE : 'DCELL'}
+    info = dict(north = cellhd.north, south = cellhd.south, east = cellhd.east, west = cellhd.west,
+                nsres = cellhd.ns_res, ewres = cellhd.ew_res,
+                datatype = types[libgis.G_raster_map_type(name, mapset)], min = None, max = None)
+    fpRange = libgis.FPRange()
+    if libgis.G_read_fp_range(name, mapset, ctypes.byref(fpRange)) == 1:
+        minimum, maximum = ctypes.c_double(), ctypes.c_double()
+        libgis.G_get_fp_range_min_max(ctypes.byref(fpRange), ctypes.byref(minimum), ctypes.byref(maximum))
+        # null (NaN) for empty map
+        if minimum.value == minimum.value:
+            info['min'], info['max'] = minimum.value, maximum.value
+    return info
+
+def VectorTopoInfoHandler(map):
+    """!Returns topology summary of vector map (the same as grass.vector_info_topo())"""
+    lib = GetLibraries()
+    if lib:
+        import ctypes
+        libvect = lib[1]
+        name, mapset = map, ''
+        if '@' in map:
+            name, mapset = map.split('@', 1)
+        mapInfo = libvect.Map_info()
+        mapRef = ctypes.byref(mapInfo)
+        libvect.Vect_set_open_level(2)
+        level = libvect.Vect_open_old_head(mapRef, name, mapset)
+        if level >= 2:
+            info = dict(nodes = libvect.Vect_get_num_nodes(mapRef),
+                        primitives = libvect.Vect_get_num_lines(mapRef),
+                        areas = libvect.Vect_get_num_areas(mapRef),
+                        islands = libvect.Vect_get_num_islands(mapRef),
+                        map3d = bool(libvect.Vect_is_3d(mapRef)))
+            for key, type in (('points', libvect.GV_POINT), ('lines', libvect.GV_LINE),
+                              ('boundaries', libvect.GV_BOUNDARY), ('centroids', libvect.GV_CENTROID),
+                              ('faces', libvect.GV_FACE), ('kernels', libvect.GV_KERNEL)):
+                info[key] = libvect.Vect_get_num_primitives(mapRef, type)
+            libvect.Vect_close(mapRef)
+            return info
+        if level >= 1:
+            libvect.Vect_close(mapRef)
+    # topology not available, let v.info report it
+    import grass.script as grass
+    return grass.vector_info_topo(map = map)
+
+def ProjInfoHandler():
+    """!Returns projection and units of location (keys printed by g.proj -p)"""
+    env = GetEnv()
+    permanent = os.path.join(env['GISDBASE'], env['LOCATION_NAME'], 'PERMANENT')
+    if not os.path.isfile(os.path.join(permanent, 'PROJ_INFO')):
+        return dict(proj = 'xy', units = '')
+    info = dict()
+    for file in ('PROJ_INFO', 'PROJ_UNITS'):
+        try:
+            fd = open(os.path.join(permanent, file), 'r')
+        except IOError:
+            continue
+        try:
+            for line in fd:
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    info[key.strip()] = value.strip()
+        finally:
+            fd.close()
+    return info
+
+def MapBoundsHandler(input):
+    """!Returns output of ps.map -b (ps.map is not available as library)"""
+    import grass.script as grass
+    return grass.read_command('ps.map', flags = 'b', input = input)
+
+def PaperSizesHandler():
+    """!Returns output of ps.map -p (sizes are compiled in ps.map)"""
+    import grass.script as grass
+    return grass.read_command('ps.map', flags = 'p')
+
+handlers = {'raster_info' : RasterInfoHandler,
+            'vector_info_topo' : VectorTopoInfoHandler,
+            'proj' : ProjInfoHandler,
+            'map_bounds' : MapBoundsHandler,
+            'paper_sizes' : PaperSizesHandler}
+
+def main():
+    """!Serve requests read from stdin until it's closed"""
+    global inWorker
+    inWorker = True
+    if sys.platform == 'win32':
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+    # replies use copy of stdout, output of libraries and modules goes to stderr
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    while True:
+        try:
+            func, kwargs, env = cPickle.load(sys.stdin)
+        except EOFError:
+            break
+        for key in passedEnv:
+            if env.get(key):
+                os.environ[key] = env[key]
+            elif key in os.environ:
+                del os.environ[key]
+        try:
+            reply = (True, handlers[func](**kwargs))
+        except Exception, e:
+            reply = (False, str(e))
+        cPickle.dump(reply, output, cPickle.HIGHEST_PROTOCOL)
+        output.flush()
+
+def GisrcStamp():
+    """!Returns stamp of GISRC file, libraries of helper are initialized from it"""
+    try:
+        stat = os.stat(os.environ['GISRC'])
+    except (KeyError, OSError):
+        return None
+    return (os.environ['GISRC'], stat.st_mtime, stat.st_size)
+
+class Worker:
+    """!Client of one helper process, process is started with the first request
+
+    Process is started again when GISRC changes (e.g. g.mapset).
+    """
+    def __init__(self):
+        self.process = None
+        self.gisrc = None
+        # process can't be started (e.g. missing interpreter)
+        self.failed = False
+        
+    def _start(self):
+        """!Start helper process if it's not running, returns False on failure"""
+        if self.process and self.process.poll() is None:
+            if self.gisrc == GisrcStamp():
+                return True
+            self.Terminate()
+        import subprocess
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        try:
+            self.process = subprocess.Popen([sys.executable, script],
+                                            stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        except OSError:
+            self.process = None
+            self.failed = True
+            return False
+        self.gisrc = GisrcStamp()
+        return True
+        
+    def Call(self, func, kwargs, env):
+        """!Send request to helper process
+
+        @return (ok, result or error message), None if process can't handle request
+        """
+        for attempt in range(2):
+            if not self._start():
+                return None
+            try:
+                cPickle.dump((func, kwargs, env), self.process.stdin, cPickle.HIGHEST_PROTOCOL)
+                self.process.stdin.flush()
+                return cPickle.load(self.process.stdout)
+            except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+                # process died (e.g. fatal error in library), start it again
+                self.Terminate()
+        return None
+        
+    def Terminate(self):
+        """!Stop helper process"""
+        if self.process:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+            self.process = None
+
+class WorkerPool:
+    """!Pool of helper processes, each request is sent to idle one
+
+    If helper process can't be used, request is handled in calling process
+    (by GRASS modules).
+    """
+    def __init__(self, size = 2):
+        self.workers = [Worker() for i in range(size)]
+        self.idle = Queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.failed = False
+        
+    def Call(self, func, **kwargs):
+        """!Run request in helper process
+
+        @param func name of request ('raster_info', 'vector_info_topo', 'proj',
+        'map_bounds', 'paper_sizes')
+
+        @return result of the request
+        """
+        env = dict([(key, os.getenv(key)) for key in passedEnv])
+        # saved region of calling thread
+        env['WIND_OVERRIDE'] = GetWindOverride()
+        reply = None
+        if not self.failed:
+            worker = self.idle.get()
+            try:
+                reply = worker.Call(func, kwargs, env)
+                self.failed = worker.failed
+            finally:
+                self.idle.put(worker)
+        if reply is None:
+            # modules are run in this process
+            return handlers[func](**kwargs)
+        
+        ok, result = reply
+        if not ok:
+            import grass.script as grass
+            raise grass.ScriptError(result)
+        return result
+        
+    def Terminate(self):
+        """!Stop helper processes"""
+        for worker in self.workers:
+            worker.Terminate()
+
+workerPool = WorkerPool()
+
+def RasterInfo(map):
+    """!Returns type, range, extent and resolution of raster map (see grass.raster_info())"""
+    return workerPool.Call('raster_info', map = map)
+
+def VectorTopoInfo(map):
+    """!Returns topology summary of vector map (see grass.vector_info_topo())"""
+    return workerPool.Call('vector_info_topo', map = map)
+
+def ProjInfo():
+    """!Returns projection information as printed by g.proj -p"""
+    return workerPool.Call('proj')
+
+def MapBounds(input):
+    """!Returns output of ps.map -b for instruction file"""
+    return workerPool.Call('map_bounds', input = input)
+
+def PaperSizes():
+    """!Returns output of ps.map -p"""
+    return workerPool.Call('paper_sizes')
+
+if __name__ == '__main__':
+    main()